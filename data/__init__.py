@@ -2,7 +2,10 @@ from data.src.utils import load_original_gmd_dataset_pickle
 from data.src.utils import extract_hvo_sequences_dict
 from data.src.utils import pickle_hvo_dict
 from data.src.utils import get_drum_mapping_using_label
+from data.src.metadata_index import MetadataIndex
 from data.src.dataLoaders import load_gmd_hvo_sequences
 from data.src.dataLoaders import load_down_sampled_gmd_hvo_sequences
 from data.src.dataLoaders import MonotonicGrooveDataset
-from data.src.dataLoaders import GrooveDataSet_Density
\ No newline at end of file
+from data.src.dataLoaders import GrooveDataSet_Density
+from data.src.dataLoaders import SharedMemoryGrooveDataset
+from data.src.dataLoaders import TensorBatchIterator
\ No newline at end of file
@@ -1,18 +1,28 @@
-from src.utils import *
+import os, sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", ".."))
+
+from data.gmd.src.local_compiler import compile_local_gmd, get_compiled_data_directory
+from hvo_sequence.drum_mappings import get_drum_mapping_using_label
 
 import argparse
 
-parser = argparse.ArgumentParser(description='Script to download groove midi dataset from tfds and compile into'
-                                             'a single dictionary and stored as a pickle')
+parser = argparse.ArgumentParser(description='Script to compile the groove midi dataset (local midi files + info.csv) '
+                                             'into columnar hvo arrays (one npz file per train/test/validation split)')
+
+parser.add_argument('--source', type=str,
+                    default="data/gmd/resources/source_dataset/groove-v1.0.0-midionly.zip",
+                    help='path to the groove-v1.0.0-midionly.zip file or to the extracted groove/ folder',
+                    required=False)
 
-parser.add_argument('--set', type=str,
-                    default="resource/compiled_in_dict/",
-                    help='path to store the pickled dictionary of dataset',
+parser.add_argument('--info_csv', type=str,
+                    default="data/gmd/resources/source_dataset/info.csv",
+                    help='path to the info.csv file of the dataset',
                     required=False)
 
 parser.add_argument('--save_at', type=str,
-                    default="resource/compiled_in_dict/",
-                    help='path to store the pickled dictionary of dataset',
+                    default=None,
+                    help='path to store the compiled npz files (default: data/gmd/resources/compiled/...)',
                     required=False)
 
 parser.add_argument('--SetID', type=int,
@@ -20,29 +30,41 @@ parser.add_argument('--SetID', type=int,
                     help='SetID 0 is 2bar set, SetID 1 is 4bar set, SetID 2 is Full (unsplit) set',
                     required=False)
 
-args = parser.parse_args()
+parser.add_argument('--beat_division_factor', type=int, nargs="+",
+                    default=[4],
+                    help='beat division factors of the grid (e.g. 4 for 16th note resolution)',
+                    required=False)
 
-if __name__ == "__main__":
+parser.add_argument('--drum_mapping_label', type=str,
+                    default="ROLAND_REDUCED_MAPPING",
+                    help='drum mapping used for the hvo arrays (see hvo_sequence/drum_mappings.py)',
+                    required=False)
 
-    setTags = ["groove/2bar-midionly", "groove/4bar-midionly", "groove/full-midionly"]
+parser.add_argument('--num_processes', type=int,
+                    default=None,
+                    help='number of worker processes (default: number of cpus)',
+                    required=False)
 
-    # Step 1 --- get subsets from tfds
-    train_tfds, test_tfds, validation_tfds = load_midionly_gmd_subsets_from_tfds(setTags[args.SetID])
-    metadata_pd = get_gmd_metadata_as_pd("resources/source_dataset/info.csv")
+args = parser.parse_args()
 
-    # Step 2 --- mix tfds sets with metadata into a dictionary
-    train_dict = get_gmd_dict(train_tfds, metadata_pd)
-    test_dict = get_gmd_dict(test_tfds, metadata_pd)
-    validation_dict = get_gmd_dict(validation_tfds, metadata_pd)
+if __name__ == "__main__":
 
-    # Step 3 --- sort based on loop_id
-    train_dict = sort_dictionary_by_key(train_dict, "loop_id")
-    test_dict = sort_dictionary_by_key(test_dict, "loop_id")
-    validation_dict = sort_dictionary_by_key(validation_dict, "loop_id")
-    
-    # Step 4 --- store as a single dict
-    gmd_dict = {"train": train_dict, "test": test_dict, "validation": validation_dict}
-    fname = setTags[args.SetID].replace("/", "_")
-    pickle_dict = pickle_dict(gmd_dict, "resources/storedDicts", fname)
+    setTags = ["groove/2bar-midionly", "groove/4bar-midionly", "groove/full-midionly"]
+    segment_length_bars = [2, 4, None][args.SetID]
 
+    save_at = args.save_at
+    if save_at is None:
+        # same location load_gmd_hvo_sequences() looks for if the raw pickled dictionaries are not available
+        raw_data_pickle_path = os.path.join("data/gmd/resources/storedDicts",
+                                            setTags[args.SetID].replace("/", "_") + ".bz2pickle")
+        save_at = get_compiled_data_directory(raw_data_pickle_path, args.beat_division_factor,
+                                              args.drum_mapping_label)
 
+    compile_local_gmd(
+        source=args.source,
+        info_csv_path=args.info_csv,
+        output_dir=save_at,
+        drum_mapping=get_drum_mapping_using_label(args.drum_mapping_label),
+        beat_division_factors=args.beat_division_factor,
+        segment_length_bars=segment_length_bars,
+        n_processes=args.num_processes)
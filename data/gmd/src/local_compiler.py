@@ -0,0 +1,444 @@
+"""
+Offline compiler for the Groove MIDI Dataset
+
+Reads the midi files from a local copy of the dataset (extracted folder or the groove-v1.0.0-midionly.zip itself)
+together with info.csv, and converts them straight into hvo arrays in a process pool (no tfds / tensorflow,
+no note_seq / NoteSequence protobufs). The result is stored as a columnar cache, one .npz per split:
+
+    {output_dir}/{split}.npz   -->   hvo:            (total_steps, 3 * n_voices) float64, all samples concatenated
+                                     step_offsets:   (N + 1,) sample i is hvo[step_offsets[i]:step_offsets[i + 1]]
+                                     qpm, time_signature_numerator, time_signature_denominator: (N,)
+                                     + one (N,) str column per metadata field (drummer, master_id, loop_id, ...)
+"""
+import csv
+import json
+import os
+import struct
+import zipfile
+from multiprocessing import Pool
+
+import numpy as np
+
+import logging
+logger = logging.getLogger("data.gmd.local_compiler")
+logger.setLevel(logging.DEBUG)
+
+METADATA_FIELDS = ["drummer", "session", "loop_id", "master_id", "style_primary", "style_secondary", "bpm",
+                   "beat_type", "time_signature", "full_midi_filename", "full_audio_filename"]
+
+
+# -----------------------------------------------------------------
+# ----------------       MIDI Parsing       -----------------------
+# -----------------------------------------------------------------
+def _read_variable_length(data, pos):
+    value = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value = (value << 7) | (byte & 0x7F)
+        if not byte & 0x80:
+            return value, pos
+
+
+def parse_midi_bytes(data):
+    """
+    Minimal standard midi file parser (only what is needed for drum scores). Follows the conventions of pretty_midi
+    (used by note_seq / tfds): a note off (or note on with zero velocity) closes all the open notes of the same
+    channel and pitch, notes that are never closed are ignored
+
+    :param data: (bytes) content of a .mid file
+    :return: (dict) {"onsets_sec": (n_notes,) float array, "ends_sec": (n_notes,) float array (in file order),
+                     "pitches": (n_notes,) int array, "velocities": (n_notes,) int array (1-127),
+                     "tempos": [(sec, qpm)], "time_signatures": [(sec, numerator, denominator)],
+                     "end_time": time of the last event in seconds (same as PrettyMIDI.get_end_time()),
+                     "ticks_per_beat": int}
+    """
+    if data[:4] != b"MThd":
+        raise ValueError("Not a standard midi file")
+    header_length = struct.unpack(">I", data[4:8])[0]
+    _, n_tracks, division = struct.unpack(">HHH", data[8:14])
+    if division & 0x8000:
+        raise ValueError("SMPTE time division is not supported")
+
+    notes, tempos, time_signatures = [], [], []       # (tick, ...) entries
+    last_event_tick = 0
+    pos = 8 + header_length
+    for _ in range(n_tracks):
+        if data[pos:pos + 4] != b"MTrk":
+            raise ValueError("Malformed midi track")
+        track_end = pos + 8 + struct.unpack(">I", data[pos + 4:pos + 8])[0]
+        pos += 8
+        tick, running_status, open_notes = 0, None, dict()
+        while pos < track_end:
+            delta, pos = _read_variable_length(data, pos)
+            tick += delta
+            status = data[pos]
+            if status == 0xFF:                                  # meta event
+                meta_type = data[pos + 1]
+                length, pos = _read_variable_length(data, pos + 2)
+                if meta_type == 0x51:
+                    tempos.append((tick, int.from_bytes(data[pos:pos + 3], "big")))
+                elif meta_type == 0x58:
+                    time_signatures.append((tick, data[pos], 2 ** data[pos + 1]))
+                if meta_type in (0x01, 0x05, 0x51, 0x58, 0x59):    # text, lyrics, tempo, time/key signature
+                    last_event_tick = max(last_event_tick, tick)
+                pos += length
+                running_status = None
+            elif status in (0xF0, 0xF7):                        # sysex event
+                length, pos = _read_variable_length(data, pos + 1)
+                pos += length
+                running_status = None
+            else:                                               # channel event (possibly with running status)
+                if status & 0x80:
+                    running_status = status
+                    pos += 1
+                message_type, channel = running_status & 0xF0, running_status & 0x0F
+                if message_type in (0x80, 0x90):
+                    key_ = (channel, data[pos])
+                    if message_type == 0x90 and data[pos + 1] > 0:
+                        open_notes.setdefault(key_, []).append((tick, data[pos + 1]))
+                    elif key_ in open_notes:
+                        to_close = [note for note in open_notes[key_] if note[0] != tick]
+                        to_keep = [note for note in open_notes.pop(key_) if note[0] == tick]
+                        for start_tick, velocity in to_close:
+                            notes.append((start_tick, tick, data[pos], velocity))
+                            last_event_tick = max(last_event_tick, tick)
+                        # (as in pretty_midi) notes started at this tick stay open only if another note was closed
+                        if to_close and to_keep:
+                            open_notes[key_] = to_keep
+                elif message_type in (0xB0, 0xE0):              # control change, pitch bend
+                    last_event_tick = max(last_event_tick, tick)
+                pos += 1 if message_type in (0xC0, 0xD0) else 2
+        pos = track_end
+
+    # convert ticks to seconds using the tempo map (default 120 qpm)
+    tempos = sorted(tempos) if tempos else [(0, 500000)]
+    if tempos[0][0] != 0:
+        tempos.insert(0, (0, 500000))
+    tempo_ticks = np.array([t for t, _ in tempos], dtype=np.float64)
+    secs_per_tick = np.array([60.0 / ((60000000.0 / us_per_beat) * division) for _, us_per_beat in tempos])
+    tempo_secs = np.concatenate([[0.0], np.cumsum(np.diff(tempo_ticks) * secs_per_tick[:-1])])
+
+    def ticks_to_sec(ticks):
+        ticks = np.asarray(ticks, dtype=np.float64)
+        ix = np.searchsorted(tempo_ticks, ticks, side="right") - 1
+        return tempo_secs[ix] + (ticks - tempo_ticks[ix]) * secs_per_tick[ix]
+
+    return {
+        "onsets_sec": ticks_to_sec([n[0] for n in notes]),
+        "ends_sec": ticks_to_sec([n[1] for n in notes]),
+        "pitches": np.array([n[2] for n in notes], dtype=np.int64),
+        "velocities": np.array([n[3] for n in notes], dtype=np.int64),
+        "tempos": [(float(tempo_secs[ix]), 60.0 / (secs_per_tick[ix] * division)) for ix in range(len(tempos))],
+        "time_signatures": [(float(ticks_to_sec(t)), num, den) for t, num, den in sorted(time_signatures)],
+        "end_time": float(ticks_to_sec(last_event_tick)),
+        "ticks_per_beat": division
+    }
+
+
+# -----------------------------------------------------------------
+# ----------------     MIDI --> HVO arrays   ----------------------
+# -----------------------------------------------------------------
+def get_pitch_to_voice_lookup(drum_mapping):
+    """ (128,) array mapping a midi pitch to its voice index in the drum mapping (-1 if not mapped) """
+    lookup = np.full(128, -1, dtype=np.int64)
+    for voice_ix, pitches in reversed(list(enumerate(drum_mapping.values()))):
+        lookup[pitches] = voice_ix
+    return lookup
+
+
+def _get_beat_grid_locations(secs_per_beat, beat_division_factors):
+    return sorted(set(round(i * secs_per_beat / bdf, 3) for bdf in beat_division_factors for i in range(int(bdf))))
+
+
+def get_grid_lines(n_steps, qpm, denominator, beat_division_factors):
+    """
+    Grid lines (in seconds) of a single tempo/time signature score, computed exactly as GridMaker does
+    (including the rounding of the beat locations and of the grid lines to 1ms)
+    """
+    secs_per_beat = (60.0 / qpm) * 4.0 / denominator
+    beat_locations = _get_beat_grid_locations(secs_per_beat, beat_division_factors)
+    n_beats = n_steps / len(beat_locations)
+    beat_dur_sec = round(n_beats * secs_per_beat, 3) / n_beats
+    return np.array([round(loc + beat_dur_sec * beat_ix, 3) for beat_ix in range(int(n_beats))
+                     for loc in beat_locations])
+
+
+def notes_to_hvo(onsets_sec, pitches, velocities, pitch_to_voice, n_voices, qpm, numerator, denominator,
+                 beat_division_factors):
+    """
+    Places the notes on the grid the same way note_sequence_to_hvo_sequence() does: nearest grid line, offset
+    as a ratio of the distance to the next/previous grid line rounded to 3 decimals, the earliest note wins if
+    several notes fall on the same step and voice (the last one in file order if they start together), and the
+    sequence ends at the step of the last note
+
+    :param onsets_sec: (n_notes,) onset times in seconds (relative to the start of the segment), in file order
+    :param pitches: (n_notes,) midi pitches
+    :param velocities: (n_notes,) midi velocities (1-127)
+    :param pitch_to_voice: (128,) output of get_pitch_to_voice_lookup
+    :param n_voices: number of voices in the drum mapping
+    :param qpm: tempo
+    :param numerator: time signature numerator
+    :param denominator: time signature denominator
+    :param beat_division_factors: list of ints (e.g. [4] for 16th note resolution)
+    :return: (n_steps, 3 * n_voices) float64 hvo array (same dtype as the hvo of HVO_Sequence)
+    """
+    voices = pitch_to_voice[pitches]
+    is_mapped = voices >= 0
+    onsets_sec, voices, velocities = onsets_sec[is_mapped], voices[is_mapped], velocities[is_mapped]
+    if onsets_sec.size == 0:
+        return np.zeros((0, 3 * n_voices), dtype=np.float64)
+
+    # the grid initially spans two bars and is extended (once, by the latest note) if needed
+    secs_per_beat = (60.0 / qpm) * 4.0 / denominator
+    steps_per_beat = len(_get_beat_grid_locations(secs_per_beat, beat_division_factors))
+    n_grid_steps = 2 * numerator * steps_per_beat
+    grid = get_grid_lines(n_grid_steps, qpm, denominator, beat_division_factors)
+    latest = onsets_sec.max()
+    if latest > grid[-2]:
+        n_needed = int(np.ceil(latest / secs_per_beat)) * steps_per_beat + 1
+        n_needed = max(int(np.ceil(n_needed / steps_per_beat)) * steps_per_beat, numerator * steps_per_beat)
+        if n_needed > n_grid_steps:
+            grid = get_grid_lines(n_needed, qpm, denominator, beat_division_factors)
+
+    # nearest grid line (ties go to the earlier line)
+    right = np.clip(np.searchsorted(grid, onsets_sec, side="left"), 1, len(grid) - 1)
+    left = right - 1
+    step = np.where(np.abs(grid[right] - onsets_sec) < np.abs(onsets_sec - grid[left]), right, left)
+    diff = onsets_sec - grid[step]
+    next_interval = grid[np.minimum(step + 1, len(grid) - 1)] - grid[step]
+    previous_interval = grid[step] - grid[step - 1]
+    offsets = np.zeros_like(diff)
+    offsets[diff > 0] = diff[diff > 0] / next_interval[diff > 0]
+    offsets[diff < 0] = diff[diff < 0] / previous_interval[diff < 0]
+    offsets = np.array([round(offset, 3) for offset in offsets.tolist()])
+
+    # keep the earliest note of each (step, voice) cell
+    order = np.lexsort((-np.arange(len(onsets_sec)), onsets_sec))
+    _, first = np.unique((step * n_voices + voices)[order], return_index=True)
+    first = order[first]
+    hvo = np.zeros((int(step.max()) + 1, 3 * n_voices), dtype=np.float64)
+    hvo[step[first], voices[first]] = 1
+    hvo[step[first], voices[first] + n_voices] = velocities[first] / 127.0
+    hvo[step[first], voices[first] + 2 * n_voices] = offsets[first]
+    return hvo
+
+
+_ZIP_FILES = dict()     # one open zip handle per worker process
+
+
+def _read_midi_file(source, midi_filename):
+    if not source.endswith(".zip"):
+        with open(os.path.join(source, midi_filename), "rb") as f:
+            return f.read()
+    if source not in _ZIP_FILES:
+        _ZIP_FILES[source] = zipfile.ZipFile(source, "r")
+    zip_file = _ZIP_FILES[source]
+    root = zip_file.namelist()[0].split("/")[0]
+    return zip_file.read(f"{root}/{midi_filename}")
+
+
+def compile_midi_file(job):
+    """
+    Converts a single performance into (segmented) hvo arrays. Used as the process pool worker
+
+    The segmentation follows the groove/{n}bar-midionly tfds configs: bars are computed from the (integer) bpm
+    and the time signature in info.csv, the final bar is kept if at least half filled, a segment only contains the
+    notes that start and end within it, and the note times are re-quantized to midi ticks after shifting
+
+    :param job: (dict) {"source", "row" (info.csv row), "pitch_to_voice", "n_voices", "beat_division_factors",
+                        "segment_length_bars"}
+    :return: list of (hvo, metadata dict, qpm, numerator, denominator) -- empty list if the file is skipped
+    """
+    row = job["row"]
+    try:
+        midi = parse_midi_bytes(_read_midi_file(job["source"], row["midi_filename"]))
+    except (OSError, KeyError, ValueError, IndexError) as e:
+        logger.warning(f"Skipping {row['midi_filename']}: {e}")
+        return []
+
+    # same as extract_hvo_sequences_dict(), only performances with a single tempo and time signature are used
+    if len({qpm for _, qpm in midi["tempos"]}) != 1 or len({ts[1:] for ts in midi["time_signatures"]}) != 1:
+        return []
+    qpm = midi["tempos"][0][1]
+    _, numerator, denominator = midi["time_signatures"][0]
+
+    style_full = row["style"]
+    metadata = {
+        "drummer": row["drummer"],
+        "session": row["session"].split("/")[-1],
+        "master_id": row["id"],
+        "style_primary": style_full.split("/")[0],
+        "style_secondary": style_full.split("/")[1] if "/" in style_full else "None",
+        "bpm": row["bpm"],
+        "beat_type": row["beat_type"],
+        "time_signature": row["time_signature"],
+        "full_midi_filename": row["midi_filename"],
+        "full_audio_filename": row["audio_filename"] or "nan",      # pandas reads missing audio files as nan
+    }
+
+    onsets, ends, pitches, velocities = midi["onsets_sec"], midi["ends_sec"], midi["pitches"], midi["velocities"]
+    segment_length_bars = job["segment_length_bars"]
+    compiled = []
+
+    if segment_length_bars is None:
+        hvo = notes_to_hvo(onsets, pitches, velocities, job["pitch_to_voice"], job["n_voices"], qpm, numerator,
+                           denominator, job["beat_division_factors"])
+        if hvo.shape[0] > 0:
+            compiled.append((hvo, dict(metadata, loop_id=row["id"]), qpm, numerator, denominator))
+        return compiled
+
+    bar_duration = 60 / int(row["bpm"]) * int(row["time_signature"].split("-")[0])
+    total_bars = int(round(midi["end_time"] / bar_duration))
+
+    # tfds cuts each segment with PrettyMIDI.adjust_times() (which rescales the tempo by the ratio of the tick
+    # snapped segment boundaries to the target duration), writes it to a midi file and reads it back: the note
+    # times are quantized to ticks and the tempo is truncated to an integer number of microseconds per beat
+    ticks_per_beat = midi["ticks_per_beat"]
+    secs_per_tick = 60.0 / (qpm * ticks_per_beat)
+    segment_duration = segment_length_bars * bar_duration
+
+    for segment_ix in range(total_bars - segment_length_bars + 1):
+        start, end = segment_ix * bar_duration, (segment_ix + segment_length_bars) * bar_duration
+        in_segment = (onsets >= start) & (ends <= end)
+        if not in_segment.any():
+            continue
+        snapped_start, snapped_end = np.floor(np.array([start, end]) / secs_per_tick + 0.5) * secs_per_tick
+        segment_secs_per_tick = 60.0 / (qpm * (snapped_end - snapped_start) / segment_duration * ticks_per_beat)
+        us_per_beat = int(60000000.0 / (60.0 / (segment_secs_per_tick * ticks_per_beat)))
+        written_secs_per_tick = 60.0 / ((60000000.0 / us_per_beat) * ticks_per_beat)
+        segment_qpm = 60.0 / (written_secs_per_tick * ticks_per_beat)
+
+        scale = segment_duration / (end - start)
+        onset_ticks = np.floor((onsets[in_segment] - start) * scale / segment_secs_per_tick + 0.5)
+        end_ticks = np.floor((ends[in_segment] - start) * scale / segment_secs_per_tick + 0.5)
+        # note order in the written midi file (pretty_midi sorts the events by tick, pitch and velocity)
+        file_order = np.lexsort((velocities[in_segment], pitches[in_segment], end_ticks))
+        hvo = notes_to_hvo(onset_ticks[file_order] * written_secs_per_tick, pitches[in_segment][file_order],
+                           velocities[in_segment][file_order], job["pitch_to_voice"],
+                           job["n_voices"], segment_qpm, numerator, denominator, job["beat_division_factors"])
+        if hvo.shape[0] > 0:
+            compiled.append((hvo, dict(metadata, loop_id=f"{row['id']}:{segment_ix:03d}"),
+                             segment_qpm, numerator, denominator))
+    return compiled
+
+
+# -----------------------------------------------------------------
+# ----------------      Dataset Compilation     -------------------
+# -----------------------------------------------------------------
+def read_gmd_info_csv(info_csv_path):
+    with open(info_csv_path, "r", newline="") as f:
+        return list(csv.DictReader(f))
+
+
+def compile_local_gmd(source, info_csv_path, output_dir, drum_mapping, beat_division_factors=(4,),
+                      segment_length_bars=2, n_processes=None, chunksize=8):
+    """
+    Compiles a local copy of the groove midi dataset into a columnar cache (one {split}.npz per split)
+
+    :param source: path to the extracted dataset folder (containing drummer1/, drummer2/, ...) or to the
+                    groove-v1.0.0-midionly.zip file
+    :param info_csv_path: path to info.csv
+    :param output_dir: where to store the {split}.npz files
+    :param drum_mapping: [dict] (e.g. get_drum_mapping_using_label("ROLAND_REDUCED_MAPPING"))
+    :param beat_division_factors: list of ints (e.g. [4] for 16th note resolution)
+    :param segment_length_bars: length of the segments in bars (2 --> same as groove/2bar-midionly),
+                                None to keep the full performances
+    :param n_processes: number of worker processes (default: os.cpu_count())
+    :param chunksize: number of files sent to a worker at once
+    :return: [dict] {split: path to the npz file}
+    """
+    rows = read_gmd_info_csv(info_csv_path)
+    pitch_to_voice = get_pitch_to_voice_lookup(drum_mapping)
+    jobs = [{"source": source, "row": row, "pitch_to_voice": pitch_to_voice, "n_voices": len(drum_mapping),
+             "beat_division_factors": list(beat_division_factors), "segment_length_bars": segment_length_bars}
+            for row in rows]
+
+    per_split = dict()
+    with Pool(processes=n_processes) as pool:
+        for row, compiled in zip(rows, pool.imap(compile_midi_file, jobs, chunksize=chunksize)):
+            per_split.setdefault(row["split"], []).extend(compiled)
+
+    os.makedirs(output_dir, exist_ok=True)
+    paths = dict()
+    for split, samples in per_split.items():
+        samples = sorted(samples, key=lambda x: x[1]["loop_id"])
+        n_steps = np.array([hvo.shape[0] for hvo, _, _, _, _ in samples], dtype=np.int64)
+        columns = {field: np.array([str(metadata[field]) for _, metadata, _, _, _ in samples])
+                   for field in METADATA_FIELDS}
+        paths[split] = os.path.join(output_dir, f"{split}.npz")
+        np.savez_compressed(
+            paths[split], hvo=np.concatenate([hvo for hvo, _, _, _, _ in samples] or
+                                              [np.zeros((0, 3 * len(drum_mapping)), dtype=np.float64)]),
+            step_offsets=np.concatenate([[0], np.cumsum(n_steps)]),
+            qpm=np.array([s[2] for s in samples]),
+            time_signature_numerator=np.array([s[3] for s in samples], dtype=np.int64),
+            time_signature_denominator=np.array([s[4] for s in samples], dtype=np.int64),
+            beat_division_factors=np.array(beat_division_factors, dtype=np.int64),
+            drum_mapping=np.array(json.dumps(drum_mapping)),
+            **columns)
+        logger.info(f"Compiled {len(samples)} {split} samples into {paths[split]}")
+
+    return paths
+
+
+def get_compiled_data_directory(raw_data_pickle_path, beat_division_factor, drum_mapping_label):
+    """
+    Location of the compiled version of a raw gmd pickle, i.e. for
+    data/gmd/resources/storedDicts/groove_2bar-midionly.bz2pickle -->
+        data/gmd/resources/compiled/groove_2bar-midionly/beat_division_factor_[4]/drum_mapping_label_ROLAND_REDUCED_MAPPING
+    """
+    resources_dir = os.path.dirname(os.path.dirname(raw_data_pickle_path))
+    set_name = os.path.basename(raw_data_pickle_path).replace(".bz2pickle", "")
+    return os.path.join(resources_dir, "compiled", set_name, f"beat_division_factor_{list(beat_division_factor)}",
+                        f"drum_mapping_label_{drum_mapping_label}")
+
+
+def load_compiled_split(npz_path):
+    """ loads a compiled {split}.npz file as a dict of columns """
+    with np.load(npz_path) as data:
+        return {key_: data[key_] for key_ in data.files}
+
+
+def compiled_split_to_hvo_sequences(columns, dataset_label="Groove MIDI Dataset"):
+    """
+    Converts the columns of a compiled split into a list of HVO_Sequence objects
+    (same metadata as extract_hvo_sequences_dict() so that the rest of the pipeline can be used as is)
+    """
+    from hvo_sequence.hvo_seq import HVO_Sequence
+
+    drum_mapping = json.loads(str(columns["drum_mapping"]))
+    beat_division_factors = [int(x) for x in columns["beat_division_factors"]]
+    hvo_sequences = []
+    offsets = columns["step_offsets"]
+    for ix in range(len(offsets) - 1):
+        hvo_seq = HVO_Sequence(beat_division_factors=beat_division_factors, drum_mapping=drum_mapping)
+        hvo_seq.add_time_signature(0, int(columns["time_signature_numerator"][ix]),
+                                   int(columns["time_signature_denominator"][ix]))
+        hvo_seq.add_tempo(0, float(columns["qpm"][ix]))
+        # (caches compiled before the hvo was stored as float64 hold float32 values)
+        hvo_seq.hvo = columns["hvo"][offsets[ix]:offsets[ix + 1]].astype(np.float64)
+        hvo_seq.metadata.update({"Source": dataset_label})
+        hvo_seq.metadata.update({field: str(columns[field][ix]) for field in METADATA_FIELDS})
+        hvo_sequences.append(hvo_seq)
+    return hvo_sequences
+
+
+def pickle_compiled_dataset(compiled_dir, dataset_tag, dataset_setting_json_path):
+    """
+    Writes the filtered train/test/validation caches (same as pickle_hvo_dict()) from a compiled dataset, so that
+    load_gmd_hvo_sequences() / MonotonicGrooveDataset can be used without the tfds pickles
+
+    :param compiled_dir: output_dir of compile_local_gmd()
+    :param dataset_tag: [str] (use "gmd" for groove midi dataset)
+    :param dataset_setting_json_path: [file.json path] (path to data/dataset_json_settings/4_4_Beats_gmd.json)
+    """
+    from data.src.utils import pickle_hvo_dict
+
+    hvo_dict = dict()
+    for split in ["train", "test", "validation"]:
+        npz_path = os.path.join(compiled_dir, f"{split}.npz")
+        if os.path.exists(npz_path):
+            hvo_dict[split] = compiled_split_to_hvo_sequences(load_compiled_split(npz_path))
+
+    pickle_hvo_dict(hvo_dict, dataset_tag, dataset_setting_json_path)
@@ -1,5 +1,6 @@
 from data.src.utils import get_data_directory_using_filters, get_drum_mapping_using_label, load_original_gmd_dataset_pickle, extract_hvo_sequences_dict, pickle_hvo_dict
 from data.control.control_utils import calculate_density
+from data.gmd.src.local_compiler import get_compiled_data_directory, pickle_compiled_dataset
 import numpy as np
 import torch
 from tqdm import tqdm
@@ -9,6 +10,9 @@ import json
 import os
 import pickle
 import bz2
+import shutil
+import tempfile
+import weakref
 import logging
 logging.basicConfig(level=logging.DEBUG)
 dataLoaderLogger = logging.getLogger("data.Base.dataLoaders")
@@ -34,24 +38,32 @@ def load_gmd_hvo_sequences(dataset_setting_json_path, subset_tag, force_regenera
         dataLoaderLogger.info(f"Loading {dataset_tag} dataset")
         raw_data_pickle_path = dataset_setting_json["raw_data_pickle_path"][dataset_tag]
 
-        for path_prepend in ["./", "../", "../../"]:
-            if os.path.exists(path_prepend + raw_data_pickle_path):
-                raw_data_pickle_path = path_prepend + raw_data_pickle_path
-                break
-        assert os.path.exists(raw_data_pickle_path), "path to gmd dict pickle is incorrect --- " \
-                                                "look into data/gmd/resources/storedDicts/groove-*.bz2pickle"
         dir__ = get_data_directory_using_filters(dataset_tag, dataset_setting_json_path)
         beat_division_factor = dataset_setting_json["global"]["beat_division_factor"]
         drum_mapping_label = dataset_setting_json["global"]["drum_mapping_label"]
+        compiled_data_dir = get_compiled_data_directory(raw_data_pickle_path, beat_division_factor, drum_mapping_label)
+
+        for path_prepend in ["./", "../", "../../"]:
+            if os.path.exists(path_prepend + raw_data_pickle_path) or os.path.exists(path_prepend + compiled_data_dir):
+                raw_data_pickle_path = path_prepend + raw_data_pickle_path
+                compiled_data_dir = path_prepend + compiled_data_dir
+                break
 
         if (not os.path.exists(dir__)) or force_regenerate is True:
             dataLoaderLogger.info(f"No Cached Version Available Here: {dir__}. ")
-            dataLoaderLogger.info(
-                f"extracting data from raw pickled midi/note_sequence/metadata dictionaries at {raw_data_pickle_path}")
-            gmd_dict = load_original_gmd_dataset_pickle(raw_data_pickle_path)
-            drum_mapping = get_drum_mapping_using_label(drum_mapping_label)
-            hvo_dict = extract_hvo_sequences_dict(gmd_dict, beat_division_factor, drum_mapping)
-            pickle_hvo_dict(hvo_dict, dataset_tag, dataset_setting_json_path)
+            if os.path.exists(raw_data_pickle_path):
+                dataLoaderLogger.info(
+                    f"extracting data from raw pickled midi/note_sequence/metadata dictionaries at {raw_data_pickle_path}")
+                gmd_dict = load_original_gmd_dataset_pickle(raw_data_pickle_path)
+                drum_mapping = get_drum_mapping_using_label(drum_mapping_label)
+                hvo_dict = extract_hvo_sequences_dict(gmd_dict, beat_division_factor, drum_mapping)
+                pickle_hvo_dict(hvo_dict, dataset_tag, dataset_setting_json_path)
+            else:
+                assert os.path.exists(compiled_data_dir), \
+                    f"path to gmd dict pickle is incorrect and no compiled version found at {compiled_data_dir} --- " \
+                    f"look into data/gmd/resources/storedDicts/groove-*.bz2pickle or run data/gmd/compile.py"
+                dataLoaderLogger.info(f"extracting data from compiled hvo arrays at {compiled_data_dir}")
+                pickle_compiled_dataset(compiled_data_dir, dataset_tag, dataset_setting_json_path)
             dataLoaderLogger.info(f"Cached Version available at {dir__}")
         else:
             dataLoaderLogger.info(f"Loading Cached Version from: {dir__}")
@@ -359,97 +371,274 @@ class MonotonicGrooveDataset(Dataset):
     def get_outputs_at(self, idx):
         return self.outputs[idx]
 
+# ---------------------------------------------------------------------------------------------- #
+# fork-safe dataset for multi-worker data loading
+# ---------------------------------------------------------------------------------------------- #
+
+
+def _remove_shared_memory_dir(directory, owner_pid):
+    # forked workers inherit the finalizer, only the process that created the files may delete them
+    if os.getpid() == owner_pid:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+class SharedMemoryGrooveDataset(Dataset):
+    def __init__(self, source_dataset, shared_memory_dir=None):
+        """
+        Fork-safe copy of a MonotonicGrooveDataset (or GrooveDataSet_Density) to be used with num_workers > 0
+
+        All the per sample arrays are written once to .npy files in shared memory (/dev/shm if available,
+        otherwise the temp directory) and re-opened as read-only memory maps. No hvo_sequences or any other per
+        sample python objects are kept, so the worker processes only share pages of the memory maps instead of
+        touching (and copying on write) millions of python objects. The dataset can also be pickled
+        (spawn start method) as only the file paths are pickled.
+
+        :param source_dataset: [MonotonicGrooveDataset or GrooveDataSet_Density] dataset to copy
+        :param shared_memory_dir: [str] where to create the memory mapped files (default /dev/shm if available)
+        """
+        self.fields = ["inputs", "outputs", "hit_balancing_weights_per_sample", "genre_balancing_weights_per_sample"]
+        if hasattr(source_dataset, "densities"):
+            self.fields.insert(2, "densities")
+
+        if shared_memory_dir is None:
+            shared_memory_dir = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+        self.directory = tempfile.mkdtemp(prefix="groove_dataset_", dir=shared_memory_dir)
+        self._finalizer = weakref.finalize(self, _remove_shared_memory_dir, self.directory, os.getpid())
+
+        self.paths = dict()
+        for field in self.fields:
+            values = getattr(source_dataset, field)
+            values = values.detach().cpu().numpy() if isinstance(values, torch.Tensor) else np.asarray(values)
+            path = os.path.join(self.directory, f"{field}.npy")
+            memmap = np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=values.shape)
+            memmap[:] = values
+            memmap.flush()
+            del memmap
+            self.paths[field] = path
+
+        self._open_memmaps()
+        dataLoaderLogger.info(f"Shared {len(self)} sequences via memory mapped files in {self.directory}")
+
+    def _open_memmaps(self):
+        self.arrays = {field: np.load(path, mmap_mode="r") for field, path in self.paths.items()}
+        self.length = len(self.arrays["inputs"])
+
+    def __getstate__(self):
+        return {"fields": self.fields, "directory": self.directory, "paths": self.paths}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open_memmaps()
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, idx):
+        return tuple(torch.from_numpy(np.array(self.arrays[field][idx])) for field in self.fields) + (idx,)
+
+    def get_inputs_at(self, idx):
+        return torch.from_numpy(np.array(self.arrays["inputs"][idx]))
+
+    def get_outputs_at(self, idx):
+        return torch.from_numpy(np.array(self.arrays["outputs"][idx]))
+
+    def close(self):
+        """ removes the memory mapped files (also done automatically when the dataset is garbage collected) """
+        self.arrays = dict()
+        if hasattr(self, "_finalizer"):
+            self._finalizer()
+
+# ---------------------------------------------------------------------------------------------- #
+# batch iterator for datasets held in (device) tensors
+# ---------------------------------------------------------------------------------------------- #
+
+
+class TensorBatchIterator:
+    def __init__(self, dataset, batch_size, shuffle=True, drop_last=False, seed=None):
+        """
+        Drop-in replacement of DataLoader(dataset, batch_size, shuffle) for datasets whose per sample data already
+        sits in tensors (load_as_tensor=True and/or move_all_to_gpu=True)
+
+        Instead of indexing the samples one by one through __getitem__ and collating them, a permutation is drawn
+        once per epoch and each batch is sliced out of the resident tensors with index_select (on the device the
+        tensors are on, cpu or cuda). The batches have the same layout as the DataLoader batches:
+            (inputs, outputs, [densities,] hit_balancing_weights, genre_balancing_weights, indices)
+        (the indices are a cpu int64 tensor)
+
+        :param dataset: [MonotonicGrooveDataset or GrooveDataSet_Density] dataset with the data held in tensors
+        :param batch_size: [int] number of samples per batch
+        :param shuffle: [bool] draws a new permutation of the samples every epoch
+        :param drop_last: [bool] drops the last batch if it is smaller than batch_size
+        :param seed: [int] seed of the permutation generator
+        """
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+        self.fields = ["inputs", "outputs", "hit_balancing_weights_per_sample", "genre_balancing_weights_per_sample"]
+        if hasattr(dataset, "densities"):
+            self.fields.insert(2, "densities")
+        self.tensors = []
+        for field in self.fields:
+            values = getattr(dataset, field)
+            if not isinstance(values, torch.Tensor):
+                values = torch.tensor(np.asarray(values), dtype=torch.float32)
+            self.tensors.append(values)
+        self.length = len(self.tensors[0])
+        assert all(len(tensor) == self.length for tensor in self.tensors), \
+            "All the fields of the dataset must have the same number of samples"
+
+        # (without a seed, the seed is drawn from the global torch generator, so torch.manual_seed still applies)
+        self.generator = torch.Generator()
+        self.generator.manual_seed(seed if seed is not None else int(torch.randint(2 ** 62, (1,)).item()))
+
+    def __len__(self):
+        if self.drop_last:
+            return self.length // self.batch_size
+        return ceil(self.length / self.batch_size)
+
+    def __iter__(self):
+        if self.shuffle:
+            permutation = torch.randperm(self.length, generator=self.generator)
+        else:
+            permutation = torch.arange(self.length)
+        # one copy of the permutation per device the tensors are on (usually one)
+        permutations = {tensor.device: permutation.to(tensor.device) for tensor in self.tensors}
+
+        n_samples = len(self) * self.batch_size if self.drop_last else self.length
+        for start in range(0, n_samples, self.batch_size):
+            end = min(start + self.batch_size, n_samples)
+            yield tuple(tensor.index_select(0, permutations[tensor.device][start:end]) for tensor in self.tensors) \
+                + (permutation[start:end],)
+
+    def state_dict(self):
+        """ state of the permutation generator (to resume with the same order of batches) """
+        return {"generator": self.generator.get_state()}
+
+    def load_state_dict(self, state):
+        self.generator.set_state(state["generator"])
+
+
 # ---------------------------------------------------------------------------------------------- #
 # loading a down sampled dataset
 # ---------------------------------------------------------------------------------------------- #
 
 
+def get_down_sampling_columns(hvo_seq_list):
+    """
+    Extracts the per-sample columns needed for down sampling a dataset
+
+    :param hvo_seq_list: [list] list of HVO_Sequence objects
+    :return: [dict] {"performer": (N,) str array, "master_id": (N,) str array,
+                    "weighted_hits": (N,) float array --> total number of hits / number of active voices}
+    """
+    performer = np.array([hs.metadata["drummer"] for hs in hvo_seq_list])
+    master_id = np.array([hs.metadata["master_id"] for hs in hvo_seq_list])
+    hits = [hs.hvo[:, :hs.hvo.shape[-1] // 3] for hs in hvo_seq_list]
+    total_hits = np.array([h.sum() for h in hits], dtype=np.float64)
+    active_voices = np.array([np.count_nonzero(h.any(axis=0)) for h in hits], dtype=np.float64)
+    weighted_hits = np.divide(total_hits, active_voices, out=np.zeros_like(total_hits), where=active_voices > 0)
+
+    return {"performer": performer, "master_id": master_id, "weighted_hits": weighted_hits}
+
+
+def _group_ids_in_order_of_appearance(keys):
+    """ returns (group id per sample, number of samples per group, first index of each group) where
+    group ids are assigned in order of first appearance """
+    _, first_index, inverse, counts = np.unique(keys, return_index=True, return_inverse=True, return_counts=True)
+    order = np.argsort(first_index, kind="stable")
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    return rank[inverse.reshape(-1)], counts[order], first_index[order]
+
+
+def get_down_sampled_indices(columns, down_sample_ratio):
+    """
+    Down sample the dataset by a given ratio, the ratio of the performers and the ratio of the performances
+    are kept the same as much as possible. The selection is deterministic.
+
+    Within each performance, the samples are ranked by total number of hits / total number of voices active
+    then N equally spaced samples are selected from the ranked list
+
+    :param columns: [dict] output of get_down_sampling_columns()
+    :param down_sample_ratio: [float] the ratio of the dataset to keep
+    :return: (M,) int64 array of indices into the original list (grouped by performer, then by performance)
+    """
+    n_samples = len(columns["weighted_hits"])
+    if n_samples == 0:
+        return np.array([], dtype=np.int64)
+    down_sampled_size = ceil(n_samples * down_sample_ratio)
+
+    # group samples by performer and by performance (performance ids are only unique within a performer)
+    performer_ids, samples_per_performer, _ = _group_ids_in_order_of_appearance(columns["performer"])
+    performance_keys = np.char.add(np.char.add(columns["performer"].astype(str), "/"),
+                                   columns["master_id"].astype(str))
+    performance_ids, samples_per_performance, performance_first_index = \
+        _group_ids_in_order_of_appearance(performance_keys)
+    performer_of_performance = performer_ids[performance_first_index]
+
+    # number of samples to grab from each performer, then from each performance of the performer
+    # (np.ceil of the float ratios keeps the exact same allocation as the original nested-dict version)
+    needed_per_performer = np.ceil(down_sampled_size * (samples_per_performer / n_samples))
+    needed_per_performance = np.ceil(needed_per_performer[performer_of_performance] * samples_per_performance /
+                                     samples_per_performer[performer_of_performance]).astype(np.int64)
+
+    # rank the samples of each performance by weighted hits (descending, ties keep the original order)
+    # groups are laid out by performer then by performance, both in order of first appearance
+    order = np.lexsort((np.arange(n_samples), -columns["weighted_hits"], performance_ids, performer_ids))
+    group_order = np.lexsort((np.arange(len(samples_per_performance)), performer_of_performance))
+    group_start = np.empty_like(samples_per_performance)
+    group_start[group_order] = np.cumsum(samples_per_performance[group_order]) - samples_per_performance[group_order]
+
+    # select N equally spaced samples from each ranked performance (same as np.linspace(0, n - 1, N, dtype=int))
+    slot_group = np.repeat(group_order, needed_per_performance[group_order])
+    slot_start = np.cumsum(needed_per_performance[group_order]) - needed_per_performance[group_order]
+    slot_ix = np.arange(len(slot_group)) - np.repeat(slot_start, needed_per_performance[group_order])
+    n_ = samples_per_performance[slot_group]
+    k_ = needed_per_performance[slot_group]
+    step = np.divide(n_ - 1, k_ - 1, out=np.zeros(len(slot_group)), where=k_ > 1)
+    positions = (slot_ix * step).astype(np.int64)
+    is_last = (slot_ix == k_ - 1) & (k_ > 1)
+    positions[is_last] = n_[is_last] - 1
+
+    return order[group_start[slot_group] + positions].astype(np.int64)
+
+
 def down_sample_dataset(hvo_seq_list, down_sample_ratio):
     """
     Down sample the dataset by a given ratio, the ratio of the performers and the ratio of the performances
     are kept the same as much as possible.
-    :param hvo_seq_list:
-    :param down_sample_ratio:
-    :return:
+    :param hvo_seq_list: [list] list of HVO_Sequence objects
+    :param down_sample_ratio: [float] the ratio of the dataset to keep
+    :return: [list] list of the selected HVO_Sequence objects
     """
-    down_sampled_size = ceil(len(hvo_seq_list) * down_sample_ratio)
-
-    # =================================================================================================
-    # Divide up the performances by performer
-    # =================================================================================================
-    per_performer_per_performance_data = dict()
-    for hs in tqdm(hvo_seq_list):
-        performer = hs.metadata["drummer"]
-        performance_id = hs.metadata["master_id"]
-        if performer not in per_performer_per_performance_data:
-            per_performer_per_performance_data[performer] = {}
-        if performance_id not in per_performer_per_performance_data[performer]:
-            per_performer_per_performance_data[performer][performance_id] = []
-        per_performer_per_performance_data[performer][performance_id].append(hs)
-
-    # =================================================================================================
-    # Figure out how many loops to grab from each performer
-    # =================================================================================================
-    def flatten(l):
-        if isinstance(l[0], list):
-            return [item for sublist in l for item in sublist]
-        else:
-            return l
-
-    ratios_to_other_performers = dict()
-
-    # All samples per performer
-    existing_sample_ratios_by_performer = dict()
-    for performer, performances in per_performer_per_performance_data.items():
-        existing_sample_ratios_by_performer[performer] = \
-            len(flatten([performances[p] for p in performances])) / len(hvo_seq_list)
-
-    new_samples_per_performer = dict()
-    for performer, ratio in existing_sample_ratios_by_performer.items():
-        samples = ceil(down_sampled_size * ratio)
-        if samples > 0:
-            new_samples_per_performer[performer] = samples
-
-    # =================================================================================================
-    # Figure out for each performer, how many samples to grab from each performance
-    # =================================================================================================
-    num_loops_from_each_performance_compiled_for_all_performers = dict()
-    for performer, performances in per_performer_per_performance_data.items():
-        total_samples = len(flatten([performances[p] for p in performances]))
-        if performer in new_samples_per_performer:
-            needed_samples = new_samples_per_performer[performer]
-            num_loops_from_each_performance = dict()
-            for performance_id, hs_list in performances.items():
-                samples_to_select = ceil(needed_samples * len(hs_list) / total_samples)
-                if samples_to_select > 0:
-                    num_loops_from_each_performance[performance_id] = samples_to_select
-            if num_loops_from_each_performance:
-                num_loops_from_each_performance_compiled_for_all_performers[performer] = \
-                    num_loops_from_each_performance
-
-    # =================================================================================================
-    # Sample required number of loops from each performance
-    # THE SELECTION IS DONE BY RANKING THE TOTAL NUMBER OF HITS / TOTAL NUMBER OF VOICES ACTIVE
-    # then selecting N equally spaced samples from the ranked list
-    # =================================================================================================
-    for performer, performances in per_performer_per_performance_data.items():
-        for performance, hvo_seqs in performances.items():
-            seqs_sorted = sorted(
-                hvo_seqs,
-                key=lambda x: x.hits.sum() / x.get_number_of_active_voices(), reverse=True)
-            indices = np.linspace(
-                0,
-                len(seqs_sorted) - 1,
-                num_loops_from_each_performance_compiled_for_all_performers[performer][performance],
-                dtype=int)
-            per_performer_per_performance_data[performer][performance] = [seqs_sorted[i] for i in indices]
-
-    downsampled_hvo_sequences = []
-    for performer, performances in per_performer_per_performance_data.items():
-        for performance, hvo_seqs in performances.items():
-            downsampled_hvo_sequences.extend(hvo_seqs)
-
-    return downsampled_hvo_sequences
+    indices = get_down_sampled_indices(get_down_sampling_columns(hvo_seq_list), down_sample_ratio)
+    return [hvo_seq_list[ix] for ix in indices]
+
+
+def get_cached_down_sampling_columns(dataset_setting_json_path, subset_tag, hvo_seq_set, dataset_tag="gmd"):
+    """
+    Returns the down sampling columns of a full subset (see get_down_sampling_columns). The columns are cached
+    next to the full set ({subset_tag}_down_sampling_columns.npz) so that any ratio can be derived without
+    touching the hvo_sequences again.
+
+    :param dataset_setting_json_path: path to the json file containing the dataset settings
+    :param subset_tag: [str] train/test/validation
+    :param hvo_seq_set: [list] the full (not down sampled) subset
+    :param dataset_tag: [str] (use "gmd" for groove midi dataset)
+    :return: [dict] see get_down_sampling_columns
+    """
+    columns_path = os.path.join(get_data_directory_using_filters(dataset_tag, dataset_setting_json_path),
+                                f"{subset_tag}_down_sampling_columns.npz")
+    if os.path.exists(columns_path):
+        cached = np.load(columns_path)
+        if len(cached["weighted_hits"]) == len(hvo_seq_set):
+            return {key_: cached[key_] for key_ in cached.files}
+
+    columns = get_down_sampling_columns(hvo_seq_set)
+    np.savez_compressed(columns_path, **columns)
+    return columns
 
 
 def load_down_sampled_gmd_hvo_sequences(
@@ -457,49 +646,47 @@ def load_down_sampled_gmd_hvo_sequences(
     """
     Loads the hvo_sequences using the settings provided in the json file.
 
+    Only the indices of the selected samples are cached (in {subset_tag}_indices.npz), the samples themselves are
+    always taken from the cached full set, so any ratio can be derived from the full set without duplicating it.
+
     :param dataset_setting_json_path: path to the json file containing the dataset settings (see data/dataset_json_settings/4_4_Beats_gmd.json)
     :param subset_tag: [str] whether to load the train/test/validation set
     :param down_sampled_ratio: [float] the ratio of the dataset to downsample to
-    :param cache_downsampled_set: [bool] whether to cache the down sampled dataset
-    :param force_regenerate: [bool] if True, will regenerate the hvo_sequences from the raw data regardless of cache
+    :param cache_down_sampled_set: [bool] whether to cache the indices of the down sampled dataset
+    :param force_regenerate: [bool] if True, will re-select the down sampled indices regardless of cache
     :return:
     """
     dataset_tag = "gmd"
     dir__ = get_data_directory_using_filters(dataset_tag,
                                              dataset_setting_json_path,
                                              down_sampled_ratio=down_sampled_ratio)
-    if (not os.path.exists(dir__)) or force_regenerate is True or cache_down_sampled_set is False:
-        dataLoaderLogger.info(f"No Cached Version Available Here: {dir__}. ")
-        dataLoaderLogger.info(f"Downsampling the dataset to {down_sampled_ratio} and saving to {dir__}.")
-
-        down_sampled_dict = {}
-        for subset_tag in ["train", "validation", "test"]:
-            hvo_seq_set = load_gmd_hvo_sequences(
-                dataset_setting_json_path=dataset_setting_json_path,
-                subset_tag=subset_tag,
-                force_regenerate=False)
-            down_sampled_dict.update({subset_tag: down_sample_dataset(hvo_seq_set, down_sampled_ratio)})
+    indices_path = os.path.join(dir__, f"{subset_tag}_indices.npz")
+
+    hvo_seq_set = load_gmd_hvo_sequences(
+        dataset_setting_json_path=dataset_setting_json_path,
+        subset_tag=subset_tag,
+        force_regenerate=False)
+
+    indices = None
+    if os.path.exists(indices_path) and force_regenerate is False and cache_down_sampled_set is True:
+        cached = np.load(indices_path)
+        if int(cached["full_set_size"]) == len(hvo_seq_set):
+            dataLoaderLogger.info(f"Loading Cached Version from: {indices_path}")
+            indices = cached["indices"]
+        else:
+            dataLoaderLogger.info(f"Cached indices at {indices_path} don't match the full set. Regenerating")
 
-        # collect and dump samples that match filter
+    if indices is None:
+        dataLoaderLogger.info(f"Downsampling the {subset_tag} set to {down_sampled_ratio}")
+        columns = get_cached_down_sampling_columns(dataset_setting_json_path, subset_tag, hvo_seq_set)
+        indices = get_down_sampled_indices(columns, down_sampled_ratio)
         if cache_down_sampled_set:
-            # create directories if needed
-            if not os.path.exists(dir__):
-                os.makedirs(dir__)
-            for set_key_, set_data_ in down_sampled_dict.items():
-                ofile = bz2.BZ2File(os.path.join(dir__, f"{set_key_}.bz2pickle"), 'wb')
-                pickle.dump(set_data_, ofile)
-                ofile.close()
-
-        dataLoaderLogger.info(f"Loaded {len(down_sampled_dict[subset_tag])} {subset_tag} samples from {dir__}")
-        return down_sampled_dict[subset_tag]
-    else:
-        dataLoaderLogger.info(f"Loading Cached Version from: {dir__}")
-        ifile = bz2.BZ2File(os.path.join(dir__, f"{subset_tag}.bz2pickle"), 'rb')
-        set_data_ = pickle.load(ifile)
-        ifile.close()
-        dataLoaderLogger.info(f"Loaded {len(set_data_)} {subset_tag} samples from {dir__}")
-        return set_data_
+            os.makedirs(dir__, exist_ok=True)
+            np.savez(indices_path, indices=indices, full_set_size=len(hvo_seq_set))
 
+    set_data_ = [hvo_seq_set[ix] for ix in indices]
+    dataLoaderLogger.info(f"Loaded {len(set_data_)} {subset_tag} samples from {dir__}")
+    return set_data_
 
 
 if __name__ == "__main__":
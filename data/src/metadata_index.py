@@ -0,0 +1,123 @@
+import numpy as np
+
+import logging
+logger = logging.getLogger("data.Base.metadata_index")
+logger.setLevel(logging.DEBUG)
+
+# keys that are indexed as soon as the index is built (any other key is indexed lazily on first query)
+DEFAULT_INDEXED_KEYS = ("style_primary", "drummer", "master_id", "beat_type", "time_signature")
+
+
+def as_list_of_values(values):
+    """ filter values are expected to be lists (i.e. {"style_primary": ["rock", "funk"]}), a single
+    value (i.e. {"style_primary": "rock"}) is treated as a one-element list rather than a substring container
+    """
+    if isinstance(values, (list, tuple, set, np.ndarray)):
+        return list(values)
+    return [values]
+
+
+def is_empty_filter(filter_dict):
+    """ returns True if the filter doesn't restrict anything (None or a dict with all values set to None)"""
+    return filter_dict is None or all(value is None for value in filter_dict.values())
+
+
+class MetadataIndex(object):
+    def __init__(self, hvo_sequences_or_metadata, indexed_keys=DEFAULT_INDEXED_KEYS):
+        """
+        Inverted index over the metadata of a list of hvo_sequences. The index is built once per dataset
+        and maps every (metadata key, value) pair to a sorted array of sample indices, so that filters
+        are resolved with set operations on small integer arrays instead of a python loop over all samples.
+
+        Query semantics (same as the filter dicts in data/dataset_json_settings):
+            - values of the same key are OR-ed (IN):     {"style_primary": ["rock", "funk"]}
+            - different keys are AND-ed:                  {"style_primary": ["rock"], "beat_type": ["beat"]}
+            - None values are ignored:                    {"drummer": None}
+            - a list of filter dicts is OR-ed (see select_any)
+
+        :param hvo_sequences_or_metadata: list of HVO_Sequence objects (or list of metadata dicts)
+        :param indexed_keys: keys to index right away, other keys are indexed on their first query
+        """
+        self._metadata = [sample.metadata if hasattr(sample, "metadata") else sample
+                          for sample in hvo_sequences_or_metadata]
+        self._n_samples = len(self._metadata)
+        self._index = dict()
+
+        for key_ in indexed_keys:
+            self._build_key(key_)
+
+    def __len__(self):
+        return self._n_samples
+
+    def _build_key(self, key_):
+        if key_ in self._index:
+            return self._index[key_]
+
+        postings = dict()
+        for ix, metadata in enumerate(self._metadata):
+            if key_ in metadata:
+                postings.setdefault(metadata[key_], []).append(ix)
+
+        self._index[key_] = {val_: np.array(ixs, dtype=np.int64) for val_, ixs in postings.items()}
+        return self._index[key_]
+
+    @property
+    def indexed_keys(self):
+        return list(self._index.keys())
+
+    def values(self, key_):
+        """ returns the unique values available for a metadata key (in order of first appearance) """
+        return list(self._build_key(key_).keys())
+
+    def counts(self, key_):
+        """ returns a {value: number of samples} dictionary for a metadata key """
+        return {val_: len(ixs) for val_, ixs in self._build_key(key_).items()}
+
+    def all_indices(self):
+        return np.arange(self._n_samples, dtype=np.int64)
+
+    def select_in(self, key_, values):
+        """ returns the sorted indices of samples for which metadata[key_] is any of the values (IN / OR) """
+        postings = self._build_key(key_)
+        matches = [postings[val_] for val_ in as_list_of_values(values) if val_ in postings]
+        if not matches:
+            return np.array([], dtype=np.int64)
+        if len(matches) == 1:
+            return matches[0].copy()
+        return np.unique(np.concatenate(matches))
+
+    def select(self, filter_dict):
+        """ returns the sorted indices of samples passing ALL conditions of the filter dict (AND across keys)
+
+        :param filter_dict: [dict] (e.g. {"style_primary": ["rock"], "beat_type": ["beat"], "drummer": None})
+        :return: np.ndarray of int64 sample indices
+        """
+        if is_empty_filter(filter_dict):
+            return self.all_indices()
+
+        selected = None
+        for key_, values in filter_dict.items():
+            if values is None:
+                continue
+            indices = self.select_in(key_, values)
+            selected = indices if selected is None else np.intersect1d(selected, indices, assume_unique=True)
+            if selected.size == 0:
+                break
+
+        return selected
+
+    def select_any(self, list_of_filter_dicts):
+        """ returns the sorted indices of samples passing AT LEAST ONE of the filter dicts (OR across filters)"""
+        if not list_of_filter_dicts:
+            return self.all_indices()
+        return np.unique(np.concatenate([self.select(filter_dict) for filter_dict in list_of_filter_dicts]))
+
+    def mask(self, filter_dict):
+        """ boolean mask version of select() """
+        mask_ = np.zeros(self._n_samples, dtype=bool)
+        mask_[self.select(filter_dict)] = True
+        return mask_
+
+    def take(self, items, filter_dict):
+        """ returns the elements of items (list aligned with the indexed samples) that pass the filter dict"""
+        return [items[ix] for ix in self.select(filter_dict)]
@@ -9,6 +9,7 @@ from bokeh.plotting import gridplot
 from bokeh.models import Tabs, Panel
 from hvo_sequence.io_helpers import note_sequence_to_hvo_sequence
 from hvo_sequence.drum_mappings import get_drum_mapping_using_label
+from data.src.metadata_index import MetadataIndex, as_list_of_values
 
 from math import pi
 
@@ -33,13 +34,19 @@ except ImportError:
 from bokeh.io import save
 
 
-def does_pass_filter(hvo_sample, filter_dict):   # FIXME THERE IS AN ISSUE HERE
-    passed_conditions = [True]  # initialized with true in case no filters are required
+def does_pass_filter(hvo_sample, filter_dict):
+    """ checks a single sample against a filter dict. To filter a whole set, use MetadataIndex instead
+    (a single value is treated as a one-element list, i.e. "rock" doesn't match substrings of it)
+
+    **A sample without one of the filtered metadata keys doesn't pass the filter (same as MetadataIndex), it used to
+    raise a KeyError**
+    """
     for fkey_, fval_ in filter_dict.items():
         if fval_ is not None:
-            passed_conditions.append(True if hvo_sample.metadata[fkey_] in fval_ else False)
+            if hvo_sample.metadata.get(fkey_) not in as_list_of_values(fval_):
+                return False
 
-    return all(passed_conditions)
+    return True
 
 
 def get_data_directory_using_filters(dataset_tag, dataset_setting_json_path, down_sampled_ratio=None):
@@ -88,11 +95,8 @@ def pickle_hvo_dict(hvo_dict, dataset_tag, dataset_setting_json_path):
     dataset = json.load(open(dataset_setting_json_path, "r"))
     filter_dict_ = dataset["settings"][dataset_tag]
     for set_key_, set_data_ in hvo_dict.items():
-        filtered_samples = []
-        num_samples = len(set_data_)
-        for sample in tqdm(set_data_, total = num_samples, desc=f"filtering HVO_Sequences in subset {set_key_}"):
-            if does_pass_filter(sample, filter_dict_):
-                filtered_samples.append(sample)
+        filtered_samples = MetadataIndex(set_data_).take(set_data_, filter_dict_)
+        logger.info(f"{len(filtered_samples)}/{len(set_data_)} HVO_Sequences in subset {set_key_} passed the filters")
 
         ofile = bz2.BZ2File(os.path.join(dir__, f"{set_key_}.bz2pickle"), 'wb')
         pickle.dump(filtered_samples, ofile)
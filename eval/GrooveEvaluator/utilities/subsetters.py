@@ -6,6 +6,8 @@ sys.path.append("..")
 import numpy as np
 
 from copy import deepcopy
+from data.src.metadata_index import MetadataIndex, is_empty_filter
+from data.src.utils import does_pass_filter
 import logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("eval/GrooveEvaluator/utilities/subsetters.py")
@@ -103,37 +105,41 @@ class HVOSetSubsetter(object):
                 hvo_subsets.append([])
                 subset_tags.append([''])
 
+            # index the metadata once and resolve every filter against the index
+            metadata_index = MetadataIndex(self.full_hvo_set_pre_filters)
+            has_required_hits = self.get_at_least_one_hit_mask()
+
             for subset_ix, filter_dict_for_subset in enumerate(self.list_of_filter_dicts_for_subsets):
                 # if current filter is None or a dict with None values
                 # add all the dataset in its entirety to current subset
-                if filter_dict_for_subset is None:
-                    hvo_subsets[subset_ix] = self.full_hvo_set_pre_filters
-                elif isinstance(filter_dict_for_subset, dict) and \
-                        all(value is None for value in filter_dict_for_subset.values()):
+                if is_empty_filter(filter_dict_for_subset):
                     hvo_subsets[subset_ix] = self.full_hvo_set_pre_filters
 
                 else:
                     # Check which samples meet all filter specifications and add them to the current subset
                     subset_tags[subset_ix] = '_AND_'.join(str(x) for x in filter_dict_for_subset.values())
-                    for hvo_sample in self.full_hvo_set_pre_filters:
-                        if self.does_pass_filter(hvo_sample, filter_dict_for_subset):
-                            if self.at_least_one_hit_in_voices is not None:
-                                # Check that there is at least one hit in the required subset of voices
-                                if 1 in hvo_sample.hvo[:, self.at_least_one_hit_in_voices]:
-                                    hvo_subsets[subset_ix].append(hvo_sample)
-                            else:
-                                hvo_subsets[subset_ix].append(hvo_sample)
-
+                    indices = metadata_index.select(filter_dict_for_subset)
+                    if has_required_hits is not None:
+                        indices = indices[has_required_hits[indices]]
+                    hvo_subsets[subset_ix] = [self.full_hvo_set_pre_filters[ix] for ix in indices]
 
         return subset_tags, hvo_subsets
 
-    def does_pass_filter(self, hvo_sample, filter_dict):   # FIXME THERE IS AN ISSUE HERE
-        passed_conditions = [True]  # initialized with true in case no filters are required
-        for fkey_, fval_ in filter_dict.items():
-            if fval_ is not None:
-                passed_conditions.append(True if hvo_sample.metadata[fkey_] in fval_ else False)
+    def get_at_least_one_hit_mask(self):
+        """
+        :return: None if at_least_one_hit_in_voices is not specified, otherwise a boolean array specifying
+                 whether each sample has at least one hit in the required voices
+        """
+        if self.at_least_one_hit_in_voices is None:
+            return None
+
+        return np.array([1 in hvo_sample.hvo[:, self.at_least_one_hit_in_voices]
+                         for hvo_sample in self.full_hvo_set_pre_filters], dtype=bool)
 
-        return all(passed_conditions)
+    def does_pass_filter(self, hvo_sample, filter_dict):
+        """ checks a single sample against a filter dict (see data.src.utils.does_pass_filter, a sample missing one
+        of the filtered metadata keys doesn't pass) """
+        return does_pass_filter(hvo_sample, filter_dict)
 
 
 class Set_Sampler(object):
@@ -14,14 +14,10 @@ def load_density_2d_model(model_path, params_dict=None, is_evaluating=True, devi
         model (GrooveTransformerEncoder): the loaded model
     """
 
-    try:
-        if device is not None:
-            loaded_dict = torch.load(model_path, map_location=device)
-        else:
-            loaded_dict = torch.load(model_path)
-    except:
-        loaded_dict = torch.load(model_path, map_location=torch.device('cpu'))
-
+    # pick the device before loading (instead of retrying on cpu, which reads the file twice)
+    if device is None and not torch.cuda.is_available():
+        device = torch.device('cpu')
+    loaded_dict = torch.load(model_path, map_location=device)
 
     if params_dict is None:
         if 'params' in loaded_dict:
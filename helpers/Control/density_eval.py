@@ -120,27 +120,27 @@ def get_piano_rolls_for_control_model_wandb(
     density_values = [0.0, 0.01, 0.5, 0.99]
     hvo_sequences = random.sample(hvo_seq_set, num_examples)
 
+    # density sweep: row 0 holds the 'real' density of each sequence, the other rows the fixed test values
+    real_densities = [normalizing_fn(calculate_density(hvo_seq.hits)) if normalizing_fn is not None
+                      else calculate_density(hvo_seq.hits) for hvo_seq in hvo_sequences]
+    densities = torch.tensor([real_densities] + [[density] * num_examples for density in density_values[1:]],
+                             dtype=torch.float32).to(device)
+    in_grooves = torch.tensor(np.array([hvo_seq.flatten_voices() for hvo_seq in hvo_sequences]),
+                              dtype=torch.float32).to(device)
+
+    # encode the whole sweep once and decode it in a single pass --> [n_densities x num_examples x T x 3V]
+    latent_handle = model.encode_to_latent_handle(in_grooves, densities)
+    outputs = model.decode_latent_handle(latent_handle)[0, 0].cpu().numpy()
+
     patterns = []
 
-    for hvo_seq in hvo_sequences:
+    for sample_ix, hvo_seq in enumerate(hvo_sequences):
         hvo_sequence_dict = {}
         hvo_sequence_dict["input"] = hvo_seq
 
-        density_values[0] = normalizing_fn(calculate_density(hvo_seq.hits)) if normalizing_fn is not None \
-                else calculate_density(hvo_seq.hits)
-        densities = torch.tensor(density_values, dtype=torch.float32).to(device)
-
-
-        # Create a batch of duplicate inputs based on number of densities we are testing
-        in_grooves = torch.tensor(np.repeat(hvo_seq.flatten_voices()[np.newaxis, :], len(density_values), axis=0),
-                                  dtype=torch.float32)
-
-        outputs, mu, log_var, latent_z = model.predict(in_grooves.to(device), densities.to(device), return_concatenated=True)
-        output_hvo_arrays = [seq.squeeze(0).cpu().numpy() for seq in torch.split(outputs, 1, dim=0)]
-
-        for density, prediction in zip(density_values, output_hvo_arrays):
+        for density_ix, density in enumerate([real_densities[sample_ix]] + density_values[1:]):
             output_hvo = copy.deepcopy(hvo_seq)
-            output_hvo.hvo = prediction
+            output_hvo.hvo = outputs[density_ix, sample_ix]
             hvo_sequence_dict[str(density)] = output_hvo
 
         patterns.append(hvo_sequence_dict)
@@ -211,18 +211,16 @@ def get_density_prediction_averages(model, test_dataset, device, batch_size=64,
 
     densities = [0.01, 0.5, 0.99]
 
-    predicted_densities = {}
-
-    for density in densities:
+    # encode all the density values at once and decode them in a single pass --> [n_densities x batch_size x T x 3V]
+    density_inputs = torch.tensor(densities, dtype=torch.float32)[:, None].repeat(1, batch_size)
+    latent_handle = model.encode_to_latent_handle(in_grooves.to(device), density_inputs.to(device))
+    predictions = model.decode_latent_handle(latent_handle)[0, 0]
 
-        density_inputs = torch.full((batch_size,), density, dtype=torch.float32)
+    predicted_densities = {}
 
-        predictions, _, _, _ = model.predict(
-            in_grooves.to(device),
-            density_inputs.to(device),
-            return_concatenated=True)
+    for density, density_predictions in zip(densities, predictions):
 
-        hits = predictions[:, :, :9]
+        hits = density_predictions[:, :, :9]
         num_hits = torch.sum(hits)
         num_potential_hits = torch.numel(hits)
         predictions_density = (num_hits / num_potential_hits).item()
@@ -236,6 +234,3 @@ def get_density_prediction_averages(model, test_dataset, device, batch_size=64,
         predicted_densities[title] = predictions_density
 
     return predicted_densities
-
-
-
@@ -0,0 +1,154 @@
+import torch
+
+from logging import getLogger
+logger = getLogger("helpers/VAE/augmentation.py")
+logger.setLevel("DEBUG")
+
+
+def tapify_hvo_batch(hvo_batch, voice_idx=2, reduce_dim=False):
+    """
+    Flattens a batch of hvo targets into tapped (monotonic) sequences on the device the batch lives on.
+    Equivalent to HVO_Sequence.flatten_voices() with the default settings, that is, the velocity at each step is the
+    maximum velocity of the step (velocity_aggregator_modes=1) and the offset is the one corresponding to the
+    loudest event at that step (offset_aggregator_modes=3)
+
+    :param hvo_batch: (torch.Tensor) (batch, time_steps, 3 * n_voices)
+    :param voice_idx: (int) the voice in which the tapped sequence is placed (ignored if reduce_dim is True)
+    :param reduce_dim: (bool) if True, returns (batch, time_steps, 3) instead of (batch, time_steps, 3 * n_voices)
+    :return: (torch.Tensor) the tapped sequences
+    """
+    n_voices = hvo_batch.shape[-1] // 3
+    h, v, o = torch.split(hvo_batch, n_voices, -1)
+    synced_v = h * v
+    synced_o = h * o
+
+    idx_max_vel = torch.argmax(synced_v, dim=-1, keepdim=True)
+    new_h = (h != 0).any(dim=-1, keepdim=True).to(hvo_batch.dtype)
+    new_v = torch.gather(synced_v, -1, idx_max_vel)
+    new_o = torch.gather(synced_o, -1, idx_max_vel)
+
+    if reduce_dim:
+        return torch.cat((new_h, new_v, new_o), dim=-1)
+
+    assert n_voices > voice_idx >= 0, "invalid voice index"
+    tapped = torch.zeros_like(hvo_batch)
+    tapped[:, :, voice_idx] = new_h[:, :, 0]
+    tapped[:, :, n_voices + voice_idx] = new_v[:, :, 0]
+    tapped[:, :, 2 * n_voices + voice_idx] = new_o[:, :, 0]
+    return tapped
+
+
+class BatchAugmenter(object):
+    def __init__(self, event_removal_prob=0.0, event_removal_threshold_range=(0.0, 0.2),
+                 velocity_scale_range=(1.0, 1.0), velocity_jitter_std=0.0, offset_jitter_std=0.0,
+                 voice_dropout_prob=0.0, tapped_voice_idx=2, collapse_tapped_sequence=False, seed=None):
+        """
+        Augments batches of hvo targets on the device they already live on (no round trip to HVO_Sequence objects),
+        then re-derives the tapped inputs from the augmented targets (see tapify_hvo_batch)
+
+        All the random numbers are drawn from a dedicated torch.Generator, so given a seed (and the same order of
+        batches) the augmentations are reproducible
+
+        :param event_removal_prob: (float) probability of removing random events from a sample
+        :param event_removal_threshold_range: (tuple) similar to HVO_Sequence.remove_random_events, a threshold is
+                    uniformly sampled from this range per sample and hits whose random value is below it are removed
+        :param velocity_scale_range: (tuple) per sample velocity scaling factor is uniformly sampled from this range
+        :param velocity_jitter_std: (float) std of the gaussian noise added to the velocity of each event
+        :param offset_jitter_std: (float) std of the gaussian noise added to the offset of each event
+                    (offsets are clamped to [-0.5, 0.5])
+        :param voice_dropout_prob: (float) probability of muting each voice of each sample
+        :param tapped_voice_idx: (int) index of the voice to be tapped (default is 2 which is usually closed hat)
+        :param collapse_tapped_sequence: (bool) returns Tx3 inputs instead of Tx(3xNumVoices) inputs
+        :param seed: (int) seed for the augmentation generator (if None, a non-deterministic seed is used)
+        """
+        self.event_removal_prob = event_removal_prob
+        self.event_removal_threshold_range = event_removal_threshold_range
+        self.velocity_scale_range = velocity_scale_range
+        self.velocity_jitter_std = velocity_jitter_std
+        self.offset_jitter_std = offset_jitter_std
+        self.voice_dropout_prob = voice_dropout_prob
+        self.tapped_voice_idx = tapped_voice_idx
+        self.collapse_tapped_sequence = collapse_tapped_sequence
+        self.seed = seed
+        self._generators = dict()
+
+    @property
+    def is_active(self):
+        return self.event_removal_prob > 0 or self.velocity_scale_range != (1.0, 1.0) or \
+               self.velocity_jitter_std > 0 or self.offset_jitter_std > 0 or self.voice_dropout_prob > 0
+
+    def get_generator(self, device):
+        """ one generator per device, all seeded from the same seed """
+        device = torch.device(device)
+        if device not in self._generators:
+            generator = torch.Generator(device=device)
+            if self.seed is not None:
+                generator.manual_seed(self.seed)
+            else:
+                generator.seed()
+            self._generators[device] = generator
+        return self._generators[device]
+
+    def state_dict(self):
+        return {str(device): generator.get_state() for device, generator in self._generators.items()}
+
+    def load_state_dict(self, state_dict):
+        for device, state in state_dict.items():
+            self.get_generator(device).set_state(state)
+
+    def _rand(self, shape, like):
+        return torch.rand(shape, generator=self.get_generator(like.device), device=like.device, dtype=like.dtype)
+
+    def _randn(self, shape, like):
+        return torch.randn(shape, generator=self.get_generator(like.device), device=like.device, dtype=like.dtype)
+
+    def augment_targets(self, outputs):
+        """
+        :param outputs: (torch.Tensor) (batch, time_steps, 3 * n_voices) hvo targets
+        :return: (torch.Tensor) augmented targets (velocities and offsets are zeroed wherever there is no hit)
+        """
+        batch_size, time_steps, n_features = outputs.shape
+        n_voices = n_features // 3
+        h, v, o = torch.split(outputs, n_voices, -1)
+        h_aug = h
+
+        if self.event_removal_prob > 0:
+            low, high = self.event_removal_threshold_range
+            thresholds = low + (high - low) * self._rand((batch_size, 1, 1), outputs)
+            apply = self._rand((batch_size, 1, 1), outputs) < self.event_removal_prob
+            removed = (self._rand(h.shape, outputs) <= thresholds) & apply
+            h_aug = h_aug.masked_fill(removed, 0)
+
+        if self.voice_dropout_prob > 0:
+            dropped = self._rand((batch_size, 1, n_voices), outputs) < self.voice_dropout_prob
+            h_aug = h_aug.masked_fill(dropped, 0)
+
+        # never return an empty pattern, fall back to the original sample instead
+        is_empty = (h_aug.sum(dim=(1, 2), keepdim=True) == 0)
+        h_aug = torch.where(is_empty, h, h_aug)
+
+        if self.velocity_scale_range != (1.0, 1.0):
+            low, high = self.velocity_scale_range
+            v = v * (low + (high - low) * self._rand((batch_size, 1, 1), outputs))
+
+        if self.velocity_jitter_std > 0:
+            v = v + self.velocity_jitter_std * self._randn(v.shape, outputs)
+
+        if self.offset_jitter_std > 0:
+            o = o + self.offset_jitter_std * self._randn(o.shape, outputs)
+
+        v = torch.clamp(v, 0.0, 1.0) * h_aug
+        o = torch.clamp(o, -0.5, 0.5) * h_aug
+
+        return torch.cat((h_aug, v, o), dim=-1)
+
+    def __call__(self, outputs):
+        """
+        :param outputs: (torch.Tensor) (batch, time_steps, 3 * n_voices) hvo targets
+        :return: (inputs, outputs) the re-tapified inputs and the augmented targets
+        """
+        with torch.no_grad():
+            augmented_outputs = self.augment_targets(outputs)
+            inputs = tapify_hvo_batch(augmented_outputs, voice_idx=self.tapped_voice_idx,
+                                      reduce_dim=self.collapse_tapped_sequence)
+        return inputs, augmented_outputs
@@ -0,0 +1,231 @@
+#  Copyright (c) 2022. \n Created by Behzad Haki. behzad.haki@upf.edu
+"""
+Resumable training state checkpoints written in the background
+
+A training state checkpoint holds everything needed to continue a run exactly where it stopped: the model and
+optimizer states, the epoch/step counters, the run config (incl. the beta annealing settings), the wandb run id and
+the states of all the random number generators (python, numpy, torch cpu/cuda) and of any other object with a
+state_dict()/load_state_dict() (e.g. the BatchAugmenter and its generators).
+
+AsyncCheckpointer.save() only copies the state to cpu (a snapshot, so the training can go on modifying the weights)
+and hands it to a background thread that writes it to disk (to a temporary file renamed once complete, so a killed
+job never leaves a truncated checkpoint) and deletes all but the last keep_last checkpoints. If the writer falls
+behind, save() waits until it has caught up (at most max_pending snapshots are queued).
+
+The checkpoints contain 'model_state_dict' and 'params' like the files of model.save(), so they can also be loaded
+with load_variational_mgt_model (or the density model loaders).
+
+Usage:
+    checkpointer = AsyncCheckpointer(checkpoint_dir, keep_last=3)
+    for epoch in range(start_epoch, n_epochs):
+        ...
+        checkpointer.save(get_training_state(model, optimizer, epoch, step_, config=dict(config)), epoch)
+    checkpointer.close()
+
+    state = load_checkpoint(checkpoint_dir)            # latest checkpoint in the folder (or a .pth path)
+    start_epoch, step_ = restore_training_state(state, model, optimizer)
+"""
+import os
+import glob
+import queue
+import random
+import threading
+
+import numpy as np
+import torch
+
+from logging import getLogger
+logger = getLogger("helpers/VAE/checkpointing.py")
+logger.setLevel("DEBUG")
+
+CHECKPOINT_PREFIX = "training_state_"
+
+
+# ---------------------------------------------------------------------------------------------------
+# ------------                 RNG STATES                        ------------------------------------
+# ---------------------------------------------------------------------------------------------------
+def get_rng_states():
+    """ States of all the global random number generators (only tensors/python primitives, so that torch.load works
+    with weights_only=True) """
+    np_state = np.random.get_state()
+    states = {
+        "python": random.getstate(),
+        "numpy": {"keys": torch.from_numpy(np_state[1].astype(np.int64)), "pos": int(np_state[2]),
+                  "has_gauss": int(np_state[3]), "cached_gaussian": float(np_state[4])},
+        "torch": torch.get_rng_state(),
+        "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else []
+    }
+    return states
+
+
+def set_rng_states(states):
+    """ Restores the states returned by get_rng_states() """
+    random.setstate((states["python"][0], tuple(states["python"][1]), states["python"][2]))
+    np.random.set_state(("MT19937", states["numpy"]["keys"].numpy().astype(np.uint32), states["numpy"]["pos"],
+                         states["numpy"]["has_gauss"], states["numpy"]["cached_gaussian"]))
+    torch.set_rng_state(states["torch"])
+    if torch.cuda.is_available() and len(states["cuda"]) > 0:
+        torch.cuda.set_rng_state_all(states["cuda"])
+
+
+# ---------------------------------------------------------------------------------------------------
+# ------------                 TRAINING STATE                    ------------------------------------
+# ---------------------------------------------------------------------------------------------------
+def snapshot(obj):
+    """ Copy of a (nested) state where all the tensors are detached and copied to cpu """
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {key: snapshot(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(value) for value in obj)
+    return obj
+
+
+def get_training_state(model, optimizer, epoch, step, config=None, wandb_run_id=None, stateful_objects=None):
+    """
+    Full training state at the end of an epoch (not copied, see AsyncCheckpointer.save)
+
+    :param model: (GrooveTransformerEncoderVAE, Density1D, ...) the (unwrapped) model
+    :param optimizer: (torch.optim.Optimizer) the optimizer
+    :param epoch: (int) the last completed epoch
+    :param step: (int) the number of training steps so far
+    :param config: (dict) the run config (hparams)
+    :param wandb_run_id: (str) id of the wandb run (to log to the same run when resuming)
+    :param stateful_objects: (dict) {name: object with state_dict()} additional states to save (e.g. the augmenter)
+    :return: (dict)
+    """
+    return {
+        "model_state_dict": model.state_dict(),
+        "params": model.get_params_dict(),
+        "optimizer_state_dict": optimizer.state_dict(),
+        "epoch": epoch,
+        "step": step,
+        "config": config,
+        "wandb_run_id": wandb_run_id,
+        "rng_states": get_rng_states(),
+        "extra_states": {name: obj.state_dict() for name, obj in (stateful_objects or dict()).items()}
+    }
+
+
+def get_checkpoint_paths(checkpoint_dir):
+    """ Training state checkpoints in a folder, oldest first """
+    return sorted(glob.glob(os.path.join(checkpoint_dir, f"{CHECKPOINT_PREFIX}*.pth")))
+
+
+def load_checkpoint(path, map_location="cpu"):
+    """
+    Loads a training state checkpoint
+
+    :param path: (str) a checkpoint (.pth) or a folder of checkpoints (the latest one is loaded)
+    :param map_location: device to load the tensors to
+    :return: (dict) the training state (see get_training_state)
+    """
+    if os.path.isdir(path):
+        paths = get_checkpoint_paths(path)
+        assert len(paths) > 0, f"No checkpoints found in {path}"
+        path = paths[-1]
+    logger.info(f"Loading the training state from {path}")
+    return torch.load(path, map_location=map_location)
+
+
+def restore_training_state(state, model, optimizer, stateful_objects=None, restore_rng_states=True):
+    """
+    Restores the model, optimizer and (optionally) the random number generators from a training state
+
+    **Call this right before the epoch loop, so that nothing consumes random numbers between the restoring and the
+    training (otherwise the run does not continue exactly as it would have)**
+
+    :param state: (dict) see load_checkpoint
+    :param model: the model (same architecture as the saved one)
+    :param optimizer: the optimizer (same type and parameters as the saved one)
+    :param stateful_objects: (dict) {name: object with load_state_dict()} additional states to restore
+    :param restore_rng_states: (bool) if False, the random number generators are not restored
+    :return: (start_epoch, step) the first epoch to run and the number of training steps so far
+    """
+    model.load_state_dict(state["model_state_dict"])
+    optimizer.load_state_dict(state["optimizer_state_dict"])
+    for name, obj in (stateful_objects or dict()).items():
+        if name in state["extra_states"]:
+            obj.load_state_dict(state["extra_states"][name])
+        else:
+            logger.warning(f"No saved state for {name}")
+    if restore_rng_states:
+        set_rng_states(state["rng_states"])
+    logger.info(f"Resuming after epoch {state['epoch']} (step {state['step']})")
+    return state["epoch"] + 1, state["step"]
+
+
+# ---------------------------------------------------------------------------------------------------
+# ------------                 BACKGROUND WRITER                 ------------------------------------
+# ---------------------------------------------------------------------------------------------------
+class AsyncCheckpointer(object):
+    def __init__(self, checkpoint_dir, keep_last=3, max_pending=1):
+        """
+        Writes the training state checkpoints from a background thread
+
+        :param checkpoint_dir: (str) folder of the checkpoints (training_state_{epoch}.pth)
+        :param keep_last: (int) number of checkpoints to keep (older ones are deleted, None to keep all)
+        :param max_pending: (int) number of snapshots that may wait for the writer, save() blocks when more are
+                            queued (bounds the cpu memory used by the snapshots if the disk is slower than training)
+        """
+        self.checkpoint_dir = checkpoint_dir
+        self.keep_last = keep_last
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._error = None
+        self._thread = threading.Thread(target=self._write_loop, name="AsyncCheckpointer", daemon=True)
+        self._thread.start()
+
+    def _write_loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            state, path = item
+            try:
+                torch.save(state, path + ".tmp")
+                os.replace(path + ".tmp", path)
+                if self.keep_last is not None:
+                    for old_path in get_checkpoint_paths(self.checkpoint_dir)[:-self.keep_last]:
+                        os.remove(old_path)
+                logger.info(f"Training state saved to {path}")
+            except Exception as e:
+                logger.exception(f"Saving {path} failed")
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _raise_if_failed(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError(f"A previous checkpoint could not be saved: {error}") from error
+
+    def save(self, state, epoch):
+        """
+        Snapshots the state (copy to cpu) and queues it for writing, returns without waiting for the write (unless
+        max_pending snapshots are already queued, in which case it waits for the writer to catch up)
+
+        :param state: (dict) see get_training_state
+        :param epoch: (int) the epoch (used in the file name)
+        :return: (str) the path the checkpoint will be written to
+        """
+        self._raise_if_failed()
+        path = os.path.join(self.checkpoint_dir, f"{CHECKPOINT_PREFIX}{epoch:04d}.pth")
+        if self._queue.full():
+            logger.warning(f"Checkpoint writer is behind, waiting before queueing {path}")
+        self._queue.put((snapshot(state), path))
+        return path
+
+    def wait(self):
+        """ Blocks until all the queued checkpoints are written """
+        self._queue.join()
+        self._raise_if_failed()
+
+    def close(self):
+        """ Writes the remaining checkpoints and stops the background thread """
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._raise_if_failed()
@@ -0,0 +1,292 @@
+#  Copyright (c) 2022. \n Created by Behzad Haki. behzad.haki@upf.edu
+"""
+Opt-in torch.compile acceleration of the VAE models (GrooveTransformerEncoderVAE, Density1D, Density2D)
+
+The models have fixed input shapes (max_len x embedding_size), so the methods are compiled with static shapes
+(dynamic=False), i.e. one specialized graph per batch size. The compiled methods are attached to the model instance
+(the class, the state_dict and save() are not affected). If the compilation (or a compiled call) fails, a warning is
+logged and the method permanently falls back to eager.
+
+Compilation is lazy, so the first call of each method (and each new batch size) is slow. warmup_compiled_model() runs
+these first calls on dummy inputs. The backward graph is only compiled on the first backward() (outside of the compiled
+method), so warmup_compiled_model() also catches the failures of the backward: the model is uncompiled and runs eager.
+
+Usage:
+    compile_model(model)                             # training: forward (and backward) in batch_loop
+    compile_model(model, methods=INFERENCE_METHODS)  # inference: predict/sample
+    warmup_compiled_model(model, batch_sizes=(1, 64))
+    uncompile_model(model)
+
+    python helpers/VAE/compile_utils.py   (benchmark on a randomly initialized model)
+    python helpers/VAE/compile_utils.py --check_fallback   (forces compile failures, see check_eager_fallback)
+"""
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+
+from logging import getLogger
+logger = getLogger("helpers/VAE/compile_utils.py")
+logger.setLevel("DEBUG")
+
+TRAINING_METHODS = ("forward", )
+INFERENCE_METHODS = ("encode", "predict", "predict_and_return_concatenated", "sample",
+                     "sample_and_return_concatenated")
+
+
+class CompiledMethod(object):
+    def __init__(self, method, name, **compile_kwargs):
+        """
+        A compiled method which falls back to the eager method if compilation fails
+
+        :param method: (bound method) the eager method
+        :param name: (str) name of the method (for logging)
+        :param compile_kwargs: arguments for torch.compile (e.g. mode, fullgraph, backend)
+        """
+        self.eager_method = method
+        self.name = name
+        self.compiled_method = torch.compile(method, dynamic=False, **compile_kwargs)
+        self.failed = False
+
+    def __call__(self, *args, **kwargs):
+        # when called from within another compiled method, the eager method is inlined in the outer graph
+        if self.failed or torch.compiler.is_compiling():
+            return self.eager_method(*args, **kwargs)
+        try:
+            return self.compiled_method(*args, **kwargs)
+        except Exception as e:
+            logger.warning(f"Compiling {self.name} failed, falling back to eager: {type(e).__name__}: {e}")
+            self.failed = True
+            return self.eager_method(*args, **kwargs)
+
+
+def compile_model(model, methods=TRAINING_METHODS, **compile_kwargs):
+    """
+    Compiles (in place) the given methods of a model
+
+    :param model: (GrooveTransformerEncoderVAE, Density1D or Density2D) the model
+    :param methods: (list) names of the methods to compile (TRAINING_METHODS and/or INFERENCE_METHODS)
+    :param compile_kwargs: arguments for torch.compile (e.g. mode="max-autotune", backend="inductor")
+    :return: the model
+    """
+    for name in methods:
+        if not hasattr(model, name):
+            logger.warning(f"{type(model).__name__} has no method {name}, skipping")
+            continue
+        eager_method = getattr(type(model), name).__get__(model)
+        setattr(model, name, CompiledMethod(eager_method, f"{type(model).__name__}.{name}", **compile_kwargs))
+    return model
+
+
+def uncompile_model(model):
+    """ Removes the compiled methods (the model runs eager again) """
+    for name in list(vars(model).keys()):
+        if isinstance(vars(model)[name], CompiledMethod):
+            delattr(model, name)
+    return model
+
+
+def get_compiled_methods(model):
+    """ Names of the compiled methods, and whether they fell back to eager: {name: is_compiled} """
+    return {name: not method.failed for name, method in vars(model).items() if isinstance(method, CompiledMethod)}
+
+
+def get_dummy_inputs(model, batch_size):
+    """ Random (src, params) inputs for a model (params is None if the model does not take control params) """
+    src = (torch.rand((batch_size, model.max_len_enc, model.embedding_size_src)) > 0.8).float().to(model.device)
+    params = torch.rand((batch_size, )).to(model.device) if hasattr(model, "n_params") else None
+    return src, params
+
+
+def warmup_compiled_model(model, batch_sizes=(1, ), training=None):
+    """
+    Runs the compiled methods once per batch size, so that the graphs are compiled before the actual use
+
+    :param model: the (compiled) model
+    :param batch_sizes: (list) batch sizes to compile for (each batch size is a different graph)
+    :param training: (bool) if True, the forward is warmed up with a backward pass (default: model.training)
+    :return: (dict) warmup time (sec) per batch size (if the warmup fails, the model is uncompiled and the remaining
+                batch sizes are skipped)
+    """
+    training = model.training if training is None else training
+    compiled_methods = get_compiled_methods(model)
+    n_voices = model.embedding_size_tgt // 3
+    voice_thresholds = torch.ones(n_voices, device=model.device) * 0.5
+    voice_max_count_allowed = torch.ones(n_voices, device=model.device) * model.max_len_dec
+
+    times = dict()
+    for batch_size in batch_sizes:
+        start = time.perf_counter()
+        try:
+            _warmup_batch_size(model, batch_size, training, compiled_methods, voice_thresholds,
+                               voice_max_count_allowed)
+        except Exception as e:
+            # e.g. the backward graph, which is compiled on the first backward() (outside of CompiledMethod)
+            logger.warning(f"Warming up the compiled model failed, falling back to eager: {type(e).__name__}: {e}")
+            model.zero_grad(set_to_none=True)
+            uncompile_model(model)
+            break
+        times[batch_size] = time.perf_counter() - start
+        logger.info(f"Warmed up {list(compiled_methods.keys())} for batch size {batch_size} in "
+                    f"{times[batch_size]:.2f} sec")
+    return times
+
+
+def _warmup_batch_size(model, batch_size, training, compiled_methods, voice_thresholds, voice_max_count_allowed):
+    src, params = get_dummy_inputs(model, batch_size)
+    inputs = (src, ) if params is None else (src, params)
+    if "forward" in compiled_methods:
+        if training:
+            (h_logits, v_logits, o_logits), mu, log_var, _ = model(*inputs)
+            (h_logits.sum() + v_logits.sum() + o_logits.sum() + mu.sum() + log_var.sum()).backward()
+            model.zero_grad(set_to_none=True)
+        else:
+            with torch.no_grad():
+                model(*inputs)
+    with torch.no_grad():
+        if "encode" in compiled_methods:
+            model.encode(*inputs)
+        if "predict" in compiled_methods:
+            model.predict(*inputs)
+        if "predict_and_return_concatenated" in compiled_methods:
+            model.predict_and_return_concatenated(*inputs)
+        latent_z = torch.zeros((batch_size, model.latent_dim), device=model.device)
+        if "sample" in compiled_methods:
+            model.sample(latent_z, voice_thresholds, voice_max_count_allowed)
+        if "sample_and_return_concatenated" in compiled_methods:
+            model.sample_and_return_concatenated(latent_z, voice_thresholds, voice_max_count_allowed)
+
+
+# ---------------------------------------------------------------------------------------------------
+# ------------                 FALLBACK CHECK                    ------------------------------------
+# ---------------------------------------------------------------------------------------------------
+def _failing_backend(gm, example_inputs):
+    raise RuntimeError("forced compile failure")
+
+
+def _get_failing_backward_backend():
+    # compiles the forward graph (eager), but fails when the backward graph is compiled (on the first backward())
+    from torch._dynamo.backends.common import aot_autograd
+    return aot_autograd(fw_compiler=lambda gm, example_inputs: gm.forward, bw_compiler=_failing_backend)
+
+
+def check_eager_fallback(model, batch_size=2):
+    """
+    Forces the compilation of the forward and then of the backward graph to fail (with backends that raise) and
+    checks that the training still runs eager
+
+    :param model: (GrooveTransformerEncoderVAE, Density1D or Density2D) an eager model (copied, not modified)
+    :param batch_size: (int) batch size of the dummy inputs
+    :return: (dict) {"forward": compiled methods after the forward failure, "backward": after the backward failure}
+    """
+    import copy
+    results = dict()
+    for phase, backend in (("forward", _failing_backend), ("backward", _get_failing_backward_backend())):
+        torch._dynamo.reset()
+        model_ = compile_model(copy.deepcopy(model).train(), backend=backend)
+        warmup_compiled_model(model_, batch_sizes=(batch_size, ), training=True)
+        # a regular training step after the failed warmup
+        src, params = get_dummy_inputs(model_, batch_size)
+        (h_logits, v_logits, o_logits), mu, log_var, _ = model_(*((src, ) if params is None else (src, params)))
+        (h_logits.sum() + v_logits.sum() + o_logits.sum() + mu.sum() + log_var.sum()).backward()
+        results[phase] = get_compiled_methods(model_)
+        assert not any(results[phase].values()), f"{phase} compile failure did not fall back to eager"
+    torch._dynamo.reset()
+    logger.info(f"Eager fallback check passed: {results}")
+    return results
+
+
+# ---------------------------------------------------------------------------------------------------
+# ------------                 BENCHMARK                         ------------------------------------
+# ---------------------------------------------------------------------------------------------------
+def get_training_steps_per_sec(model, batch_size, n_steps=20):
+    """ Forward/backward/optimizer steps per second on random batches """
+    model.train()
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-5)
+    src, params = get_dummy_inputs(model, batch_size)
+    inputs = (src, ) if params is None else (src, params)
+    start = time.perf_counter()
+    for _ in range(n_steps):
+        (h_logits, v_logits, o_logits), mu, log_var, _ = model(*inputs)
+        loss = torch.nn.functional.binary_cross_entropy_with_logits(h_logits, src[:, :, :h_logits.shape[-1]]) + \
+            v_logits.pow(2).mean() + o_logits.pow(2).mean() + (mu.pow(2) + log_var.exp()).mean()
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+    return n_steps / (time.perf_counter() - start)
+
+
+def get_request_latency_ms(model, n_runs=50):
+    """ Median latency (ms) of predict_and_return_concatenated for a single input """
+    model.eval()
+    src, params = get_dummy_inputs(model, 1)
+    inputs = (src, ) if params is None else (src, params)
+    latencies = []
+    with torch.no_grad():
+        for _ in range(n_runs):
+            start = time.perf_counter()
+            model.predict_and_return_concatenated(*inputs)
+            latencies.append((time.perf_counter() - start) * 1000.0)
+    return float(np.median(latencies))
+
+
+def benchmark_compiled_model(model_eager, model_compiled, train_batch_size=64, n_train_steps=20, n_runs=50):
+    """
+    Compares the training throughput and the single request latency of an eager and a compiled (warmed up) model
+
+    :param model_eager: the eager model
+    :param model_compiled: the compiled model (with forward and predict_and_return_concatenated compiled)
+    :param train_batch_size: (int) batch size of the training steps
+    :param n_train_steps: (int) number of training steps to time
+    :param n_runs: (int) number of single requests to time
+    :return: (dict) steps/sec and latency (ms) of both models
+    """
+    results = {
+        "eager_train_steps_per_sec": get_training_steps_per_sec(model_eager, train_batch_size, n_train_steps),
+        "compiled_train_steps_per_sec": get_training_steps_per_sec(model_compiled, train_batch_size, n_train_steps),
+        "eager_request_latency_ms": get_request_latency_ms(model_eager, n_runs),
+        "compiled_request_latency_ms": get_request_latency_ms(model_compiled, n_runs),
+        "compiled_methods": get_compiled_methods(model_compiled)
+    }
+    logger.info(f"Compile benchmark: {results}")
+    return results
+
+
+if __name__ == "__main__":
+    import copy
+    import json
+    import argparse
+    sys.path.append(os.path.join(os.path.dirname(__file__), "..", ".."))
+    from model import GrooveTransformerEncoderVAE
+
+    parser = argparse.ArgumentParser(description="Benchmark torch.compile against eager on cpu")
+    parser.add_argument("--model_path", type=str, default=None, help="path to the .pth model (default: random init)")
+    parser.add_argument("--train_batch_size", type=int, default=64)
+    parser.add_argument("--mode", type=str, default="default", help="torch.compile mode")
+    parser.add_argument("--check_fallback", action="store_true",
+                        help="only check the fallback to eager when the compilation fails (see check_eager_fallback)")
+    args = parser.parse_args()
+
+    if args.model_path is not None:
+        from helpers.VAE.modelLoader import load_variational_mgt_model
+        model = load_variational_mgt_model(args.model_path, device="cpu")
+    else:
+        model = GrooveTransformerEncoderVAE({
+            'd_model_enc': 128, 'd_model_dec': 128, 'embedding_size_src': 27, 'embedding_size_tgt': 27,
+            'nhead_enc': 4, 'nhead_dec': 4, 'dim_feedforward_enc': 512, 'dim_feedforward_dec': 512,
+            'num_encoder_layers': 3, 'num_decoder_layers': 3, 'dropout': 0.1, 'latent_dim': 32, 'max_len_enc': 32,
+            'max_len_dec': 32, 'device': 'cpu', 'o_activation': 'tanh'})
+
+    if args.check_fallback:
+        print(json.dumps(check_eager_fallback(model), indent=4))
+        sys.exit(0)
+
+    compiled_model = compile_model(copy.deepcopy(model), methods=("forward", "predict_and_return_concatenated"),
+                                   mode=args.mode)
+    compiled_model.train()
+    warmup_compiled_model(compiled_model, batch_sizes=(args.train_batch_size, ), training=True)
+    compiled_model.eval()
+    warmup_compiled_model(compiled_model, batch_sizes=(1, ))
+    print(json.dumps(benchmark_compiled_model(model, compiled_model, args.train_batch_size), indent=4))
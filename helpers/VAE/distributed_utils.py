@@ -0,0 +1,118 @@
+#  Copyright (c) 2022. \n Created by Behzad Haki. behzad.haki@upf.edu
+"""
+Data parallel training on cpu (torch.distributed with the gloo backend)
+
+Every rank holds a replica of the model and trains on its own shard of the training set (DistributedSampler). The
+gradients are averaged across the ranks (DistributedDataParallel) after every backward pass, so the replicas stay
+identical. Evaluation, logging and checkpointing are done by rank 0 only.
+
+The ranks are launched locally with torchrun, which sets the RANK/WORLD_SIZE/MASTER_ADDR/MASTER_PORT environment
+variables used by init_distributed():
+
+    torchrun --standalone --nproc_per_node 4 train.py --distributed True ...
+"""
+import os
+
+import numpy as np
+import torch
+import torch.distributed as dist
+from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
+
+from logging import getLogger
+logger = getLogger("helpers/VAE/distributed_utils.py")
+logger.setLevel("DEBUG")
+
+
+def init_distributed(backend="gloo", set_num_threads=True):
+    """
+    Initializes the process group from the environment variables set by torchrun
+
+    :param backend: (str) torch.distributed backend ("gloo" for cpu)
+    :param set_num_threads: (bool) if True, the cores of the machine are split between the local ranks
+    :return: (rank, world_size)
+    """
+    if not dist.is_initialized():
+        dist.init_process_group(backend=backend)
+    rank, world_size = dist.get_rank(), dist.get_world_size()
+    if set_num_threads:
+        local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", world_size))
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // local_world_size))
+    logger.info(f"Initialized rank {rank} of {world_size} ({backend}, {torch.get_num_threads()} threads)")
+    return rank, world_size
+
+
+def cleanup_distributed():
+    if dist.is_initialized():
+        dist.destroy_process_group()
+
+
+def get_rank():
+    return dist.get_rank() if dist.is_initialized() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if dist.is_initialized() else 1
+
+
+def is_main_process():
+    """ True for rank 0 (or if not running distributed) """
+    return get_rank() == 0
+
+
+def barrier():
+    if dist.is_initialized():
+        dist.barrier()
+
+
+def broadcast_object(obj, src=0):
+    """ Sends a (picklable) object from rank src to all the ranks """
+    if not dist.is_initialized():
+        return obj
+    objects = [obj if get_rank() == src else None]
+    dist.broadcast_object_list(objects, src=src)
+    return objects[0]
+
+
+def get_distributed_dataloader(dataset, batch_size, shuffle=True, seed=0, drop_last=False, **dataloader_kwargs):
+    """
+    DataLoader over the shard of the dataset of the current rank
+
+    **Call dataloader.sampler.set_epoch(epoch) at the beginning of each epoch so that the shuffling differs between
+    the epochs (and is the same on all ranks)**
+
+    :param dataset: (torch.utils.data.Dataset) the full dataset
+    :param batch_size: (int) batch size per rank
+    :param shuffle: (bool) shuffle the dataset (before sharding)
+    :param seed: (int) seed of the shuffling (must be the same on all ranks)
+    :param drop_last: (bool) drop the tail of the dataset to make it evenly divisible across the ranks
+    :param dataloader_kwargs: additional arguments for the DataLoader (e.g. num_workers)
+    :return: (torch.utils.data.DataLoader)
+    """
+    sampler = DistributedSampler(dataset, num_replicas=get_world_size(), rank=get_rank(), shuffle=shuffle,
+                                 seed=seed, drop_last=drop_last)
+    return DataLoader(dataset, batch_size=batch_size, sampler=sampler, **dataloader_kwargs)
+
+
+def wrap_model(model):
+    """ Wraps the model in DistributedDataParallel (gradients are all-reduced in the backward pass) """
+    if not dist.is_initialized():
+        return model
+    return torch.nn.parallel.DistributedDataParallel(model)
+
+
+def all_reduce_metrics(metrics):
+    """
+    Averages the (scalar) metrics across the ranks
+
+    :param metrics: (dict) {name: float} metrics of the current rank (same keys on all ranks)
+    :return: (dict) {name: float} mean of each metric over the ranks
+    """
+    if not dist.is_initialized():
+        return metrics
+    keys = sorted(key for key, value in metrics.items() if np.isscalar(value))
+    values = torch.tensor([float(metrics[key]) for key in keys], dtype=torch.float64)
+    dist.all_reduce(values, op=dist.ReduceOp.SUM)
+    reduced = dict(metrics)
+    reduced.update({key: value / get_world_size() for key, value in zip(keys, values.tolist())})
+    return reduced
@@ -0,0 +1,313 @@
+#  Copyright (c) 2022. \n Created by Behzad Haki. behzad.haki@upf.edu
+"""
+Evaluation of the training snapshots in a background process
+
+The periodic evaluation of train.py (piano rolls from the GrooveEvaluator template, UMAP of the latents, hit scores on
+the train/test sets) can take longer than the epoch itself. EvalWorker runs it in a separate process instead: submit()
+copies the weights to cpu (a snapshot, so the training can go on modifying them) and puts them in a bounded queue,
+the worker process rebuilds the model from the snapshot, runs the requested evaluation tasks and sends the results
+back, tagged with the epoch of the snapshot. poll_results() collects the finished evaluations without blocking, so
+they can be logged (to the current step, with the epoch of the snapshot under eval/epoch) while the training goes on.
+
+Backpressure: at most max_pending snapshots wait in the queue (on top of the one being evaluated). When the queue is
+full, submit() either skips the snapshot (when_full="skip", the training never waits for the evaluation) or waits
+for a free slot (when_full="block", every snapshot is evaluated).
+
+The worker is started with the 'spawn' method and limits itself to num_threads threads, so that it doesn't fight the
+training for the cores. The scalar results are also appended to {output_dir}/eval_results.jsonl.
+
+Usage:
+    eval_worker = EvalWorker(settings, output_dir=..., max_pending=1, when_full="skip")
+    for epoch in range(n_epochs):
+        ...
+        if epoch % frequency == 0:
+            eval_worker.submit(epoch, model, tasks=("piano_rolls", "umap", "hit_scores_test"))
+        for eval_epoch, results in eval_worker.poll_results():
+            sink.log({**results, "eval/epoch": eval_epoch}, commit=False)
+    for eval_epoch, results in eval_worker.close():
+        ...
+"""
+import os
+import json
+import time
+import queue
+import numbers
+import traceback
+
+import torch
+import torch.multiprocessing as mp
+
+from logging import getLogger
+logger = getLogger("helpers/VAE/eval_worker.py")
+logger.setLevel("DEBUG")
+
+WHEN_FULL_POLICIES = ("skip", "block")
+
+
+# ---------------------------------------------------------------------------------------------------
+# ------------                 EVALUATION TASKS                  ------------------------------------
+# ---------------------------------------------------------------------------------------------------
+# every task is called as task(model, settings, cache) in the worker and returns a dictionary ready to be logged
+# (settings is the dictionary given to EvalWorker, cache is a dictionary kept by the worker between the snapshots)
+
+def get_dataset_setting_json_path(settings):
+    return f"{settings['dataset_json_dir']}/{settings['dataset_json_fname']}"
+
+
+def evaluate_piano_rolls(model, settings, cache):
+    """ Piano rolls of a small subset of the test set (same as the media of train.py) """
+    from helpers.VAE.eval_utils import get_logging_media_for_vae_model_wandb
+    return get_logging_media_for_vae_model_wandb(
+        groove_transformer_vae=model,
+        device=settings.get("device", "cpu"),
+        dataset_setting_json_path=get_dataset_setting_json_path(settings),
+        subset_name='test',
+        down_sampled_ratio=0.005,
+        collapse_tapped_sequence=settings["collapse_tapped_sequence"],
+        cached_folder=settings.get("cached_folder", "eval/GrooveEvaluator/templates"),
+        divide_by_genre=True,
+        need_piano_roll=True,
+        need_kl_plot=False,
+        need_audio=False
+    )
+
+
+def evaluate_umap(model, settings, cache):
+    """ UMAP of the latents of the test set (the test set is loaded once per worker) """
+    from helpers.VAE.eval_utils import generate_umap_for_vae_model_wandb
+    if "test_dataset" not in cache:
+        from data.src.dataLoaders import MonotonicGrooveDataset
+        cache["test_dataset"] = MonotonicGrooveDataset(**settings["test_dataset_kwargs"])
+    return generate_umap_for_vae_model_wandb(
+        groove_transformer_vae=model,
+        device=settings.get("device", "cpu"),
+        test_dataset=cache["test_dataset"],
+        subset_name='test',
+        collapse_tapped_sequence=settings["collapse_tapped_sequence"],
+    )
+
+
+def evaluate_hit_scores_train(model, settings, cache):
+    """ Hit scores on 10% of the train set """
+    from helpers.VAE.eval_utils import get_hit_scores_for_vae_model
+    return get_hit_scores_for_vae_model(
+        groove_transformer_vae=model,
+        device=settings.get("device", "cpu"),
+        dataset_setting_json_path=get_dataset_setting_json_path(settings),
+        subset_name='train',
+        down_sampled_ratio=0.1,
+        collapse_tapped_sequence=settings["collapse_tapped_sequence"],
+        cached_folder=settings.get("cached_folder", "eval/GrooveEvaluator/templates"),
+        divide_by_genre=False
+    )
+
+
+def evaluate_hit_scores_test(model, settings, cache):
+    """ Hit scores on the entire evaluation subset """
+    from helpers.VAE.eval_utils import get_hit_scores_for_vae_model
+    return get_hit_scores_for_vae_model(
+        groove_transformer_vae=model,
+        device=settings.get("device", "cpu"),
+        dataset_setting_json_path=get_dataset_setting_json_path(settings),
+        subset_name=settings.get("evaluate_on_subset", "test"),
+        down_sampled_ratio=None,
+        collapse_tapped_sequence=settings["collapse_tapped_sequence"],
+        cached_folder=settings.get("cached_folder", "eval/GrooveEvaluator/templates"),
+        divide_by_genre=False
+    )
+
+
+EVAL_TASKS = {
+    "piano_rolls": evaluate_piano_rolls,
+    "umap": evaluate_umap,
+    "hit_scores_train": evaluate_hit_scores_train,
+    "hit_scores_test": evaluate_hit_scores_test,
+}
+
+
+# ---------------------------------------------------------------------------------------------------
+# ------------                 WORKER PROCESS                    ------------------------------------
+# ---------------------------------------------------------------------------------------------------
+def get_model_from_snapshot(snapshot_):
+    """ Rebuilds the model (in eval mode) from a snapshot {"params", "model_state_dict"} """
+    from model import GrooveTransformerEncoderVAE
+    model = GrooveTransformerEncoderVAE(snapshot_["params"])
+    model.load_state_dict(snapshot_["model_state_dict"])
+    model.eval()
+    return model
+
+
+def get_scalar_results(results):
+    """ The (json serializable) scalar values of the results """
+    return {key: float(value) if isinstance(value, torch.Tensor) else value
+            for key, value in results.items()
+            if isinstance(value, (numbers.Number, str, bool)) or
+            (isinstance(value, torch.Tensor) and value.numel() == 1)}
+
+
+def _worker_loop(snapshot_queue, result_queue, settings, tasks, output_dir, num_threads):
+    torch.set_num_threads(num_threads)
+    cache = dict()
+    results_path = os.path.join(output_dir, "eval_results.jsonl") if output_dir is not None else None
+
+    while True:
+        item = snapshot_queue.get()
+        if item is None:
+            result_queue.put(("done", None, None, None))
+            return
+        epoch, snapshot_, task_names = item
+        try:
+            model = get_model_from_snapshot(snapshot_)
+        except Exception:
+            result_queue.put(("error", epoch, "load_model", traceback.format_exc()))
+            continue
+        del snapshot_
+
+        for task_name in task_names:
+            start = time.perf_counter()
+            try:
+                with torch.no_grad():
+                    results = tasks[task_name](model, settings, cache)
+            except Exception:
+                result_queue.put(("error", epoch, task_name, traceback.format_exc()))
+                continue
+            results[f"eval/{task_name}_sec"] = time.perf_counter() - start
+            if results_path is not None:
+                with open(results_path, "a") as f:
+                    f.write(json.dumps({"epoch": epoch, "task": task_name, **get_scalar_results(results)}) + "\n")
+            result_queue.put(("result", epoch, task_name, results))
+
+
+# ---------------------------------------------------------------------------------------------------
+# ------------                 TRAINING SIDE                     ------------------------------------
+# ---------------------------------------------------------------------------------------------------
+def _rewrap_media(results):
+    # wandb.Html keeps its content in a temporary file of the process that created it, so the html is re-wrapped
+    # in this process (the content itself comes along with the pickled object)
+    import wandb
+    for key, value in results.items():
+        if type(value).__name__ == "Html" and hasattr(value, "html"):
+            results[key] = wandb.Html(value.html, inject=False)
+    return results
+
+
+class EvalWorker(object):
+    def __init__(self, settings, output_dir=None, max_pending=1, when_full="skip", num_threads=1, tasks=None):
+        """
+        Evaluates model snapshots in a background process
+
+        :param settings: (dict) settings of the evaluation tasks, for the default tasks:
+                            dataset_json_dir, dataset_json_fname, evaluate_on_subset, collapse_tapped_sequence,
+                            cached_folder, device (of the evaluation, default cpu) and test_dataset_kwargs
+                            (kwargs of the MonotonicGrooveDataset used for the UMAP)
+        :param output_dir: (str) folder of eval_results.jsonl (None to not write the scalar results)
+        :param max_pending: (int) max number of snapshots waiting to be evaluated
+        :param when_full: (str) 'skip' (drop the new snapshot) or 'block' (wait for a free slot) when max_pending
+                            snapshots are already waiting
+        :param num_threads: (int) number of torch threads of the worker
+        :param tasks: (dict) {name: function(model, settings, cache) -> dict} tasks available to submit()
+                            (default EVAL_TASKS, the functions must be importable from the worker)
+        """
+        assert when_full in WHEN_FULL_POLICIES, f"when_full must be one of {WHEN_FULL_POLICIES}"
+        assert max_pending >= 1, "max_pending must be at least 1"
+        self.when_full = when_full
+        self.tasks = tasks if tasks is not None else EVAL_TASKS
+        self.n_submitted = 0
+        self.n_skipped = 0
+        self._closed = False
+        if output_dir is not None:
+            os.makedirs(output_dir, exist_ok=True)
+
+        context = mp.get_context("spawn")
+        self._snapshot_queue = context.Queue(maxsize=max_pending)
+        self._result_queue = context.Queue()
+        self._process = context.Process(
+            target=_worker_loop, name="EvalWorker", daemon=True,
+            args=(self._snapshot_queue, self._result_queue, settings, self.tasks, output_dir, num_threads))
+        self._process.start()
+
+    def submit(self, epoch, model, tasks):
+        """
+        Snapshots the model and queues it for evaluation
+
+        :param epoch: (int) the epoch the results are tagged with
+        :param model: (GrooveTransformerEncoderVAE) the (unwrapped) model
+        :param tasks: (list of str) names of the tasks to run on the snapshot
+        :return: (bool) False if the snapshot was skipped because the queue is full
+        """
+        assert not self._closed, "The worker is closed"
+        if not self._process.is_alive():
+            raise RuntimeError(f"The evaluation worker stopped (exit code {self._process.exitcode})")
+        unknown_tasks = [task for task in tasks if task not in self.tasks]
+        assert len(unknown_tasks) == 0, f"Unknown evaluation tasks {unknown_tasks}, available: {list(self.tasks)}"
+        if len(tasks) == 0:
+            return True
+
+        from helpers.VAE.checkpointing import snapshot
+        item = (epoch, snapshot({"params": model.get_params_dict(), "model_state_dict": model.state_dict()}),
+                list(tasks))
+        try:
+            self._snapshot_queue.put(item, block=self.when_full == "block")
+        except queue.Full:
+            self.n_skipped += 1
+            logger.warning(f"Evaluation of epoch {epoch} skipped, the previous snapshots are still being evaluated")
+            return False
+        self.n_submitted += 1
+        return True
+
+    def _handle(self, message, collected):
+        kind, epoch, task_name, payload = message
+        if kind == "error":
+            logger.warning(f"Evaluation task {task_name} of epoch {epoch} failed:\n{payload}")
+        elif kind == "result":
+            if collected and collected[-1][0] == epoch:
+                collected[-1][1].update(_rewrap_media(payload))
+            else:
+                collected.append((epoch, _rewrap_media(payload)))
+        return kind
+
+    def poll_results(self):
+        """
+        Results finished so far (non blocking)
+
+        :return: (list) [(epoch, {key: value})] in the order of the epochs
+        """
+        collected = []
+        while True:
+            try:
+                message = self._result_queue.get_nowait()
+            except queue.Empty:
+                return collected
+            self._handle(message, collected)
+
+    def close(self, timeout=None):
+        """
+        Waits for the queued snapshots to be evaluated and stops the worker
+
+        :param timeout: (float) max number of seconds to wait (None to wait until done)
+        :return: (list) [(epoch, {key: value})] the results not polled yet
+        """
+        collected = []
+        if self._closed:
+            return collected
+        self._closed = True
+        if self._process.is_alive():
+            self._snapshot_queue.put(None)
+            deadline = None if timeout is None else time.perf_counter() + timeout
+            while True:
+                remaining = None if deadline is None else max(0.0, deadline - time.perf_counter())
+                try:
+                    message = self._result_queue.get(timeout=remaining if remaining is not None else 1.0)
+                except queue.Empty:
+                    if deadline is not None or not self._process.is_alive():
+                        break
+                    continue
+                if self._handle(message, collected) == "done":
+                    break
+        collected.extend(self.poll_results())
+        self._process.join(timeout=5)
+        if self._process.is_alive():
+            logger.warning("The evaluation worker did not stop, terminating it")
+            self._process.terminate()
+        logger.info(f"Evaluation worker closed ({self.n_submitted} snapshots evaluated, {self.n_skipped} skipped)")
+        return collected
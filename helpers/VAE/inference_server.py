@@ -0,0 +1,487 @@
+#  Copyright (c) 2022. \n Created by Behzad Haki. behzad.haki@upf.edu
+"""
+Local inference server for the groove VAE (GrooveTransformerEncoderVAE)
+
+Concurrent requests (one tapped pattern each) are queued and coalesced into micro-batches: the first request of a
+batch waits at most max_wait_ms for others to arrive (or until max_batch_size requests are collected), then the whole
+batch is encoded, decoded and sampled in a single pass and the per request results are sent back.
+
+The server speaks plain HTTP, either on localhost or on a unix socket:
+    POST /predict   {"hvo": [[...], ...],                      (max_len_enc x embedding_size_src) tapped input
+                     "voice_thresholds": [...],                 (optional, default 0.5 for all voices)
+                     "voice_max_count_allowed": [...],          (optional, default no limit)
+                     "sampling_mode": 0,                        (optional, 0: top-k, 1: bernoulli)
+                     "temperature": 1.0}                        (optional)
+                --> {"hvo": [[...], ...], "latent_z": [...]}
+    GET /stats      --> latency percentiles (p50/p99) and the histogram of the batch sizes
+    GET /health     --> {"status": "ok"}
+
+Up to REQUEST_QUEUE_SIZE connections can wait to be accepted, check_concurrent_clients() sends a burst of concurrent
+requests to verify that a running server serves all of them.
+
+Usage:
+    python helpers/VAE/inference_server.py --model_path path/to/model.pth --port 8765
+    python helpers/VAE/inference_server.py --model_path path/to/model.pth --unix_socket /tmp/groove_vae.sock
+"""
+import os
+import sys
+import json
+import time
+import queue
+import socket
+import threading
+import collections
+import http.client
+import socketserver
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import torch
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", ".."))
+
+from logging import getLogger
+logger = getLogger("helpers/VAE/inference_server.py")
+logger.setLevel("DEBUG")
+
+
+# --------------------------------------------------------------------------------
+# ------------                 STATISTICS                    ---------------------
+# --------------------------------------------------------------------------------
+class InferenceStats(object):
+    def __init__(self, window_size=10000):
+        """
+        Keeps track of the request latencies (over the last window_size requests) and of the batch sizes
+
+        :param window_size: (int) number of latest requests used for the latency percentiles
+        """
+        self._lock = threading.Lock()
+        self._latencies_ms = collections.deque(maxlen=window_size)
+        self._batch_size_histogram = collections.Counter()
+        self._num_requests = 0
+        self._num_batches = 0
+
+    def add_batch(self, latencies_ms):
+        with self._lock:
+            self._latencies_ms.extend(latencies_ms)
+            self._batch_size_histogram[len(latencies_ms)] += 1
+            self._num_requests += len(latencies_ms)
+            self._num_batches += 1
+
+    def summary(self):
+        """
+        :return: (dict) number of requests/batches, latency percentiles (ms) and the batch size histogram
+        """
+        with self._lock:
+            latencies = np.array(self._latencies_ms)
+            histogram = dict(sorted(self._batch_size_histogram.items()))
+            num_requests, num_batches = self._num_requests, self._num_batches
+
+        summary = {
+            "num_requests": num_requests,
+            "num_batches": num_batches,
+            "mean_batch_size": num_requests / num_batches if num_batches > 0 else 0.0,
+            "batch_size_histogram": {str(k): v for k, v in histogram.items()}
+        }
+        for q in (50, 90, 99):
+            summary[f"latency_p{q}_ms"] = float(np.percentile(latencies, q)) if latencies.size > 0 else None
+        return summary
+
+
+# --------------------------------------------------------------------------------
+# ------------                 MICRO-BATCHING                ---------------------
+# --------------------------------------------------------------------------------
+class GrooveRequest(object):
+    def __init__(self, hvo, voice_thresholds, voice_max_count_allowed, sampling_mode=0, temperature=1.0):
+        """
+        A single prediction request (see MicroBatchingPredictor.submit)
+        """
+        self.hvo = hvo
+        self.voice_thresholds = voice_thresholds
+        self.voice_max_count_allowed = voice_max_count_allowed
+        self.sampling_mode = sampling_mode
+        self.temperature = temperature
+        self.future = Future()
+        self.arrival_time = time.perf_counter()
+
+
+class MicroBatchingPredictor(object):
+    def __init__(self, model, max_batch_size=32, max_wait_ms=5.0, device=None, stats_window_size=10000):
+        """
+        Coalesces concurrent requests into micro-batches that are run on a single worker thread
+
+        :param model: (GrooveTransformerEncoderVAE) the model (see load_variational_mgt_model)
+        :param max_batch_size: (int) maximum number of requests in a batch
+        :param max_wait_ms: (float) maximum time the first request of a batch waits for other requests
+        :param device: (str or torch.device) device to run the model on (default: the device of the model)
+        :param stats_window_size: (int) number of latest requests used for the latency percentiles
+        """
+        self.model = model.eval()
+        self.device = device if device is not None else next(model.parameters()).device
+        self.model.to(self.device)
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.stats = InferenceStats(window_size=stats_window_size)
+
+        self.input_shape = (model.max_len_enc, model.embedding_size_src)
+        self.n_voices = model.embedding_size_tgt // 3
+        self.n_steps = model.max_len_dec
+
+        self._queue = queue.Queue()
+        self._worker = None
+        self._running = False
+        self._stopped = False
+        self._submit_lock = threading.Lock()
+
+    def start(self):
+        if self._worker is None:
+            self._running = True
+            self._worker = threading.Thread(target=self._run, name="MicroBatchingPredictor", daemon=True)
+            self._worker.start()
+        return self
+
+    def stop(self):
+        """ Stops the worker once the requests queued so far are in a batch, the requests left in the queue fail
+        with a RuntimeError, and so does any later submit() """
+        with self._submit_lock:
+            self._stopped = True
+        if self._worker is not None:
+            self._running = False
+            self._queue.put(None)
+            self._worker.join()
+            self._worker = None
+        self._fail_pending_requests()
+
+    def _fail_pending_requests(self):
+        while True:
+            try:
+                request = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if request is not None:
+                request.future.set_exception(RuntimeError("The predictor was stopped before running the request"))
+
+    def submit(self, hvo, voice_thresholds=None, voice_max_count_allowed=None, sampling_mode=0, temperature=1.0):
+        """
+        Queues a request for the next micro-batch
+
+        :param hvo: (array like) tapped input of shape (max_len_enc, embedding_size_src)
+        :param voice_thresholds: (array like) [num_voices] thresholds for hit prediction (default: 0.5)
+        :param voice_max_count_allowed: (array like) [num_voices] maximum number of hits per voice (default: no limit)
+        :param sampling_mode: (int) 0 for top-k sampling, 1 for bernoulli sampling
+        :param temperature: (float) temperature for sampling
+        :return: (concurrent.futures.Future) resolves to a dict with "hvo" (max_len_dec x embedding_size_tgt) and
+                    "latent_z" (latent_dim) numpy arrays
+        :raises RuntimeError: if the predictor is stopped
+        """
+        hvo = np.asarray(hvo, dtype=np.float32)
+        if hvo.shape != self.input_shape:
+            raise ValueError(f"Expected an input of shape {self.input_shape}, got {hvo.shape}")
+
+        voice_thresholds = np.full(self.n_voices, 0.5, dtype=np.float32) if voice_thresholds is None \
+            else np.asarray(voice_thresholds, dtype=np.float32)
+        voice_max_count_allowed = np.full(self.n_voices, self.n_steps, dtype=np.float32) \
+            if voice_max_count_allowed is None else np.asarray(voice_max_count_allowed, dtype=np.float32)
+        if voice_thresholds.shape != (self.n_voices,) or voice_max_count_allowed.shape != (self.n_voices,):
+            raise ValueError(f"voice_thresholds and voice_max_count_allowed must have {self.n_voices} values")
+        if sampling_mode not in (0, 1):
+            raise ValueError(f"sampling_mode {sampling_mode} is not supported")
+        if temperature <= 0:
+            raise ValueError("temperature must be positive")
+
+        request = GrooveRequest(hvo, voice_thresholds, voice_max_count_allowed, sampling_mode, float(temperature))
+        with self._submit_lock:
+            if self._stopped:
+                raise RuntimeError("The predictor is stopped")
+            self._queue.put(request)
+        return request.future
+
+    def predict(self, hvo, timeout=None, **kwargs):
+        """ Blocking version of submit() """
+        return self.submit(hvo, **kwargs).result(timeout=timeout)
+
+    # ---------------------------------------------------
+    def _collect_batch(self):
+        first = self._queue.get()
+        if first is None:
+            return []
+        batch = [first]
+        deadline = first.arrival_time + self.max_wait_ms / 1000.0
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                request = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if request is None:
+                self._running = False
+                break
+            batch.append(request)
+        return batch
+
+    def _run(self):
+        while self._running:
+            batch = self._collect_batch()
+            if not batch:
+                continue
+            try:
+                results = self._predict_batch(batch)
+            except Exception as e:
+                logger.exception("Failed to run a batch")
+                for request in batch:
+                    request.future.set_exception(e)
+                continue
+
+            done_time = time.perf_counter()
+            for request, result in zip(batch, results):
+                request.future.set_result(result)
+            self.stats.add_batch([(done_time - request.arrival_time) * 1000.0 for request in batch])
+
+    def _predict_batch(self, batch):
+        """ Encodes the whole batch in a single pass, then samples it with the model's own sample() (one call per
+        group of requests sharing the same sampling mode and temperature, each request keeps its own
+        thresholds/max counts) """
+        def to_tensor(values):
+            return torch.tensor(np.stack(values), dtype=torch.float32, device=self.device)
+
+        src = to_tensor([request.hvo for request in batch])
+        voice_thresholds = to_tensor([request.voice_thresholds for request in batch])
+        voice_max_count_allowed = to_tensor([request.voice_max_count_allowed for request in batch])
+
+        groups = collections.defaultdict(list)
+        for ix, request in enumerate(batch):
+            groups[(request.sampling_mode, request.temperature)].append(ix)
+
+        with torch.no_grad():
+            _, _, latent_z = self.model.encode(src)
+            hvo = torch.zeros((len(batch), self.n_steps, self.n_voices * 3), device=self.device)
+            for (sampling_mode, temperature), rows in groups.items():
+                rows = torch.tensor(rows, device=self.device)
+                h, v, o, _ = self.model.sample(
+                    latent_z=latent_z[rows],
+                    voice_thresholds=voice_thresholds[rows],
+                    voice_max_count_allowed=voice_max_count_allowed[rows],
+                    sampling_mode=sampling_mode,
+                    temperature=temperature)
+                hvo[rows] = torch.cat((h, v, o), dim=-1).float()
+
+            hvo = hvo.cpu().numpy()
+            latent_z = latent_z.cpu().numpy()
+
+        return [{"hvo": hvo[ix], "latent_z": latent_z[ix]} for ix in range(len(batch))]
+
+
+# --------------------------------------------------------------------------------
+# ------------                 HTTP SERVER                   ---------------------
+# --------------------------------------------------------------------------------
+class GrooveRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self._send_json(200, self.server.predictor.stats.summary())
+        elif self.path == "/health":
+            self._send_json(200, {"status": "ok"})
+        else:
+            self._send_json(404, {"error": f"unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/predict":
+            self._send_json(404, {"error": f"unknown path {self.path}"})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            future = self.server.predictor.submit(
+                request["hvo"],
+                voice_thresholds=request.get("voice_thresholds", None),
+                voice_max_count_allowed=request.get("voice_max_count_allowed", None),
+                sampling_mode=int(request.get("sampling_mode", 0)),
+                temperature=float(request.get("temperature", 1.0)))
+        except (KeyError, ValueError, TypeError) as e:
+            self._send_json(400, {"error": str(e)})
+            return
+        except RuntimeError as e:
+            self._send_json(503, {"error": str(e)})
+            return
+
+        try:
+            result = future.result(timeout=self.server.request_timeout)
+        except Exception as e:
+            self._send_json(500, {"error": str(e)})
+            return
+        self._send_json(200, {key: value.tolist() for key, value in result.items()})
+
+
+# backlog of pending connections (socketserver's default of 5 refuses the bursts of concurrent clients that the
+# micro-batching is meant to absorb)
+REQUEST_QUEUE_SIZE = 128
+
+
+class GrooveHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = REQUEST_QUEUE_SIZE
+
+    def __init__(self, address, predictor, request_timeout=30.0):
+        self.predictor = predictor
+        self.request_timeout = request_timeout
+        super(GrooveHTTPServer, self).__init__(address, GrooveRequestHandler)
+
+
+class GrooveUnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+    request_queue_size = REQUEST_QUEUE_SIZE
+
+    def __init__(self, socket_path, predictor, request_timeout=30.0):
+        self.predictor = predictor
+        self.request_timeout = request_timeout
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        super(GrooveUnixHTTPServer, self).__init__(socket_path, GrooveRequestHandler)
+
+    def get_request(self):
+        # BaseHTTPRequestHandler expects a (host, port) client address
+        request, _ = super(GrooveUnixHTTPServer, self).get_request()
+        return request, ("unix", 0)
+
+    def server_close(self):
+        super(GrooveUnixHTTPServer, self).server_close()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+def create_inference_server(predictor, host="127.0.0.1", port=8765, unix_socket=None, request_timeout=30.0):
+    """
+    Creates the http server (on localhost or on a unix socket) for a MicroBatchingPredictor
+
+    :param predictor: (MicroBatchingPredictor) the predictor (started by the caller)
+    :param host: (str) host to bind to (ignored if unix_socket is given)
+    :param port: (int) port to bind to (ignored if unix_socket is given)
+    :param unix_socket: (str) path of the unix socket to bind to
+    :param request_timeout: (float) seconds to wait for the result of a request
+    :return: server, call serve_forever() to start serving
+    """
+    if unix_socket is not None:
+        return GrooveUnixHTTPServer(unix_socket, predictor, request_timeout=request_timeout)
+    return GrooveHTTPServer((host, port), predictor, request_timeout=request_timeout)
+
+
+# --------------------------------------------------------------------------------
+# ------------                 CLIENT                        ---------------------
+# --------------------------------------------------------------------------------
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout=30.0):
+        super(UnixHTTPConnection, self).__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def send_request(method, path, payload=None, host="127.0.0.1", port=8765, unix_socket=None, timeout=30.0):
+    """
+    Sends a request to the inference server
+
+    :param method: (str) "GET" or "POST"
+    :param path: (str) "/predict", "/stats" or "/health"
+    :param payload: (dict) json payload for POST requests
+    :return: (dict) the decoded json response
+    """
+    connection = UnixHTTPConnection(unix_socket, timeout=timeout) if unix_socket is not None \
+        else http.client.HTTPConnection(host, port, timeout=timeout)
+    try:
+        body = json.dumps(payload) if payload is not None else None
+        connection.request(method, path, body=body, headers={"Content-Type": "application/json"})
+        response = connection.getresponse()
+        result = json.loads(response.read())
+        if response.status != 200:
+            raise RuntimeError(f"Request failed ({response.status}): {result.get('error', '')}")
+        return result
+    finally:
+        connection.close()
+
+
+def check_concurrent_clients(n_clients, input_shape, host="127.0.0.1", port=8765, unix_socket=None, timeout=30.0):
+    """
+    Sends n_clients /predict requests at once (one thread per client) to check that a burst of concurrent
+    clients is served without refused connections
+
+    :param n_clients: (int) number of concurrent clients
+    :param input_shape: (tuple) (max_len_enc, embedding_size_src) of the served model
+    :return: (dict) {"n_succeeded": int, "errors": [str]}
+    """
+    errors, n_succeeded, lock = [], [0], threading.Lock()
+
+    def client():
+        try:
+            send_request("POST", "/predict", {"hvo": np.random.rand(*input_shape).tolist()},
+                         host=host, port=port, unix_socket=unix_socket, timeout=timeout)
+            with lock:
+                n_succeeded[0] += 1
+        except Exception as e:
+            with lock:
+                errors.append(repr(e))
+
+    threads = [threading.Thread(target=client) for _ in range(n_clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return {"n_succeeded": n_succeeded[0], "errors": errors}
+
+
+if __name__ == "__main__":
+    import argparse
+    from helpers.VAE.modelLoader import load_variational_mgt_model
+    from helpers.VAE.thread_tuner import apply_machine_profile
+
+    parser = argparse.ArgumentParser(description="Micro-batching local inference server for the groove VAE")
+    parser.add_argument("--model_path", type=str, required=True, help="path to the .pth model")
+    parser.add_argument("--params_dict", type=str, default=None, help="json path of the model params (optional)")
+    parser.add_argument("--device", type=str, default="cpu", help="device to run the model on")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="host to bind to")
+    parser.add_argument("--port", type=int, default=8765, help="port to bind to")
+    parser.add_argument("--unix_socket", type=str, default=None, help="serve on this unix socket instead")
+    parser.add_argument("--max_batch_size", type=int, default=None,
+                        help="maximum number of requests per batch (default: tuned batch size of the machine profile, "
+                             "otherwise 32)")
+    parser.add_argument("--max_wait_ms", type=float, default=5.0,
+                        help="maximum time (ms) a request waits for others to join its batch")
+    parser.add_argument("--machine_profile", type=str, default="auto",
+                        help="tuned thread counts of this machine used on cpu (see helpers/VAE/thread_tuner.py) - "
+                             "'auto', 'none' or the path of a profile")
+    args = parser.parse_args()
+
+    # (loading the model runs no inter-op work, so the inter-op threads can still be set afterwards)
+    model = load_variational_mgt_model(args.model_path, params_dict=args.params_dict, device=args.device)
+    machine_settings = apply_machine_profile("inference", model_type="vae", path=args.machine_profile,
+                                             model_config=model.get_params_dict()) if args.device == "cpu" else None
+    if args.max_batch_size is None:
+        args.max_batch_size = machine_settings["batch_size"] if machine_settings is not None else 32
+
+    predictor = MicroBatchingPredictor(model, max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms,
+                                       device=args.device).start()
+    server = create_inference_server(predictor, host=args.host, port=args.port, unix_socket=args.unix_socket)
+
+    logger.info(f"Serving on {args.unix_socket if args.unix_socket is not None else f'{args.host}:{args.port}'}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        predictor.stop()
+        logger.info(f"Stats: {predictor.stats.summary()}")
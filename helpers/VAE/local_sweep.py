@@ -0,0 +1,502 @@
+#  Copyright (c) 2022. \n Created by Behzad Haki. behzad.haki@upf.edu
+"""
+Offline hyperparameter sweeps of GrooveTransformerEncoderVAE (no wandb agent needed)
+
+Reads the same YAML search spaces as the wandb sweeps (method, metric, parameters with value/values/distribution, see
+gen_yaml_params.py) and runs the trials in a pool of worker processes, each pinned to its own set of cores. Weak
+trials are stopped early with asynchronous successive halving (ASHA): at every rung (min_epochs * eta^k epochs) a
+trial only continues if its metric is within the best 1/eta of all the trials that reached that rung so far.
+
+By default the trials train on the same training set as train.py (the mega dataset, training_dataset="mega"), set
+training_dataset to "gmd" in the sweep config to train on the (smaller) train split of the gmd instead (see
+TRAINING_DATASETS).
+
+Trials, per epoch metrics and rung results are stored in a local SQLite file. Re-running the same command resumes the
+sweep: completed and pruned trials are kept, interrupted trials are restarted, and new trials are sampled until
+n_trials exist.
+
+Usage (from the root of the repo):
+    python -m helpers.VAE.local_sweep --sweep_config sweep.yaml --db misc/VAE/sweep.sqlite --n_trials 30 \
+        --n_workers 4 --metric test/loss_total --eta 3 --min_epochs 5
+"""
+import os
+import json
+import time
+import sqlite3
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import yaml
+import torch
+from torch.utils.data import DataLoader
+
+from logging import getLogger
+logger = getLogger("helpers/VAE/local_sweep.py")
+logger.setLevel("DEBUG")
+
+# same defaults as the arguments of train.py
+DEFAULT_CONFIG = dict(
+    d_model_enc=32, d_model_dec_ratio=1, embedding_size_src=3, embedding_size_tgt=27, nhead_enc=2, nhead_dec=2,
+    d_ff_enc_to_dmodel=1, d_ff_dec_to_dmodel=1, n_enc_lyrs=3, n_dec_lyrs_ratio=1, max_len_enc=32, max_len_dec=32,
+    latent_dim=16, hit_loss_function="bce", velocity_loss_function="bce", offset_loss_function="bce",
+    beta_annealing_per_cycle_rising_ratio=1.0, beta_annealing_per_cycle_period=100,
+    beta_annealing_start_first_rise_at_epoch=0, dropout=0.4, epochs=100, batch_size=64, lr=1e-4, optimizer="sgd",
+    reduce_loss_by_sum=False, precision="fp32", is_testing=False, dataset_json_dir="data/dataset_json_settings",
+    dataset_json_fname="4_4_Beats_gmd.json", evaluate_on_subset="test", seed=0, device="cpu",
+    training_dataset="mega", mega_dataset_json_fname="4_4_Beats_mega_beats.json")
+
+# training sets of the trials: "mega" trains like train.py (MegaMonotonicGrooveDataset of mega_dataset_json_fname),
+# "gmd" trains on the train split of dataset_json_fname (faster, but the picked hyperparameters are tuned on another
+# training set than the runs of train.py). Either way the trials are evaluated on dataset_json_fname like in train.py
+TRAINING_DATASETS = ("mega", "gmd")
+
+METRIC_GOALS = {"test/loss_total": "minimize", "test/hit_f1": "maximize"}
+
+TRIAL_STATUSES = ("pending", "running", "completed", "pruned", "failed")
+
+
+# ---------------------------------------------------------------------------------------------------
+# ------------                 SEARCH SPACE                      ------------------------------------
+# ---------------------------------------------------------------------------------------------------
+def load_sweep_config(sweep_config_path):
+    """ Loads a wandb style sweep YAML ({"method": ..., "metric": ..., "parameters": {...}}) """
+    with open(sweep_config_path, "r") as f:
+        sweep_config = yaml.safe_load(f)
+    assert "parameters" in sweep_config, f"{sweep_config_path} has no parameters"
+    return sweep_config
+
+
+def sample_parameter(spec, rng):
+    """
+    Samples a single parameter from a wandb style specification
+
+    :param spec: (dict) {"value": v}, {"values": [...]} or {"distribution": ..., "min": ..., "max": ...}
+    :param rng: (np.random.Generator)
+    :return: the sampled value
+    """
+    if "value" in spec:
+        return spec["value"]
+    if "values" in spec:
+        return spec["values"][rng.integers(len(spec["values"]))]
+    distribution = spec.get("distribution", "uniform")
+    low, high = spec["min"], spec["max"]
+    if distribution == "uniform":
+        return float(rng.uniform(low, high))
+    if distribution == "int_uniform":
+        return int(rng.integers(low, high + 1))
+    if distribution == "log_uniform_values":
+        return float(np.exp(rng.uniform(np.log(low), np.log(high))))
+    if distribution == "log_uniform":
+        return float(np.exp(rng.uniform(low, high)))
+    if distribution == "q_uniform":
+        return float(np.round(rng.uniform(low, high) / spec.get("q", 1)) * spec.get("q", 1))
+    raise NotImplementedError(f"distribution {distribution} not supported")
+
+
+def get_grid(parameters):
+    """ All the combinations of a search space with only value/values specifications (method: grid) """
+    keys = list(parameters.keys())
+    for key in keys:
+        assert "value" in parameters[key] or "values" in parameters[key], \
+            f"grid search needs value/values for all the parameters ({key} has {parameters[key]})"
+    values = [[parameters[key]["value"]] if "value" in parameters[key] else parameters[key]["values"]
+              for key in keys]
+    return [dict(zip(keys, combination)) for combination in itertools.product(*values)]
+
+
+def sample_trial_parameters(sweep_config, trial_id, seed=0):
+    """
+    The parameters of the trial_id-th trial (deterministic, so that a resumed sweep samples the same trials)
+
+    :return: (dict) the sampled parameters or None if a grid sweep has no more combinations
+    """
+    method = sweep_config.get("method", "random")
+    if method == "grid":
+        grid = get_grid(sweep_config["parameters"])
+        return grid[trial_id] if trial_id < len(grid) else None
+    if method != "random":
+        logger.warning(f"method {method} not supported locally, sampling randomly instead")
+    rng = np.random.default_rng([seed, trial_id])
+    return {key: sample_parameter(spec, rng) for key, spec in sweep_config["parameters"].items()}
+
+
+def resolve_trial_config(parameters):
+    """
+    Complete config of a trial: the defaults of train.py updated with the sampled parameters, and the model
+    dimensions derived from the ratios (d_model_dec_ratio, d_ff_enc_to_dmodel, ...) in the same way as train.py
+    """
+    config = dict(DEFAULT_CONFIG)
+    config.update(parameters)
+    config.setdefault("d_model_dec", int(float(config["d_model_enc"]) * float(config["d_model_dec_ratio"])))
+    config.setdefault("dim_feedforward_enc", int(float(config["d_ff_enc_to_dmodel"]) * float(config["d_model_enc"])))
+    config.setdefault("dim_feedforward_dec", int(float(config["d_ff_dec_to_dmodel"]) * float(config["d_model_dec"])))
+    config.setdefault("num_encoder_layers", int(config["n_enc_lyrs"]))
+    config.setdefault("num_decoder_layers", int(float(config["num_encoder_layers"]) *
+                                                float(config["n_dec_lyrs_ratio"])))
+    config.setdefault("o_activation", "tanh" if config["offset_loss_function"] == "mse" else "sigmoid")
+    config["reduce_loss_by_sum"] = bool(config["reduce_loss_by_sum"])
+    return config
+
+
+def get_rung_epochs(n_epochs, min_epochs, eta):
+    """ Epochs (1-based) at which the trials are compared: min_epochs, min_epochs * eta, ... (< n_epochs) """
+    rungs, epochs = [], min_epochs
+    while epochs < n_epochs:
+        rungs.append(int(epochs))
+        epochs *= eta
+    return rungs
+
+
+# ---------------------------------------------------------------------------------------------------
+# ------------                 SQLITE STORAGE                    ------------------------------------
+# ---------------------------------------------------------------------------------------------------
+class SweepDatabase(object):
+    def __init__(self, db_path):
+        """
+        SQLite storage of a sweep (safe to use from several processes, each with its own SweepDatabase)
+
+        :param db_path: (str) path to the .sqlite file (created if needed)
+        """
+        self.db_path = db_path
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.connection = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS sweep (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS trials (
+                trial_id INTEGER PRIMARY KEY, config TEXT, status TEXT, last_epoch INTEGER, metric_value REAL,
+                model_path TEXT, error TEXT, updated_at REAL);
+            CREATE TABLE IF NOT EXISTS results (
+                trial_id INTEGER, epoch INTEGER, metrics TEXT, PRIMARY KEY (trial_id, epoch));
+            CREATE TABLE IF NOT EXISTS rungs (
+                trial_id INTEGER, rung_epoch INTEGER, metric_value REAL, PRIMARY KEY (trial_id, rung_epoch));
+        """)
+
+    def get_sweep_setting(self, key):
+        row = self.connection.execute("SELECT value FROM sweep WHERE key = ?", (key, )).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def set_sweep_setting(self, key, value):
+        self.connection.execute("INSERT OR REPLACE INTO sweep VALUES (?, ?)", (key, json.dumps(value)))
+
+    def add_trial(self, trial_id, config):
+        self.connection.execute("INSERT OR IGNORE INTO trials (trial_id, config, status, updated_at) "
+                                "VALUES (?, ?, 'pending', ?)", (trial_id, json.dumps(config), time.time()))
+
+    def update_trial(self, trial_id, **fields):
+        assert fields.get("status", "pending") in TRIAL_STATUSES
+        fields["updated_at"] = time.time()
+        self.connection.execute(f"UPDATE trials SET {', '.join(f'{key} = ?' for key in fields)} WHERE trial_id = ?",
+                                list(fields.values()) + [trial_id])
+
+    def get_trials(self, status=None):
+        """ [{"trial_id": ..., "config": {...}, "status": ..., ...}] (optionally only the trials with a status) """
+        query = "SELECT trial_id, config, status, last_epoch, metric_value, model_path, error FROM trials"
+        rows = self.connection.execute(query + (" WHERE status = ?" if status else "") + " ORDER BY trial_id",
+                                       (status, ) if status else ()).fetchall()
+        return [{"trial_id": row[0], "config": json.loads(row[1]), "status": row[2], "last_epoch": row[3],
+                 "metric_value": row[4], "model_path": row[5], "error": row[6]} for row in rows]
+
+    def get_trial(self, trial_id):
+        return [trial for trial in self.get_trials() if trial["trial_id"] == trial_id][0]
+
+    def reset_interrupted_trials(self):
+        """ Trials left running by an interrupted sweep are restarted from scratch """
+        trial_ids = [trial["trial_id"] for trial in self.get_trials("running")]
+        for trial_id in trial_ids:
+            self.connection.execute("DELETE FROM results WHERE trial_id = ?", (trial_id, ))
+            self.connection.execute("DELETE FROM rungs WHERE trial_id = ?", (trial_id, ))
+            self.update_trial(trial_id, status="pending", last_epoch=None, metric_value=None)
+        return trial_ids
+
+    def add_result(self, trial_id, epoch, metrics):
+        self.connection.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?)",
+                                (trial_id, epoch, json.dumps(metrics)))
+
+    def get_results(self, trial_id):
+        rows = self.connection.execute("SELECT epoch, metrics FROM results WHERE trial_id = ? ORDER BY epoch",
+                                       (trial_id, )).fetchall()
+        return [dict(json.loads(metrics), epoch=epoch) for epoch, metrics in rows]
+
+    def add_rung_result(self, trial_id, rung_epoch, metric_value):
+        self.connection.execute("INSERT OR REPLACE INTO rungs VALUES (?, ?, ?)", (trial_id, rung_epoch, metric_value))
+
+    def get_rung_values(self, rung_epoch):
+        rows = self.connection.execute("SELECT metric_value FROM rungs WHERE rung_epoch = ?", (rung_epoch, ))
+        return [row[0] for row in rows.fetchall()]
+
+    def close(self):
+        self.connection.close()
+
+
+def should_stop_trial(db, trial_id, rung_epoch, metric_value, goal, eta):
+    """
+    ASHA decision: records the metric of the trial at the rung, and stops the trial if it is not within the best
+    1/eta of the values recorded at this rung (no decision until at least eta trials reached the rung)
+    """
+    db.add_rung_result(trial_id, rung_epoch, metric_value)
+    values = np.array(db.get_rung_values(rung_epoch), dtype=np.float64)
+    if len(values) < eta:
+        return False
+    if goal == "minimize":
+        return metric_value > np.nanquantile(values, 1.0 / eta)
+    return metric_value < np.nanquantile(values, 1.0 - 1.0 / eta)
+
+
+# ---------------------------------------------------------------------------------------------------
+# ------------                 TRIALS (WORKER PROCESSES)          -----------------------------------
+# ---------------------------------------------------------------------------------------------------
+_worker_datasets = dict()
+
+
+def init_worker(core_queue):
+    """ Pins the worker process to its own set of cores and uses as many torch threads as cores """
+    cores = core_queue.get()
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+    os.environ["WANDB_MODE"] = "disabled"
+
+
+def get_core_sets(n_workers):
+    """ Splits the cores available to this process into n_workers disjoint sets """
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count() or 1))
+    n_workers = min(n_workers, len(cores))
+    return [[int(core) for core in chunk] for chunk in np.array_split(cores, n_workers)]
+
+
+def load_groove_datasets(config):
+    """ (training, test) datasets of a trial (loaded once per worker process and settings), the training set is
+    selected by config["training_dataset"] (see TRAINING_DATASETS) """
+    from data.src.dataLoaders import MonotonicGrooveDataset
+    assert config["training_dataset"] in TRAINING_DATASETS, f"training_dataset must be one of {TRAINING_DATASETS}"
+    collapse_tapped_sequence = (int(config["embedding_size_src"]) == 3)
+    key = (config["training_dataset"], config["mega_dataset_json_fname"], config["dataset_json_dir"],
+           config["dataset_json_fname"], config["evaluate_on_subset"], int(config["max_len_enc"]),
+           collapse_tapped_sequence, bool(config["is_testing"]))
+    if key not in _worker_datasets:
+        if config["training_dataset"] == "mega":
+            from data.src.dataLoaders import MegaMonotonicGrooveDataset
+            training_dataset = MegaMonotonicGrooveDataset(
+                dataset_setting_json_path=f"{config['dataset_json_dir']}/{config['mega_dataset_json_fname']}",
+                subset_tag="train",
+                max_len=int(config["max_len_enc"]),
+                tapped_voice_idx=2,
+                collapse_tapped_sequence=collapse_tapped_sequence)
+        else:
+            training_dataset = MonotonicGrooveDataset(
+                dataset_setting_json_path=f"{config['dataset_json_dir']}/{config['dataset_json_fname']}",
+                subset_tag="train",
+                max_len=int(config["max_len_enc"]),
+                tapped_voice_idx=2,
+                collapse_tapped_sequence=collapse_tapped_sequence,
+                down_sampled_ratio=0.1 if config["is_testing"] else None)
+        test_dataset = MonotonicGrooveDataset(
+            dataset_setting_json_path=f"{config['dataset_json_dir']}/{config['dataset_json_fname']}",
+            subset_tag=config["evaluate_on_subset"],
+            max_len=int(config["max_len_enc"]),
+            tapped_voice_idx=2,
+            collapse_tapped_sequence=collapse_tapped_sequence,
+            down_sampled_ratio=0.1 if config["is_testing"] else None)
+        _worker_datasets[key] = (training_dataset, test_dataset)
+    return _worker_datasets[key]
+
+
+def get_hit_f1(groove_transformer_vae, dataloader, device):
+    """ F1 score of the predicted hits (threshold 0.5) against the target hits over a whole dataloader """
+    groove_transformer_vae.eval()
+    n_true_positives, n_predicted, n_targets = 0.0, 0.0, 0.0
+    with torch.no_grad():
+        for data_tuple in dataloader:
+            (h, _, _), _, _, _ = groove_transformer_vae.predict(data_tuple[0].to(device))
+            h_targets = data_tuple[1].to(device)[:, :, :h.shape[-1]]
+            n_true_positives += float((h * h_targets).sum())
+            n_predicted += float(h.sum())
+            n_targets += float(h_targets.sum())
+    return 2 * n_true_positives / max(n_predicted + n_targets, 1e-8)
+
+
+def run_trial(db_path, trial_id, metric, goal, eta, min_epochs, output_dir, dataset_loader=load_groove_datasets):
+    """
+    Trains a single trial, reporting its metrics to the database and stopping early if pruned by ASHA
+
+    :param db_path: (str) the sweep database
+    :param trial_id: (int) the trial to run (its config is read from the database)
+    :param metric: (str) "test/loss_total" or "test/hit_f1"
+    :param goal: (str) "minimize" or "maximize"
+    :param eta: (int) reduction factor of successive halving
+    :param min_epochs: (int) epochs before the first rung
+    :param output_dir: (str) folder for the models of the completed trials (None to not save them)
+    :param dataset_loader: (callable) config --> (training dataset, test dataset)
+    :return: (trial_id, status, metric_value)
+    """
+    from model import GrooveTransformerEncoderVAE
+    from helpers.VAE import train_utils
+
+    db = SweepDatabase(db_path)
+    config = db.get_trial(trial_id)["config"]
+    db.update_trial(trial_id, status="running")
+    status, metric_value = "completed", None
+    try:
+        torch.manual_seed(int(config["seed"]) + trial_id)
+        training_dataset, test_dataset = dataset_loader(config)
+        train_dataloader = DataLoader(training_dataset, batch_size=int(config["batch_size"]), shuffle=True)
+        test_dataloader = DataLoader(test_dataset, batch_size=int(config["batch_size"]), shuffle=False)
+
+        model = GrooveTransformerEncoderVAE(config).to(config["device"])
+        hit_loss_fn = torch.nn.BCEWithLogitsLoss(reduction='none')
+        velocity_loss_fn = torch.nn.BCEWithLogitsLoss(reduction='none') \
+            if config["velocity_loss_function"] == "bce" else torch.nn.MSELoss(reduction='none')
+        offset_loss_fn = torch.nn.BCEWithLogitsLoss(reduction='none') \
+            if config["offset_loss_function"] == "bce" else torch.nn.MSELoss(reduction='none')
+        optimizer = torch.optim.Adam(model.parameters(), lr=config["lr"]) if config["optimizer"] == "adam" \
+            else torch.optim.SGD(model.parameters(), lr=config["lr"])
+        beta_np_cyc = train_utils.generate_beta_curve(
+            n_epochs=config["epochs"],
+            period_epochs=config["beta_annealing_per_cycle_period"],
+            rise_ratio=config["beta_annealing_per_cycle_rising_ratio"],
+            start_first_rise_at_epoch=config["beta_annealing_start_first_rise_at_epoch"])
+        rung_epochs = get_rung_epochs(config["epochs"], min_epochs, eta)
+
+        step_ = 0
+        for epoch in range(config["epochs"]):
+            model.train()
+            train_metrics, step_ = train_utils.train_loop(
+                train_dataloader=train_dataloader, groove_transformer_vae=model, optimizer=optimizer,
+                hit_loss_fn=hit_loss_fn, velocity_loss_fn=velocity_loss_fn, offset_loss_fn=offset_loss_fn,
+                device=config["device"], starting_step=step_, kl_beta=beta_np_cyc[epoch],
+                reduce_by_sum=config["reduce_loss_by_sum"], precision=config["precision"])
+            model.eval()
+            test_metrics = train_utils.test_loop(
+                test_dataloader=test_dataloader, groove_transformer_vae=model, hit_loss_fn=hit_loss_fn,
+                velocity_loss_fn=velocity_loss_fn, offset_loss_fn=offset_loss_fn, device=config["device"],
+                kl_beta=beta_np_cyc[epoch], reduce_by_sum=config["reduce_loss_by_sum"],
+                precision=config["precision"])
+            metrics = {key: float(value) for key, value in list(train_metrics.items()) + list(test_metrics.items())}
+            if metric == "test/hit_f1":
+                metrics["test/hit_f1"] = get_hit_f1(model, test_dataloader, config["device"])
+            metric_value = metrics[metric]
+            db.add_result(trial_id, epoch, metrics)
+            db.update_trial(trial_id, last_epoch=epoch, metric_value=metric_value)
+
+            if not np.isfinite(metric_value):
+                status = "pruned"
+                break
+            if (epoch + 1) in rung_epochs and should_stop_trial(db, trial_id, epoch + 1, metric_value, goal, eta):
+                status = "pruned"
+                break
+
+        model_path = None
+        if output_dir is not None and status == "completed":
+            model_path = os.path.join(output_dir, f"trial_{trial_id:04d}.pth")
+            model.save(model_path)
+        db.update_trial(trial_id, status=status, model_path=model_path)
+    except Exception as e:
+        logger.exception(f"Trial {trial_id} failed")
+        status = "failed"
+        db.update_trial(trial_id, status=status, error=f"{type(e).__name__}: {e}")
+    finally:
+        db.close()
+    return trial_id, status, metric_value
+
+
+# ---------------------------------------------------------------------------------------------------
+# ------------                 SWEEP                             ------------------------------------
+# ---------------------------------------------------------------------------------------------------
+def run_sweep(sweep_config, db_path, n_trials, n_workers=1, metric="test/loss_total", goal=None, eta=3,
+              min_epochs=1, output_dir=None, seed=0, dataset_loader=load_groove_datasets):
+    """
+    Runs (or resumes) an offline sweep
+
+    :param sweep_config: (dict) wandb style sweep config (see load_sweep_config)
+    :param db_path: (str) the SQLite file of the sweep (resumed if it exists)
+    :param n_trials: (int) total number of trials (including the ones of previous runs)
+    :param n_workers: (int) number of trials trained in parallel (the cores are split between the workers)
+    :param metric: (str) metric used by ASHA ("test/loss_total" or "test/hit_f1")
+    :param goal: (str) "minimize" or "maximize" (default: METRIC_GOALS[metric])
+    :param eta: (int) reduction factor (only the best 1/eta of the trials continue at each rung)
+    :param min_epochs: (int) epochs before the first rung
+    :param output_dir: (str) folder for the models of the completed trials (None to not save them)
+    :param seed: (int) seed of the random sampling of the trials
+    :param dataset_loader: (callable) picklable function: config --> (training dataset, test dataset)
+    :return: (list) the trials, best first: the completed trials ranked by their final metric, then the pruned trials
+                (their metric is the one of the rung they stopped at, so they are ranked by the number of epochs they
+                lasted and then by that metric), then the trials without a metric
+    """
+    goal = METRIC_GOALS.get(metric, "minimize") if goal is None else goal
+    assert goal in ("minimize", "maximize"), "goal must be either minimize or maximize"
+
+    db = SweepDatabase(db_path)
+    previous_sweep_config = db.get_sweep_setting("sweep_config")
+    if previous_sweep_config is not None and previous_sweep_config != sweep_config:
+        logger.warning(f"{db_path} was created with a different sweep config, the existing trials are kept")
+    db.set_sweep_setting("sweep_config", sweep_config)
+    interrupted = db.reset_interrupted_trials()
+    if interrupted:
+        logger.info(f"Restarting the interrupted trials {interrupted}")
+
+    for trial_id in range(len(db.get_trials()), n_trials):
+        parameters = sample_trial_parameters(sweep_config, trial_id, seed)
+        if parameters is None:
+            logger.info(f"The grid has only {trial_id} combinations")
+            break
+        db.add_trial(trial_id, resolve_trial_config(parameters))
+
+    pending = [trial["trial_id"] for trial in db.get_trials("pending")]
+    logger.info(f"Running {len(pending)} trials on {n_workers} workers ({metric}, {goal}, eta={eta}, "
+                f"rungs at {min_epochs} * {eta}^k epochs)")
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+
+    if pending:
+        core_sets = get_core_sets(n_workers)
+        mp_context = multiprocessing.get_context("spawn")
+        core_queue = mp_context.Queue()
+        for cores in core_sets:
+            core_queue.put(cores)
+        with ProcessPoolExecutor(max_workers=len(core_sets), mp_context=mp_context, initializer=init_worker,
+                                 initargs=(core_queue, )) as executor:
+            futures = [executor.submit(run_trial, db_path, trial_id, metric, goal, eta, min_epochs, output_dir,
+                                       dataset_loader) for trial_id in pending]
+            for future in futures:
+                trial_id, status, metric_value = future.result()
+                logger.info(f"Trial {trial_id} {status} ({metric} = {metric_value})")
+
+    trials = db.get_trials()
+    db.close()
+    sign = -1.0 if goal == "maximize" else 1.0
+    with_metric = [trial for trial in trials if trial["metric_value"] is not None]
+    completed = sorted([trial for trial in with_metric if trial["status"] == "completed"],
+                       key=lambda trial: sign * trial["metric_value"])
+    pruned = sorted([trial for trial in with_metric if trial["status"] == "pruned"],
+                    key=lambda trial: (-trial["last_epoch"], sign * trial["metric_value"]))
+    ranked_ids = {trial["trial_id"] for trial in completed + pruned}
+    return completed + pruned + [trial for trial in trials if trial["trial_id"] not in ranked_ids]
+
+
+if __name__ == "__main__":
+    import sys
+    import argparse
+    sys.path.append(os.path.join(os.path.dirname(__file__), "..", ".."))
+
+    parser = argparse.ArgumentParser(description="Offline sweep of the VAE with successive halving early stopping")
+    parser.add_argument("--sweep_config", type=str, required=True, help="wandb style sweep YAML file")
+    parser.add_argument("--db", type=str, default="misc/VAE/sweep.sqlite", help="SQLite file (resumed if exists)")
+    parser.add_argument("--n_trials", type=int, default=20, help="total number of trials")
+    parser.add_argument("--n_workers", type=int, default=1, help="number of trials trained in parallel")
+    parser.add_argument("--metric", type=str, default="test/loss_total", choices=list(METRIC_GOALS.keys()))
+    parser.add_argument("--eta", type=int, default=3, help="reduction factor of successive halving")
+    parser.add_argument("--min_epochs", type=int, default=5, help="epochs before the first rung")
+    parser.add_argument("--save_model_dir", type=str, default="misc/VAE/sweep", help="models of completed trials")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the trial sampling")
+    args = parser.parse_args()
+
+    results = run_sweep(load_sweep_config(args.sweep_config), args.db, args.n_trials, n_workers=args.n_workers,
+                        metric=args.metric, eta=args.eta, min_epochs=args.min_epochs,
+                        output_dir=args.save_model_dir, seed=args.seed)
+    for trial in results[:5]:
+        print(f"trial {trial['trial_id']} ({trial['status']}, {trial['last_epoch']} epochs): "
+              f"{args.metric} = {trial['metric_value']}")
@@ -19,13 +19,12 @@ def load_variational_mgt_model(model_path, params_dict=None, is_evaluating=True,
         model (GrooveTransformerEncoder): the loaded model
     """
 
-    try:
-        if device is not None:
-            loaded_dict = torch.load(model_path, map_location=device)
-        else:
-            loaded_dict = torch.load(model_path)
-    except:
-        loaded_dict = torch.load(model_path, map_location=torch.device('cpu'))
+    # pick the device before loading (instead of retrying on cpu, which reads the file twice)
+    fall_back_to_cpu = device is None and not torch.cuda.is_available()
+    if fall_back_to_cpu:
+        device = torch.device('cpu')
+    loaded_dict = torch.load(model_path, map_location=device)
+    if fall_back_to_cpu:
         logger.info(f"Model was loaded to cpu!!!")
 
     if params_dict is None:
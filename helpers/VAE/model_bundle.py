@@ -0,0 +1,197 @@
+#  Copyright (c) 2022. \n Created by Behzad Haki. behzad.haki@upf.edu
+"""
+Single file, inference optimized bundles of the VAE models (GrooveTransformerEncoderVAE, Density1D, Density2D)
+
+The model is scripted, frozen (parameters become constants and the training only branches are removed) and passed
+through torch.jit.optimize_for_inference. The params of the model (params.json), the drum mapping of its outputs
+(drum_mapping.json) and some info about the bundle (bundle_info.json) are embedded in the same file.
+
+Note that in a frozen bundle, each kept method carries its own copy of the (constant) weights, so loading takes
+longer the more methods are kept. Use benchmark_model_bundle() to compare against an unfrozen bundle (freeze=False).
+
+Usage:
+    export_model_bundle(model, "path/to/model_bundle.pt")
+    model, metadata = load_model_bundle("path/to/model_bundle.pt")
+    hvo, mu, log_var, latent_z = model.predict_and_return_concatenated(src)            # GrooveTransformerEncoderVAE
+    hvo, mu, log_var, latent_z = model.predict_and_return_concatenated(src, params)    # Density1D/Density2D
+
+    python helpers/VAE/model_bundle.py --model_path path/to/model.pth --bundle_path path/to/model_bundle.pt
+"""
+import os
+import sys
+import copy
+import json
+import time
+
+import numpy as np
+import torch
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", ".."))
+
+from model import Density1D, Density2D
+from hvo_sequence.drum_mappings import ROLAND_REDUCED_MAPPING
+
+from logging import getLogger
+logger = getLogger("helpers/VAE/model_bundle.py")
+logger.setLevel("DEBUG")
+
+# methods kept in the bundle (if the model class exports them)
+BUNDLE_METHODS = ("encode", "sample_and_return_concatenated", "predict_and_return_concatenated")
+BUNDLE_EXTRA_FILES = ("params.json", "drum_mapping.json", "bundle_info.json")
+
+
+def export_model_bundle(model, bundle_path, drum_mapping=None, freeze=True, optimize_for_inference=True,
+                        methods=BUNDLE_METHODS, additional_info=None):
+    """
+    Exports a frozen torchscript bundle of the model (cpu) along with its metadata in a single file
+
+    :param model: (GrooveTransformerEncoderVAE, Density1D or Density2D) the model
+    :param bundle_path: (str) path of the bundle (.pt)
+    :param drum_mapping: (dict) drum mapping of the outputs of the model (default: ROLAND_REDUCED_MAPPING)
+    :param freeze: (bool) if True, the scripted model is frozen
+    :param optimize_for_inference: (bool) if True, torch.jit.optimize_for_inference is applied after freezing
+    :param methods: (list) methods to keep in the frozen graph (besides forward)
+    :param additional_info: (dict) any json serializable info to be stored in bundle_info.json
+    :return: (str) the path of the bundle
+    """
+    assert bundle_path.endswith('.pt'), 'bundle_path must end with .pt'
+    if os.path.dirname(bundle_path) != "":
+        os.makedirs(os.path.dirname(bundle_path), exist_ok=True)
+
+    model_ = copy.deepcopy(model).cpu().eval()
+    scripted = torch.jit.script(model_)
+    methods = [method for method in methods if hasattr(scripted, method)]
+    assert "predict_and_return_concatenated" in methods, "predict_and_return_concatenated is needed for warm up"
+    if freeze:
+        bundle = torch.jit.freeze(scripted, preserved_attrs=methods)
+        if optimize_for_inference:
+            bundle = torch.jit.optimize_for_inference(bundle, other_methods=methods)
+    else:
+        bundle = scripted
+
+    params_dict = model_.get_params_dict()
+    params_dict['device'] = 'cpu'
+    bundle_info = {
+        "model_class": type(model).__name__,
+        "methods": methods,
+        "requires_params": isinstance(model, (Density1D, Density2D)),
+        "frozen": freeze,
+        "optimized_for_inference": freeze and optimize_for_inference,
+        "torch_version": torch.__version__,
+        "additional_info": additional_info
+    }
+    extra_files = {
+        "params.json": json.dumps(params_dict),
+        "drum_mapping.json": json.dumps(drum_mapping if drum_mapping is not None else ROLAND_REDUCED_MAPPING),
+        "bundle_info.json": json.dumps(bundle_info)
+    }
+    # (torch.jit.save would call the save() method of the model classes, which the scripted module also exposes)
+    bundle._c.save(bundle_path, _extra_files=extra_files)
+    logger.info(f"Model bundle saved at {bundle_path}")
+    return bundle_path
+
+
+def get_dummy_inputs(metadata, batch_size=1):
+    """ Zero inputs (src, params) for a bundle (params is None if the model does not take control params) """
+    params_dict = metadata["params"]
+    src = torch.zeros((batch_size, params_dict["max_len_enc"], params_dict["embedding_size_src"]))
+    params = torch.zeros((batch_size, )) if metadata["bundle_info"]["requires_params"] else None
+    return src, params
+
+
+def run_bundle(bundle, src, params=None, thres=0.5):
+    """ Runs predict_and_return_concatenated on a bundle with or without control params """
+    if params is None:
+        return bundle.predict_and_return_concatenated(src, thres)
+    return bundle.predict_and_return_concatenated(src, params, thres)
+
+
+def load_model_bundle(bundle_path, warmup_runs=3, num_threads=None):
+    """
+    Loads a bundle exported with export_model_bundle and warms up its graph
+
+    (The first few calls of a torchscript graph are slow as the graph is profiled and specialized, so the warm up
+    makes sure the first actual request does not pay for it)
+
+    :param bundle_path: (str) path of the bundle (.pt)
+    :param warmup_runs: (int) number of dummy predictions to run after loading
+    :param num_threads: (int) if given, sets the number of threads used by torch
+    :return: (bundle, metadata) metadata is a dict with "params", "drum_mapping" and "bundle_info"
+    """
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+
+    extra_files = {name: "" for name in BUNDLE_EXTRA_FILES}
+    bundle = torch.jit.load(bundle_path, map_location=torch.device('cpu'), _extra_files=extra_files)
+    metadata = {name.replace(".json", ""): json.loads(content) for name, content in extra_files.items()}
+
+    if warmup_runs > 0:
+        src, params = get_dummy_inputs(metadata)
+        with torch.no_grad():
+            for _ in range(warmup_runs):
+                run_bundle(bundle, src, params)
+
+    return bundle, metadata
+
+
+def benchmark_model_bundle(bundle_path, model=None, n_runs=50):
+    """
+    Benchmarks the cold start (loading) time and the first/warm inference latency of a bundle, and optionally of the
+    eager model for comparison
+
+    :param bundle_path: (str) path of the bundle (.pt)
+    :param model: (torch.nn.Module) the eager model (optional)
+    :param n_runs: (int) number of runs for the warm latency
+    :return: (dict) times in ms
+    """
+    def time_ms(fn):
+        start = time.perf_counter()
+        out = fn()
+        return (time.perf_counter() - start) * 1000.0, out
+
+    results = dict()
+    results["bundle_cold_start_ms"], (bundle, metadata) = time_ms(lambda: load_model_bundle(bundle_path, 0))
+    src, params = get_dummy_inputs(metadata)
+
+    with torch.no_grad():
+        results["bundle_first_inference_ms"], _ = time_ms(lambda: run_bundle(bundle, src, params))
+        results["bundle_warm_inference_ms"] = float(np.median(
+            [time_ms(lambda: run_bundle(bundle, src, params))[0] for _ in range(n_runs)]))
+
+        results["bundle_cold_start_with_warmup_ms"], (bundle, _) = time_ms(lambda: load_model_bundle(bundle_path))
+        results["bundle_first_inference_after_warmup_ms"], _ = time_ms(lambda: run_bundle(bundle, src, params))
+
+        if model is not None:
+            model_ = copy.deepcopy(model).cpu().eval()
+            results["eager_first_inference_ms"], _ = time_ms(lambda: run_bundle(model_, src, params))
+            results["eager_warm_inference_ms"] = float(np.median(
+                [time_ms(lambda: run_bundle(model_, src, params))[0] for _ in range(n_runs)]))
+
+    logger.info(f"Bundle benchmark: {results}")
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+    from helpers.VAE.modelLoader import load_variational_mgt_model
+    from helpers.Control.density_model_Loader import load_density_model
+
+    parser = argparse.ArgumentParser(description="Export a model as a frozen single file torchscript bundle")
+    parser.add_argument("--model_path", type=str, required=True, help="path to the .pth model")
+    parser.add_argument("--bundle_path", type=str, required=True, help="path of the bundle (.pt)")
+    parser.add_argument("--density_version", type=str, default=None,
+                        help="1D or 2D for density models (leave empty for GrooveTransformerEncoderVAE)")
+    parser.add_argument("--no_freeze", action="store_true", help="skip freezing (faster loading)")
+    parser.add_argument("--no_optimize", action="store_true", help="skip torch.jit.optimize_for_inference")
+    parser.add_argument("--benchmark", action="store_true", help="benchmark the bundle against the eager model")
+    args = parser.parse_args()
+
+    if args.density_version is None:
+        model = load_variational_mgt_model(args.model_path, device="cpu")
+    else:
+        model = load_density_model(args.model_path, args.density_version, device="cpu")
+
+    export_model_bundle(model, args.bundle_path, freeze=not args.no_freeze, optimize_for_inference=not args.no_optimize,
+                        additional_info={"source_model_path": args.model_path})
+    if args.benchmark:
+        print(json.dumps(benchmark_model_bundle(args.bundle_path, model=model), indent=4))
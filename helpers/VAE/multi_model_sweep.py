@@ -0,0 +1,263 @@
+#  Copyright (c) 2022. \n Created by Behzad Haki. behzad.haki@upf.edu
+"""
+Trains several GrooveTransformerEncoderVAE variants together in a single process (for hyperparameter sweeps)
+
+Models with the same architecture (and the same batch size/loss functions) are stacked: their parameters are stacked
+along a new first dimension (torch.func.stack_module_state) and a single vmapped forward/backward pass trains all of
+them on the same batches. The variants can differ in:
+    - seed (initialization only: dropout and latent sampling draw independent noise per variant from the global
+      torch RNG, i.e. vmap with randomness="different", so they are not reproducible per variant)
+    - lr
+    - beta_annealing_per_cycle_period, beta_annealing_per_cycle_rising_ratio, beta_annealing_start_first_rise_at_epoch
+
+The dataset is loaded once and shared by all the groups. Each variant gets its own folder with its checkpoints
+(loadable with load_variational_mgt_model) and a metrics.jsonl file (one line per epoch).
+
+Usage:
+    configs = get_sweep_configs(base_config, {"seed": [0, 1, 2], "lr": [1e-3, 1e-4]})
+    run_multi_model_sweep(configs, training_dataset, test_dataset, "misc/VAE/sweep")
+"""
+import os
+import copy
+import json
+import itertools
+
+import numpy as np
+import torch
+from torch.func import stack_module_state, functional_call, vmap
+from torch.utils.data import DataLoader
+
+from model import GrooveTransformerEncoderVAE
+from helpers.VAE.train_utils import generate_beta_curve, calculate_hit_loss, calculate_velocity_loss, \
+    calculate_offset_loss, calculate_kld_loss
+
+from logging import getLogger
+logger = getLogger("helpers/VAE/multi_model_sweep.py")
+logger.setLevel("DEBUG")
+
+# keys that must be the same for models to be trained together (everything else may differ between the variants)
+SHARED_KEYS = ('d_model_enc', 'd_model_dec', 'embedding_size_src', 'embedding_size_tgt', 'nhead_enc', 'nhead_dec',
+               'dim_feedforward_enc', 'dim_feedforward_dec', 'num_encoder_layers', 'num_decoder_layers', 'dropout',
+               'latent_dim', 'max_len_enc', 'max_len_dec', 'o_activation', 'velocity_loss_function',
+               'offset_loss_function', 'optimizer', 'batch_size', 'epochs', 'reduce_loss_by_sum')
+
+LOSS_NAMES = ("loss_total", "loss_h", "loss_v", "loss_o", "loss_KL", "loss_KL_beta_scaled", "loss_recon")
+
+
+def get_sweep_configs(base_config, grid):
+    """
+    Cartesian product of a grid of values on top of a base config
+
+    :param base_config: (dict) config shared by all the variants (see train.py for the keys)
+    :param grid: (dict) {key: [values]} e.g. {"seed": [0, 1], "lr": [1e-3, 1e-4]}
+    :return: (list) of configs, each with a "run_name" made from its grid values
+    """
+    configs = []
+    for values in itertools.product(*grid.values()):
+        config = dict(base_config)
+        config.update(dict(zip(grid.keys(), values)))
+        config["run_name"] = "_".join(f"{key}_{value}" for key, value in zip(grid.keys(), values))
+        configs.append(config)
+    return configs
+
+
+def group_configs(configs):
+    """ Groups the configs that can be trained together (same SHARED_KEYS) """
+    groups = dict()
+    for config in configs:
+        key = tuple(config.get(shared_key, None) for shared_key in SHARED_KEYS)
+        groups.setdefault(key, []).append(config)
+    return list(groups.values())
+
+
+class StackedVAETrainer(object):
+    def __init__(self, configs, device="cpu"):
+        """
+        Trains K GrooveTransformerEncoderVAE variants (same architecture) with a single vmapped forward/backward pass
+
+        :param configs: (list) configs of the variants (must agree on SHARED_KEYS)
+        :param device: (str) device to train on
+        """
+        assert len(group_configs(configs)) == 1, f"configs must agree on {SHARED_KEYS} to be trained together"
+        self.configs = [dict(config, device=device) for config in configs]
+        self.device = device
+        self.n_models = len(configs)
+        config = self.configs[0]
+
+        models = []
+        for ix, config_ in enumerate(self.configs):
+            torch.manual_seed(config_.get("seed", ix))
+            models.append(GrooveTransformerEncoderVAE(config_).to(device))
+        self.params, self.buffers = stack_module_state(models)
+        # stateless copy of the architecture, used for the functional calls with the stacked parameters
+        self.base_model = copy.deepcopy(models[0]).to("meta")
+
+        self.lrs = torch.tensor([config_["lr"] for config_ in self.configs], device=device)
+        self.beta_curves = torch.tensor(np.array([generate_beta_curve(
+            n_epochs=config_["epochs"],
+            period_epochs=config_["beta_annealing_per_cycle_period"],
+            rise_ratio=config_["beta_annealing_per_cycle_rising_ratio"],
+            start_first_rise_at_epoch=config_["beta_annealing_start_first_rise_at_epoch"])
+            for config_ in self.configs]), dtype=torch.float32, device=device)
+
+        self.hit_loss_fn = torch.nn.BCEWithLogitsLoss(reduction='none')
+        self.velocity_loss_fn = torch.nn.BCEWithLogitsLoss(reduction='none') \
+            if config["velocity_loss_function"] == "bce" else torch.nn.MSELoss(reduction='none')
+        self.offset_loss_fn = torch.nn.BCEWithLogitsLoss(reduction='none') \
+            if config["offset_loss_function"] == "bce" else torch.nn.MSELoss(reduction='none')
+        self.reduce_by_sum = config.get("reduce_loss_by_sum", False)
+
+        # the optimizer runs with lr=1, the updates are then scaled by the lr of each model (exact for adam and sgd
+        # without weight decay, as their states do not depend on the lr)
+        optimizer_class = torch.optim.Adam if config.get("optimizer", "sgd") == "adam" else torch.optim.SGD
+        self.optimizer = optimizer_class(list(self.params.values()), lr=1.0)
+
+    def _forward(self, inputs):
+        def forward_single_model(params, buffers, inputs_):
+            return functional_call(self.base_model, (params, buffers), (inputs_, ))
+        return vmap(forward_single_model, in_dims=(0, 0, None), randomness="different")(
+            self.params, self.buffers, inputs)
+
+    def _reduce(self, loss):
+        # [K x ...] --> [K]
+        loss = loss.reshape(loss.shape[0], -1)
+        return loss.sum(dim=1) if self.reduce_by_sum else loss.mean(dim=1)
+
+    def _get_losses(self, inputs, outputs, kl_betas, hit_balancing_weights=None, genre_balancing_weights=None):
+        (h_logits, v_logits, o_logits), mu, log_var, latent_z = self._forward(inputs)
+        h_targets, v_targets, o_targets = torch.split(outputs, int(outputs.shape[2] / 3), 2)
+        loss_h = calculate_hit_loss(h_logits, h_targets.unsqueeze(0).expand_as(h_logits), self.hit_loss_fn)
+        loss_v = calculate_velocity_loss(v_logits, v_targets.unsqueeze(0).expand_as(v_logits), self.velocity_loss_fn)
+        loss_o = calculate_offset_loss(o_logits, o_targets.unsqueeze(0).expand_as(o_logits), self.offset_loss_fn)
+        # same weighting as batch_loop (the per sample weights are shared by the K models)
+        if hit_balancing_weights is not None and genre_balancing_weights is not None:
+            weights = (hit_balancing_weights * genre_balancing_weights).unsqueeze(0)
+            loss_h, loss_v, loss_o = loss_h * weights, loss_v * weights, loss_o * weights
+        loss_h, loss_v, loss_o = self._reduce(loss_h), self._reduce(loss_v), self._reduce(loss_o)
+        # same as batch_loop: loss_KL is already scaled by the (per model) kl_beta, loss_KL_beta_scaled is also
+        # weighted by the genre balancing weights
+        loss_KL = calculate_kld_loss(mu, log_var).view(mu.shape[0], mu.shape[1], -1)
+        loss_KL_beta_scaled = loss_KL
+        if genre_balancing_weights is not None:
+            loss_KL_beta_scaled = loss_KL * genre_balancing_weights[:, 0, 0].view(1, -1, 1)
+        loss_KL = kl_betas * self._reduce(loss_KL)
+        loss_KL_beta_scaled = kl_betas * self._reduce(loss_KL_beta_scaled)
+        loss_recon = loss_h + loss_v + loss_o
+        loss_total = loss_recon + loss_KL_beta_scaled
+        return loss_total, loss_h, loss_v, loss_o, loss_KL, loss_KL_beta_scaled, loss_recon
+
+    def _run_epoch(self, dataloader, epoch, train):
+        self.base_model.train(train)
+        kl_betas = self.beta_curves[:, min(epoch, self.beta_curves.shape[1] - 1)]
+        running_sums, n_batches = None, 0
+        for data_tuple in dataloader:
+            inputs, outputs = data_tuple[0].to(self.device), data_tuple[1].to(self.device)
+            # (inputs, outputs, hit weights, genre weights, indices) when the dataset has balancing weights
+            hit_balancing_weights = data_tuple[2].to(self.device) if len(data_tuple) > 4 else None
+            genre_balancing_weights = data_tuple[3].to(self.device) if len(data_tuple) > 4 else None
+            with torch.set_grad_enabled(train):
+                losses = self._get_losses(inputs, outputs, kl_betas, hit_balancing_weights, genre_balancing_weights)
+            if train:
+                # the models are independent, so the gradient of the sum is the gradient of each model's own loss
+                self.optimizer.zero_grad()
+                losses[0].sum().backward()
+                params_before = {name: param.detach().clone() for name, param in self.params.items()}
+                self.optimizer.step()
+                with torch.no_grad():
+                    for name, param in self.params.items():
+                        lrs = self.lrs.view(-1, *([1] * (param.dim() - 1)))
+                        param.copy_(params_before[name] + lrs * (param - params_before[name]))
+            losses = torch.stack([loss.detach() for loss in losses])     # [n_losses x K]
+            running_sums = losses if running_sums is None else running_sums + losses
+            n_batches += 1
+
+        means = (running_sums / max(n_batches, 1)).cpu().numpy()
+        metrics = [{name: float(means[ix, model_ix]) for ix, name in enumerate(LOSS_NAMES)}
+                   for model_ix in range(self.n_models)]
+        for model_ix in range(self.n_models):
+            metrics[model_ix]["kl_beta"] = float(kl_betas[model_ix])
+        return metrics
+
+    def train_epoch(self, dataloader, epoch):
+        """ Trains all the models for one epoch, returns a list of per model metrics ({"loss_total": ...}) """
+        return self._run_epoch(dataloader, epoch, train=True)
+
+    def evaluate(self, dataloader, epoch):
+        """ Evaluates all the models (no gradients), returns a list of per model metrics """
+        return self._run_epoch(dataloader, epoch, train=False)
+
+    def get_model(self, model_ix):
+        """ A regular (unstacked) GrooveTransformerEncoderVAE with the current weights of the model_ix-th variant """
+        model = GrooveTransformerEncoderVAE(self.configs[model_ix])
+        state_dict = {name: tensor[model_ix].detach().clone()
+                      for name, tensor in list(self.params.items()) + list(self.buffers.items())}
+        model.load_state_dict(state_dict)
+        return model.to(self.device)
+
+    def fit(self, train_dataloader, test_dataloader, output_dir, save_model_frequency=10):
+        """
+        Trains all the models, writing per model metrics (metrics.jsonl) and checkpoints to output_dir/run_name/
+
+        :param train_dataloader: (torch.utils.data.DataLoader) training batches (shared by all the models)
+        :param test_dataloader: (torch.utils.data.DataLoader) test batches (or None)
+        :param output_dir: (str) root folder of the outputs
+        :param save_model_frequency: (int) save the models every n epochs (and after the last epoch)
+        :return: (list) final metrics of each model
+        """
+        run_dirs = [os.path.join(output_dir, config.get("run_name", f"model_{ix}"))
+                    for ix, config in enumerate(self.configs)]
+        for run_dir, config in zip(run_dirs, self.configs):
+            os.makedirs(run_dir, exist_ok=True)
+            json.dump(config, open(os.path.join(run_dir, "config.json"), "w"), default=str)
+
+        n_epochs = self.configs[0]["epochs"]
+        for epoch in range(n_epochs):
+            train_metrics = self.train_epoch(train_dataloader, epoch)
+            test_metrics = self.evaluate(test_dataloader, epoch) if test_dataloader is not None else None
+
+            metrics = []
+            for model_ix, run_dir in enumerate(run_dirs):
+                metrics_ = {"epoch": epoch, "kl_beta": train_metrics[model_ix].pop("kl_beta")}
+                metrics_.update({f"train/{key}": value for key, value in train_metrics[model_ix].items()})
+                if test_metrics is not None:
+                    metrics_.update({f"test/{key}": value for key, value in test_metrics[model_ix].items()
+                                     if key != "kl_beta"})
+                with open(os.path.join(run_dir, "metrics.jsonl"), "a") as f:
+                    f.write(json.dumps(metrics_) + "\n")
+                metrics.append(metrics_)
+            logger.info(f"Epoch {epoch}: train/loss_total per model "
+                        f"{[round(m['train/loss_total'], 4) for m in metrics]}")
+
+            if (epoch % save_model_frequency == 0 and epoch > 0) or epoch == n_epochs - 1:
+                for model_ix, run_dir in enumerate(run_dirs):
+                    self.get_model(model_ix).save(os.path.join(run_dir, f"{epoch:03d}.pth"))
+
+        return metrics
+
+
+def run_multi_model_sweep(configs, training_dataset, test_dataset, output_dir, device="cpu",
+                          save_model_frequency=10):
+    """
+    Trains all the configs of a sweep, stacking the ones that can be trained together
+
+    :param configs: (list) configs of the variants (see get_sweep_configs)
+    :param training_dataset: (torch.utils.data.Dataset) loaded once and shared by all the models
+    :param test_dataset: (torch.utils.data.Dataset) shared test set (or None)
+    :param output_dir: (str) root folder of the outputs (one sub folder per run_name)
+    :param device: (str) device to train on
+    :param save_model_frequency: (int) save the models every n epochs
+    :return: (dict) {run_name: final metrics}
+    """
+    results = dict()
+    groups = group_configs(configs)
+    for group_ix, group in enumerate(groups):
+        logger.info(f"Training group {group_ix + 1}/{len(groups)} ({len(group)} models)")
+        batch_size = group[0]["batch_size"]
+        train_dataloader = DataLoader(training_dataset, batch_size=batch_size, shuffle=True)
+        test_dataloader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False) \
+            if test_dataset is not None else None
+        trainer = StackedVAETrainer(group, device=device)
+        final_metrics = trainer.fit(train_dataloader, test_dataloader, output_dir, save_model_frequency)
+        for ix, (config, metrics) in enumerate(zip(trainer.configs, final_metrics)):
+            results[config.get("run_name", f"model_{ix}")] = metrics
+    return results
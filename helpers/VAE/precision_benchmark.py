@@ -0,0 +1,127 @@
+#  Copyright (c) 2022. \n Created by Behzad Haki. behzad.haki@upf.edu
+"""
+Compares bfloat16 (autocast) against float32 training and inference of the VAE models on cpu
+
+For each precision, a copy of the model is trained for a few steps (same data, same initial weights), then the test
+losses and the throughput of training and inference are measured. The report gives the drift of the losses and of the
+predicted hvos relative to float32.
+
+Usage:
+    report = benchmark_precisions(model, train_dataloader, test_dataloader, hit_loss_fn, velocity_loss_fn,
+                                  offset_loss_fn)
+"""
+import copy
+import time
+
+import torch
+
+from helpers.VAE.train_utils import batch_loop, get_autocast_context, PRECISIONS
+
+from logging import getLogger
+logger = getLogger("helpers/VAE/precision_benchmark.py")
+logger.setLevel("DEBUG")
+
+
+def get_training_throughput(model, dataloader, optimizer, loss_fns, device, precision, n_steps):
+    """ Trains for n_steps batches (looping over the dataloader as needed) and returns the number of samples per
+    second """
+    model.train()
+    n_samples, start, steps = 0, time.perf_counter(), 0
+    while steps < n_steps:
+        steps_before_pass = steps
+        for data_tuple in dataloader:
+            if steps == n_steps:
+                break
+            batch_loop([data_tuple], model, *loss_fns, device=device, optimizer=optimizer, precision=precision)
+            n_samples += data_tuple[0].shape[0]
+            steps += 1
+        assert steps > steps_before_pass, "The training dataloader is empty"
+    return n_samples / (time.perf_counter() - start)
+
+
+def predict_batches(model, dataloader, device):
+    """ Predicts (thresholded) the hvos of all the batches using the mean of the latent distribution """
+    model.eval()
+    predictions = []
+    with torch.no_grad():
+        for data_tuple in dataloader:
+            mu, _, _ = model.encode(data_tuple[0].to(device))
+            predictions.append(model.Decoder.decode_and_return_concatenated(mu).float().cpu())
+    return torch.cat(predictions)
+
+
+def get_inference_throughput(model, dataloader, device, precision, n_runs=3):
+    """ Number of samples per second predicted (encoder + decoder) in the given precision """
+    model.eval()
+    n_samples, start = 0, time.perf_counter()
+    with torch.no_grad(), get_autocast_context(device, precision):
+        for _ in range(n_runs):
+            for data_tuple in dataloader:
+                mu, _, _ = model.encode(data_tuple[0].to(device))
+                model.Decoder.decode_and_return_concatenated(mu)
+                n_samples += data_tuple[0].shape[0]
+    return n_samples / (time.perf_counter() - start)
+
+
+def benchmark_precisions(model, train_dataloader, test_dataloader, hit_loss_fn, velocity_loss_fn, offset_loss_fn,
+                         device="cpu", n_train_steps=20, lr=1e-4, precisions=PRECISIONS):
+    """
+    Trains and evaluates copies of a GrooveTransformerEncoderVAE in each precision
+
+    :param model: (GrooveTransformerEncoderVAE) the model (not modified)
+    :param train_dataloader: (torch.utils.data.DataLoader) training batches
+    :param test_dataloader: (torch.utils.data.DataLoader) test batches (should not be shuffled)
+    :param hit_loss_fn: (torch.nn.BCEWithLogitsLoss)
+    :param velocity_loss_fn: (torch.nn.MSELoss or torch.nn.BCEWithLogitsLoss)
+    :param offset_loss_fn: (torch.nn.MSELoss or torch.nn.BCEWithLogitsLoss)
+    :param device: (str) device to run on
+    :param n_train_steps: (int) number of training batches per precision
+    :param lr: (float) learning rate of the Adam optimizer used for the training steps
+    :param precisions: (list) precisions to compare (the first one is the reference, usually fp32)
+    :return: (dict) per precision: train/inference throughput (samples/sec), test losses, and (except for the
+                reference) drift of the test losses and hit agreement/velocity/offset error against the reference
+    """
+    loss_fns = (hit_loss_fn, velocity_loss_fn, offset_loss_fn)
+    report, reference_predictions = dict(), None
+    for precision in precisions:
+        model_ = copy.deepcopy(model).to(device)
+        model_.precision = precision
+        torch.manual_seed(0)
+        optimizer = torch.optim.Adam(model_.parameters(), lr=lr)
+
+        train_throughput = get_training_throughput(
+            model_, train_dataloader, optimizer, loss_fns, device, precision, n_train_steps)
+        model_.eval()
+        torch.manual_seed(0)
+        with torch.no_grad():
+            test_losses = batch_loop(test_dataloader, model_, *loss_fns, device=device, precision=precision)
+        with get_autocast_context(device, precision):
+            predictions = predict_batches(model_, test_dataloader, device)
+
+        report[precision] = {
+            "train_samples_per_sec": train_throughput,
+            "inference_samples_per_sec": get_inference_throughput(model_, test_dataloader, device, precision),
+            "test_losses": {key: float(value) for key, value in test_losses.items()}
+        }
+
+        if reference_predictions is None:
+            reference, reference_predictions = precision, predictions
+            continue
+
+        n_voices = predictions.shape[-1] // 3
+        h, v, o = torch.split(predictions, n_voices, -1)
+        h_ref, v_ref, o_ref = torch.split(reference_predictions, n_voices, -1)
+        hits = (h_ref > 0) & (h > 0)
+        report[precision]["drift"] = {
+            "test_losses": {key: value - report[reference]["test_losses"][key]
+                            for key, value in report[precision]["test_losses"].items()},
+            "hit_agreement": float((h == h_ref).float().mean()),
+            "velocity_mae": float((v - v_ref)[hits].abs().mean()) if hits.any() else 0.0,
+            "offset_mae": float((o - o_ref)[hits].abs().mean()) if hits.any() else 0.0,
+            "train_speedup": train_throughput / report[reference]["train_samples_per_sec"],
+            "inference_speedup": report[precision]["inference_samples_per_sec"] /
+                                 report[reference]["inference_samples_per_sec"]
+        }
+
+    logger.info(f"Precision benchmark: {report}")
+    return report
@@ -0,0 +1,198 @@
+#  Copyright (c) 2022. \n Created by Behzad Haki. behzad.haki@upf.edu
+"""
+Per phase wall time profiling of the training epochs
+
+PhaseProfiler records the wall time of named phases (e.g. train/data_loading, train/forward, train/backward,
+media/umap, hit_scores/test, ...), the number of samples per phase group (train/test) and the peak memory of each
+epoch. The summary of each epoch is appended to profile.jsonl and profile.csv in the output folder. A torch.profiler
+Chrome trace (chrome://tracing or https://ui.perfetto.dev) can also be recorded for a window of epochs, the phases
+then show up as labelled ranges in the trace.
+
+On cuda, the phases synchronize the device when they end (so that the asynchronous kernels are attributed to the
+right phase), which slows the training down a little. When disabled, phase() returns a shared no-op context, so the
+instrumentation costs close to nothing.
+
+Usage:
+    profiler = PhaseProfiler(output_dir, device="cpu", trace_epochs=(2, 3))
+    for epoch in range(n_epochs):
+        profiler.start_epoch(epoch)
+        train_loop(..., profiler=profiler)
+        with profiler.phase("media/umap"):
+            ...
+        summary = profiler.end_epoch()
+    profiler.close()
+"""
+import os
+import csv
+import json
+import time
+import contextlib
+import collections
+
+import torch
+
+from logging import getLogger
+logger = getLogger("helpers/VAE/profiling.py")
+logger.setLevel("DEBUG")
+
+try:
+    import resource
+    _has_resource = True
+except ImportError:
+    _has_resource = False
+
+_null_context = contextlib.nullcontext()
+
+
+def get_peak_rss_mb():
+    """ Peak resident memory of the process so far (MB), None if not available on this platform """
+    if not _has_resource:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+class PhaseProfiler(object):
+    def __init__(self, output_dir=None, device="cpu", enabled=True, trace_epochs=None):
+        """
+        Wall time per phase, samples/sec and peak memory per epoch
+
+        :param output_dir: (str) folder for profile.jsonl, profile.csv and the traces (None to not export)
+        :param device: (str or torch.device) device of the training (cuda devices are synchronized after each phase)
+        :param enabled: (bool) if False, nothing is recorded
+        :param trace_epochs: (tuple) (first, last) epochs (inclusive) to record in a torch.profiler Chrome trace
+                            (None for no trace)
+        """
+        self.output_dir = output_dir
+        self.enabled = enabled
+        self.trace_epochs = trace_epochs
+        device = torch.device(device)
+        self.synchronize = device.type == "cuda" and torch.cuda.is_available()
+        self.device = device
+        self.epoch = None
+        self.summaries = []
+        self._torch_profiler = None
+        self._reset()
+        if output_dir is not None and enabled:
+            os.makedirs(output_dir, exist_ok=True)
+
+    def _reset(self):
+        self.phase_times = collections.OrderedDict()
+        self.phase_counts = collections.defaultdict(int)
+        self.samples = collections.defaultdict(int)
+        self.epoch_start = time.perf_counter()
+
+    def start_epoch(self, epoch):
+        """ Resets the counters (and starts the Chrome trace at the first epoch of trace_epochs) """
+        if not self.enabled:
+            return
+        self.epoch = epoch
+        self._reset()
+        if self.synchronize:
+            torch.cuda.reset_peak_memory_stats(self.device)
+        if self.trace_epochs is not None and epoch == self.trace_epochs[0] and self._torch_profiler is None:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.synchronize:
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self._torch_profiler = torch.profiler.profile(activities=activities, record_shapes=True)
+            self._torch_profiler.__enter__()
+            logger.info(f"Recording a torch.profiler trace of epochs {self.trace_epochs[0]} to {self.trace_epochs[1]}")
+
+    @contextlib.contextmanager
+    def _timed_phase(self, name):
+        record_function = torch.profiler.record_function(name) if self._torch_profiler is not None else _null_context
+        start = time.perf_counter()
+        with record_function:
+            yield
+            if self.synchronize:
+                torch.cuda.synchronize(self.device)
+        self.phase_times[name] = self.phase_times.get(name, 0.0) + time.perf_counter() - start
+        self.phase_counts[name] += 1
+
+    def phase(self, name):
+        """ Context manager timing a phase (times of phases with the same name are summed over the epoch) """
+        if not self.enabled:
+            return _null_context
+        return self._timed_phase(name)
+
+    def iterate(self, name, iterable):
+        """ Yields the items of iterable, timing the fetching of each item as the phase name (e.g. data loading) """
+        if not self.enabled:
+            yield from iterable
+            return
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def add_samples(self, n_samples, group="train"):
+        """ Counts the samples processed by a group of phases (group/...) for the samples/sec of the group """
+        if self.enabled:
+            self.samples[group] += int(n_samples)
+
+    def end_epoch(self):
+        """
+        Summary of the epoch (also exported to output_dir)
+
+        :return: (dict) {"epoch", "epoch_sec", "{phase}_sec", "{phase}_count", "{group}/samples",
+                        "{group}/samples_per_sec", "peak_rss_mb", "peak_cuda_memory_mb"} or None if disabled
+        """
+        if not self.enabled:
+            return None
+        summary = {"epoch": self.epoch, "epoch_sec": time.perf_counter() - self.epoch_start}
+        for name, seconds in self.phase_times.items():
+            summary[f"{name}_sec"] = seconds
+            summary[f"{name}_count"] = self.phase_counts[name]
+        for group, n_samples in self.samples.items():
+            group_seconds = sum(seconds for name, seconds in self.phase_times.items() if name.startswith(f"{group}/"))
+            summary[f"{group}/samples"] = n_samples
+            summary[f"{group}/samples_per_sec"] = n_samples / group_seconds if group_seconds > 0 else None
+        summary["peak_rss_mb"] = get_peak_rss_mb()
+        if self.synchronize:
+            summary["peak_cuda_memory_mb"] = torch.cuda.max_memory_allocated(self.device) / 2 ** 20
+
+        if self._torch_profiler is not None and self.epoch >= self.trace_epochs[1]:
+            self._stop_trace()
+
+        self.summaries.append(summary)
+        self.export(summary)
+        return summary
+
+    def _stop_trace(self):
+        self._torch_profiler.__exit__(None, None, None)
+        if self.output_dir is not None:
+            last_epoch = min(self.epoch, self.trace_epochs[1])
+            trace_path = os.path.join(self.output_dir, f"trace_epochs_{self.trace_epochs[0]}_{last_epoch}.json")
+            self._torch_profiler.export_chrome_trace(trace_path)
+            logger.info(f"Chrome trace saved to {trace_path}")
+        self._torch_profiler = None
+
+    def close(self):
+        """ Stops and exports the Chrome trace if it is still recording (training ended before trace_epochs[1]) """
+        if self._torch_profiler is not None:
+            self._stop_trace()
+
+    def export(self, summary):
+        """
+        Appends the summary to profile.jsonl and rewrites profile.csv from all the lines of profile.jsonl (so that
+        the csv also holds the epochs before a resumed run, phases may differ between epochs)
+        """
+        if self.output_dir is None:
+            return
+        jsonl_path = os.path.join(self.output_dir, "profile.jsonl")
+        with open(jsonl_path, "a") as f:
+            f.write(json.dumps(summary) + "\n")
+        with open(jsonl_path, "r") as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+        fieldnames = list(dict.fromkeys(key for row in rows for key in row.keys()))
+        with open(os.path.join(self.output_dir, "profile.csv"), "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames)
+            writer.writeheader()
+            writer.writerows(rows)
+
+    def get_wandb_metrics(self, summary):
+        """ The summary with the keys prefixed by profile/ (for wandb.log) """
+        return {f"profile/{key}": value for key, value in summary.items() if key != "epoch" and value is not None}
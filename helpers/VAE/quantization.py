@@ -0,0 +1,253 @@
+#  Copyright (c) 2022. \n Created by Behzad Haki. behzad.haki@upf.edu
+"""
+Dynamic int8 quantization of the VAE models (GrooveTransformerEncoderVAE, Density1D, Density2D) for cpu inference
+
+The weights of all the Linear layers (input/latent/output layers and the feedforward blocks of the transformers) are
+stored as int8, and the activations are quantized on the fly. Before exporting, the quantized model is validated
+against the float model on a test set (hit F1, velocity MSE and offset MSE computed with the Evaluator), and the
+export is refused if the quantized model regresses beyond the given tolerances.
+
+Usage:
+    evaluator = load_evaluator_template("data/dataset_json_settings/4_4_Beats_gmd.json", "test", 0.1)
+    report = export_quantized_model(model, "path/to/quantized_model.pth", evaluator)
+    quantized_model = load_quantized_model("path/to/quantized_model.pth")
+"""
+import os
+import copy
+import time
+
+import numpy as np
+import torch
+
+from model import GrooveTransformerEncoderVAE, Density1D, Density2D
+from data.control.control_utils import calculate_density
+
+from logging import getLogger
+logger = getLogger("helpers/VAE/quantization.py")
+logger.setLevel("DEBUG")
+
+QUANTIZABLE_MODEL_CLASSES = {cls.__name__: cls for cls in (GrooveTransformerEncoderVAE, Density1D, Density2D)}
+
+
+class QuantizationAccuracyError(Exception):
+    """ Raised when the quantized model regresses beyond the tolerances (the report is in .report) """
+    def __init__(self, message, report):
+        super(QuantizationAccuracyError, self).__init__(message)
+        self.report = report
+
+
+def _skip_fast_path_hook(module, inputs):
+    return None
+
+
+def _quantize_linear_layers(model):
+    quantized_model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    # In eval mode, TransformerEncoderLayer checks the weights of its linear layers to decide whether it can use its
+    # fused (fast path) kernel, which fails for quantized layers. The fast path is skipped if the layer has hooks.
+    for module in quantized_model.modules():
+        if isinstance(module, torch.nn.TransformerEncoderLayer):
+            module.register_forward_pre_hook(_skip_fast_path_hook)
+    return quantized_model
+
+
+def quantize_dynamic_int8(model):
+    """
+    Returns a dynamically quantized (int8 Linear layers) copy of the model. The original model is not modified.
+
+    :param model: (GrooveTransformerEncoderVAE, Density1D or Density2D) the float model
+    :return: the quantized model (cpu only, eval mode)
+    """
+    assert type(model).__name__ in QUANTIZABLE_MODEL_CLASSES, f"{type(model).__name__} can not be quantized"
+    return _quantize_linear_layers(copy.deepcopy(model).cpu().eval())
+
+
+def is_density_model(model):
+    return isinstance(model, (Density1D, Density2D))
+
+
+# ---------------------------------------------------------------------------------------------------
+# ------------                 VALIDATION                        ------------------------------------
+# ---------------------------------------------------------------------------------------------------
+def get_model_inputs(model, hvo_sequences, collapse_tapped_sequence=False, normalizing_fn=None):
+    """
+    Prepares the inputs of a model for a list of hvo sequences (the control params of the density models are the
+    densities of the sequences)
+
+    :param model: the model
+    :param hvo_sequences: (list) HVO_Sequence objects
+    :param collapse_tapped_sequence: (bool) whether the tapped sequence is collapsed (input will have 1 voice only)
+    :param normalizing_fn: (function) normalizing function for the densities (only for density models)
+    :return: (in_grooves, params) params is None if the model is not a density model
+    """
+    in_grooves = torch.tensor(np.array([hvo_seq.flatten_voices(reduce_dim=collapse_tapped_sequence)
+                                        for hvo_seq in hvo_sequences]), dtype=torch.float32)
+    if not is_density_model(model):
+        return in_grooves, None
+
+    densities = [calculate_density(hvo_seq.hits) for hvo_seq in hvo_sequences]
+    if normalizing_fn is not None:
+        densities = [normalizing_fn(density) for density in densities]
+    return in_grooves, torch.tensor(densities, dtype=torch.float32)
+
+
+def predict_using_latent_mean(model, in_grooves, params=None, thres=0.5, batch_size=64):
+    """
+    Predicts the hvos by decoding the mean of the latent distribution (rather than a sampled z), so that two models
+    can be compared without the sampling noise
+
+    :param model: the model
+    :param in_grooves: (torch.Tensor) [N x max_len_enc x embedding_size_src] inputs
+    :param params: (torch.Tensor) [N] control params (only for density models)
+    :param thres: (float) threshold for hits
+    :param batch_size: (int) batch size used for inference
+    :return: (np.ndarray) [N x max_len_dec x embedding_size_tgt] predicted hvos
+    """
+    device = next(model.parameters()).device
+    predictions = []
+    with torch.no_grad():
+        for batch_ix in range(0, in_grooves.shape[0], batch_size):
+            src = in_grooves[batch_ix:batch_ix + batch_size].to(device)
+            if params is None:
+                mu, _, _ = model.encode(src)
+            else:
+                mu, _, _ = model.encode(src, params[batch_ix:batch_ix + batch_size].to(device))
+            hvo = model.Decoder.decode_and_return_concatenated(mu, threshold=thres)
+            predictions.append(hvo.cpu().numpy())
+    return np.concatenate(predictions)
+
+
+def get_accuracy_scores(evaluator, predictions):
+    """
+    Computes hit F1, velocity MSE and offset MSE of the predictions using an evaluator. The predictions are added
+    to a copy of the evaluator, so the same evaluator can be reused to score other models
+
+    :param evaluator: (Evaluator) evaluator (e.g. load_evaluator_template) holding the ground truth samples
+    :param predictions: (np.ndarray) [N x max_len x embedding_size_tgt] predictions (same order as the ground truth)
+    :return: (dict) {"hit_f1": float, "velocity_mse": float, "offset_mse": float}
+    """
+    evaluator = copy.deepcopy(evaluator)
+    evaluator.add_predictions(predictions)
+    hit_scores = evaluator.get_pos_neg_hit_scores()
+    return {
+        "hit_f1": float(np.mean(hit_scores["Relative - F1_Score"])),
+        "velocity_mse": float(evaluator.get_velocity_MSE()),
+        "offset_mse": float(evaluator.get_offset_MSE())
+    }
+
+
+def get_single_request_latency_ms(model, in_grooves, params=None, n_runs=50):
+    """ Median latency (ms) of encoding and decoding a single input """
+    src = in_grooves[:1].to(next(model.parameters()).device)
+    params_ = params[:1].to(src.device) if params is not None else None
+    latencies = []
+    with torch.no_grad():
+        for run_ix in range(n_runs + 5):
+            start = time.perf_counter()
+            mu, _, _ = model.encode(src) if params_ is None else model.encode(src, params_)
+            model.Decoder.decode_and_return_concatenated(mu)
+            if run_ix >= 5:     # first few runs are warm up
+                latencies.append((time.perf_counter() - start) * 1000.0)
+    return float(np.median(latencies))
+
+
+def validate_quantized_model(float_model, quantized_model, evaluator, collapse_tapped_sequence=False,
+                             normalizing_fn=None, thres=0.5, hit_f1_tolerance=0.01, velocity_mse_tolerance=0.002,
+                             offset_mse_tolerance=0.002):
+    """
+    Compares a quantized model against its float version on the ground truth samples of an evaluator
+
+    :param float_model: the float model
+    :param quantized_model: the quantized model (see quantize_dynamic_int8)
+    :param evaluator: (Evaluator) evaluator (e.g. load_evaluator_template) holding the test samples
+    :param collapse_tapped_sequence: (bool) whether the tapped sequence is collapsed (input will have 1 voice only)
+    :param normalizing_fn: (function) normalizing function for the densities (only for density models)
+    :param thres: (float) threshold for hits
+    :param hit_f1_tolerance: (float) maximum allowed drop of the hit F1 score
+    :param velocity_mse_tolerance: (float) maximum allowed increase of the velocity MSE
+    :param offset_mse_tolerance: (float) maximum allowed increase of the offset MSE
+    :return: (dict) report with the "float"/"quantized" scores, the "latency_ms" of a single request for both models
+                and "passed" (True if the quantized model is within the tolerances)
+    """
+    float_model = float_model.eval()
+    in_grooves, params = get_model_inputs(
+        float_model, evaluator.get_ground_truth_hvo_sequences(), collapse_tapped_sequence, normalizing_fn)
+
+    float_scores = get_accuracy_scores(evaluator, predict_using_latent_mean(float_model, in_grooves, params, thres))
+    quantized_scores = get_accuracy_scores(
+        evaluator, predict_using_latent_mean(quantized_model, in_grooves, params, thres))
+
+    tolerances = {"hit_f1": hit_f1_tolerance, "velocity_mse": velocity_mse_tolerance,
+                  "offset_mse": offset_mse_tolerance}
+    regressions = {
+        "hit_f1": float_scores["hit_f1"] - quantized_scores["hit_f1"],
+        "velocity_mse": quantized_scores["velocity_mse"] - float_scores["velocity_mse"],
+        "offset_mse": quantized_scores["offset_mse"] - float_scores["offset_mse"]
+    }
+
+    float_model_cpu = copy.deepcopy(float_model).cpu().eval()
+    report = {
+        "float": float_scores,
+        "quantized": quantized_scores,
+        "regressions": regressions,
+        "tolerances": tolerances,
+        "latency_ms": {
+            "float": get_single_request_latency_ms(float_model_cpu, in_grooves, params),
+            "quantized": get_single_request_latency_ms(quantized_model, in_grooves, params)
+        },
+        "passed": all(regressions[key] <= tolerances[key] for key in tolerances.keys())
+    }
+    logger.info(f"Quantization report: {report}")
+    return report
+
+
+# ---------------------------------------------------------------------------------------------------
+# ------------                 EXPORT / LOAD                     ------------------------------------
+# ---------------------------------------------------------------------------------------------------
+def export_quantized_model(model, save_path, evaluator, force=False, **validation_kwargs):
+    """
+    Quantizes a model, validates it against the float model and saves it if it is within the tolerances
+
+    :param model: (GrooveTransformerEncoderVAE, Density1D or Density2D) the float model
+    :param save_path: (str) path of the .pth file
+    :param evaluator: (Evaluator) evaluator (e.g. load_evaluator_template) holding the test samples
+    :param force: (bool) if True, the model is saved even if it regresses beyond the tolerances
+    :param validation_kwargs: additional arguments for validate_quantized_model (tolerances, normalizing_fn, ...)
+    :return: (dict) the validation report (see validate_quantized_model)
+    """
+    quantized_model = quantize_dynamic_int8(model)
+    report = validate_quantized_model(model, quantized_model, evaluator, **validation_kwargs)
+
+    if not report["passed"]:
+        if not force:
+            raise QuantizationAccuracyError(
+                f"Quantized model regresses beyond the tolerances: {report['regressions']}", report)
+        logger.warning(f"Saving the quantized model although it regresses: {report['regressions']}")
+
+    if not save_path.endswith('.pth'):
+        save_path += '.pth'
+    if os.path.dirname(save_path) != "":
+        os.makedirs(os.path.dirname(save_path), exist_ok=True)
+
+    params_dict = model.get_params_dict()
+    params_dict['device'] = 'cpu'
+    torch.save({'model_state_dict': quantized_model.state_dict(), 'params': params_dict,
+                'model_class': type(model).__name__, 'quantization': 'dynamic_qint8_linear',
+                'validation_report': report}, save_path)
+    logger.info(f"Quantized model saved at {save_path}")
+    return report
+
+
+def load_quantized_model(model_path):
+    """
+    Loads a model exported with export_quantized_model
+
+    :param model_path: (str) path of the .pth file
+    :return: the quantized model (cpu, eval mode)
+    """
+    loaded_dict = torch.load(model_path, map_location=torch.device('cpu'))
+    assert loaded_dict.get('quantization', None) == 'dynamic_qint8_linear', f"{model_path} is not a quantized model"
+
+    model = QUANTIZABLE_MODEL_CLASSES[loaded_dict['model_class']](loaded_dict['params']).eval()
+    model = _quantize_linear_layers(model)
+    model.load_state_dict(loaded_dict['model_state_dict'])
+    return model
@@ -0,0 +1,317 @@
+#  Copyright (c) 2022. \n Created by Behzad Haki. behzad.haki@upf.edu
+"""
+Streaming (tap by tap) inference for the groove VAE
+
+In live use the taps arrive one step at a time. A TapStreamSession keeps the current tapped buffer and only runs the
+model when a step actually changes. The results are memoized per buffer content (so going back to an already seen
+partial buffer, e.g. when a loop restarts, is free). Optionally, a deadline can be set: if the model does not finish
+in time, the last latent of the current pattern (or the prior mean z = 0 for the first taps after reset()) is decoded
+(decoder only, much cheaper than a full encode) and returned as stale, and the fresh result is cached once ready.
+
+The encoder attends over the whole 2 bar input, so every change requires a full re-encode; the savings come from
+skipping unchanged steps and from the memoized buffers.
+
+simulate_tap_stream() replays the tap timings of hvo sequences deterministically, so that the latency of a session
+can be benchmarked offline.
+"""
+import time
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+import numpy as np
+import torch
+
+from logging import getLogger
+logger = getLogger("helpers/VAE/streaming.py")
+logger.setLevel("DEBUG")
+
+
+StreamResult = collections.namedtuple("StreamResult", ["hvo", "latent_z", "from_cache", "is_stale", "latency_ms"])
+"""
+hvo: (np.ndarray) (max_len_dec, embedding_size_tgt) predicted groove
+latent_z: (np.ndarray) (latent_dim) latent of the predicted groove
+from_cache: (bool) True if the result was memoized (no inference was run)
+is_stale: (bool) True if the deadline was missed and the last latent of the pattern (or the prior mean z = 0) was
+            decoded instead
+latency_ms: (float) time spent in get_result()
+"""
+
+
+class TapStreamSession(object):
+    def __init__(self, model, voice_thresholds=None, voice_max_count_allowed=None, sampling_mode=0,
+                 temperature=1.0, deadline_ms=None, cache_size=512, tapped_voice_idx=2):
+        """
+        Keeps the tapped buffer of a live session and runs the model only when needed
+
+        :param model: (GrooveTransformerEncoderVAE) the model (see load_variational_mgt_model)
+        :param voice_thresholds: (list) [num_voices] thresholds for hit prediction (default: 0.5)
+        :param voice_max_count_allowed: (list) [num_voices] maximum number of hits per voice (default: no limit)
+        :param sampling_mode: (int) 0 for top-k sampling, 1 for bernoulli sampling
+                    (with bernoulli sampling, memoized buffers always return the same sample)
+        :param temperature: (float) temperature for sampling
+        :param deadline_ms: (float) if given, get_result() returns within this deadline (plus the time of one decoder
+                    pass), falling back to decoding the last latent (or the prior mean z = 0 if there is none since
+                    the last reset) if the model is not done in time (None: always wait for the model)
+        :param cache_size: (int) number of buffers whose results are memoized (least recently used are dropped)
+        :param tapped_voice_idx: (int) voice in which the taps are placed (ignored if the model takes Tx3 inputs)
+        """
+        self.model = model.eval()
+        self.device = next(model.parameters()).device
+        self.n_voices = model.embedding_size_tgt // 3
+        self.collapsed_input = model.embedding_size_src == 3
+        self.tapped_voice_idx = 0 if self.collapsed_input else tapped_voice_idx
+        self.n_input_voices = model.embedding_size_src // 3
+        self.buffer = np.zeros((model.max_len_enc, model.embedding_size_src), dtype=np.float32)
+
+        self.deadline_ms = deadline_ms
+        self.cache_size = cache_size
+        self._cache = collections.OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._state_lock = threading.Lock()       # guards _last_latent, _pending and _generation
+        self._last_latent = None                    # latent of the last result of the current pattern
+        self._pending = dict()
+        self._generation = 0                        # incremented by reset() (results of older patterns are ignored)
+        self._executor = ThreadPoolExecutor(max_workers=1) if deadline_ms is not None else None
+
+        self.set_sampling_params(voice_thresholds, voice_max_count_allowed, sampling_mode, temperature)
+
+    def set_sampling_params(self, voice_thresholds=None, voice_max_count_allowed=None, sampling_mode=0,
+                            temperature=1.0):
+        """ Changes the sampling parameters (clears the memoized results) """
+        self.voice_thresholds = torch.tensor(
+            voice_thresholds if voice_thresholds is not None else [0.5] * self.n_voices, dtype=torch.float32)
+        self.voice_max_count_allowed = torch.tensor(
+            voice_max_count_allowed if voice_max_count_allowed is not None
+            else [self.model.max_len_dec] * self.n_voices, dtype=torch.float32)
+        self.sampling_mode = sampling_mode
+        self.temperature = temperature
+        with self._cache_lock:
+            self._cache.clear()
+
+    # ---------------------------------------------------
+    # Buffer
+    # ---------------------------------------------------
+    def set_step(self, step, velocity=1.0, offset=0.0, hit=True):
+        """
+        Sets (or clears if hit is False) the tap at a given step
+
+        :param step: (int) step index (wrapped around the buffer length)
+        :param velocity: (float) velocity of the tap [0, 1]
+        :param offset: (float) offset of the tap [-0.5, 0.5]
+        :param hit: (bool) False to clear the step
+        :return: (bool) True if the buffer changed
+        """
+        step = step % self.buffer.shape[0]
+        v_ix, o_ix = self.tapped_voice_idx + self.n_input_voices, self.tapped_voice_idx + 2 * self.n_input_voices
+        new_values = (1.0, velocity, offset) if hit else (0.0, 0.0, 0.0)
+        old_values = (self.buffer[step, self.tapped_voice_idx], self.buffer[step, v_ix], self.buffer[step, o_ix])
+        new_values = tuple(np.float32(value) for value in new_values)
+        if new_values == old_values:
+            return False
+        self.buffer[step, self.tapped_voice_idx], self.buffer[step, v_ix], self.buffer[step, o_ix] = new_values
+        return True
+
+    def clear_step(self, step):
+        return self.set_step(step, hit=False)
+
+    def reset(self):
+        """ Clears the buffer and forgets the last latent, so that a new pattern never falls back to the groove of
+        the previous one (memoized results are kept) """
+        self.buffer[:] = 0
+        with self._state_lock:
+            self._last_latent = None
+            self._generation += 1
+
+    # ---------------------------------------------------
+    # Inference
+    # ---------------------------------------------------
+    def _decode(self, latent_z):
+        h, v, o, _ = self.model.sample(
+            latent_z, self.voice_thresholds.to(self.device), self.voice_max_count_allowed.to(self.device),
+            sampling_mode=self.sampling_mode, temperature=self.temperature)
+        return torch.cat((h, v, o), dim=-1)[0].cpu().numpy()
+
+    def _run_model(self, buffer):
+        with torch.no_grad():
+            src = torch.tensor(buffer, device=self.device)[None, :, :]
+            _, _, latent_z = self.model.encode(src)
+            hvo = self._decode(latent_z)
+        return hvo, latent_z[0].cpu().numpy()
+
+    def _decode_fallback(self, latent_z):
+        # decoder only (no encode), for when the deadline is missed
+        if latent_z is None:
+            latent_z = np.zeros(self.model.latent_dim, dtype=np.float32)
+        with torch.no_grad():
+            hvo = self._decode(torch.tensor(latent_z, device=self.device)[None, :])
+        return hvo, latent_z
+
+    def _store(self, key, result):
+        with self._cache_lock:
+            self._cache[key] = result
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _lookup(self, key):
+        with self._cache_lock:
+            if key not in self._cache:
+                return None
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+    def _on_done(self, key, generation, future):
+        # runs on the executor thread (or on the caller thread if the future is already done)
+        with self._state_lock:
+            if self._pending.get(key) is future:
+                del self._pending[key]
+        if future.cancelled():
+            return
+        if future.exception() is None:
+            self._store(key, future.result())
+            with self._state_lock:
+                if generation == self._generation:
+                    self._last_latent = future.result()[1]
+        else:
+            logger.error(f"Streaming inference failed: {future.exception()}")
+
+    def get_result(self):
+        """
+        Gets the prediction for the current buffer
+
+        :return: (StreamResult) (see the definition of StreamResult)
+        """
+        start = time.perf_counter()
+        key = self.buffer.tobytes()
+
+        cached = self._lookup(key)
+        if cached is not None:
+            hvo, latent_z = cached
+            with self._state_lock:
+                self._last_latent = latent_z
+            return StreamResult(hvo, latent_z, True, False, (time.perf_counter() - start) * 1000.0)
+
+        if self._executor is None:
+            result = self._run_model(self.buffer.copy())
+            self._store(key, result)
+        else:
+            is_new, outdated_futures = False, []
+            with self._state_lock:
+                future = self._pending.get(key)
+                if future is None:
+                    # the buffer has changed since, so the queued (not started) inferences are not needed anymore
+                    outdated_futures = list(self._pending.values())
+                    future = self._executor.submit(self._run_model, self.buffer.copy())
+                    self._pending[key] = future
+                    generation, is_new = self._generation, True
+            # (outside of the lock: cancel() and add_done_callback() of a done future run _on_done right away)
+            for outdated_future in outdated_futures:
+                outdated_future.cancel()
+            if is_new:
+                future.add_done_callback(lambda f, k=key, g=generation: self._on_done(k, g, f))
+            remaining = self.deadline_ms / 1000.0 - (time.perf_counter() - start)
+            try:
+                result = future.result(timeout=max(remaining, 0))
+            except TimeoutError:
+                with self._state_lock:
+                    last_latent = self._last_latent
+                hvo, latent_z = self._decode_fallback(last_latent)
+                return StreamResult(hvo, latent_z, False, True, (time.perf_counter() - start) * 1000.0)
+
+        with self._state_lock:
+            self._last_latent = result[1]
+        return StreamResult(result[0], result[1], False, False, (time.perf_counter() - start) * 1000.0)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+
+
+# --------------------------------------------------------------------------------
+# ------------                 SIMULATION                    ---------------------
+# --------------------------------------------------------------------------------
+def get_tap_events(hvo_sequence):
+    """
+    Gets the taps of a (flattened) hvo sequence in the order they would be played
+
+    :param hvo_sequence: (HVO_Sequence) the sequence to tap
+    :return: (list) of (time_sec, step, velocity, offset) tuples sorted by time
+    """
+    tapped = hvo_sequence.flatten_voices(reduce_dim=True)
+    n_steps = tapped.shape[0]
+    grid_lines = np.array(hvo_sequence.grid_maker.get_grid_lines(n_steps + 1)[:n_steps + 1])
+    step_durations = np.diff(grid_lines)
+
+    events = []
+    for step in np.flatnonzero(tapped[:, 0]):
+        offset = float(tapped[step, 2])
+        events.append((float(grid_lines[step] + offset * step_durations[step]), int(step),
+                       float(tapped[step, 1]), offset))
+    return sorted(events)
+
+
+def simulate_tap_stream(session, hvo_sequences, n_loops=2, realtime=False):
+    """
+    Replays the taps of hvo sequences through a session (one sequence after the other, each looped n_loops times,
+    a new sequence starts from an empty buffer) and benchmarks the latency of the session
+
+    The replay is deterministic: the taps are fed in the order of their timing. If realtime is True, the actual tap
+    timings are also respected (waits until each tap is due), otherwise the taps are fed as fast as possible.
+
+    :param session: (TapStreamSession) the session to benchmark
+    :param hvo_sequences: (list) list of HVO_Sequence objects (e.g. loaded with load_gmd_hvo_sequences)
+    :param n_loops: (int) number of times each sequence is looped (the loops after the first one hit the cache)
+    :param realtime: (bool) if True, the taps are fed at their actual timings
+    :return: (dict) latency percentiles (ms), number of taps, cache hits and stale results
+    """
+    latencies_ms = []
+    n_taps, n_cache_hits, n_stale = 0, 0, 0
+
+    for hvo_sequence in hvo_sequences:
+        session.reset()
+        events = get_tap_events(hvo_sequence)
+        if not events:
+            continue
+        loop_duration = hvo_sequence.grid_maker.get_grid_lines(len(hvo_sequence.hvo) + 1)[len(hvo_sequence.hvo)]
+
+        start = time.perf_counter()
+        for loop_ix in range(n_loops):
+            for tap_time, step, velocity, offset in events:
+                if realtime:
+                    time.sleep(max(0.0, start + loop_ix * loop_duration + tap_time - time.perf_counter()))
+                session.set_step(step, velocity=velocity, offset=offset)
+                result = session.get_result()
+                n_taps += 1
+                latencies_ms.append(result.latency_ms)
+                n_cache_hits += int(result.from_cache)
+                n_stale += int(result.is_stale)
+
+    latencies_ms = np.array(latencies_ms)
+    summary = {"num_taps": n_taps, "num_cache_hits": n_cache_hits, "num_stale": n_stale}
+    for q in (50, 90, 99):
+        summary[f"latency_p{q}_ms"] = float(np.percentile(latencies_ms, q)) if latencies_ms.size > 0 else None
+    return summary
+
+
+def check_deadline_fallback(model, deadline_ms=0.0):
+    """
+    Checks that a session with a (practically) zero deadline returns a stale StreamResult on its first call (no
+    latent yet, so the prior mean is decoded) and after a reset()
+
+    :param model: (GrooveTransformerEncoderVAE) the model
+    :param deadline_ms: (float) the deadline of the session
+    :return: (StreamResult) the result of the first call
+    """
+    session = TapStreamSession(model, deadline_ms=deadline_ms)
+    try:
+        session.set_step(0)
+        first_result = session.get_result()
+        assert isinstance(first_result, StreamResult), f"get_result() returned {first_result} instead of a StreamResult"
+        session.reset()
+        session.set_step(4)
+        result = session.get_result()
+        assert isinstance(result, StreamResult), f"get_result() returned {result} after reset()"
+    finally:
+        session.close()
+    return first_result
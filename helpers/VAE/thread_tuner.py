@@ -0,0 +1,358 @@
+#  Copyright (c) 2022. \n Created by Behzad Haki. behzad.haki@upf.edu
+"""
+Batch size and thread count tuning for cpu training and inference
+
+The throughput of the (small) groove transformers on cpu depends a lot on the batch size, on the number of intra-op
+threads (torch.set_num_threads) and on the number of inter-op threads (torch.set_num_interop_threads). The tuner
+benchmarks a model (GrooveTransformerEncoderVAE, Density1D or Density2D) on synthetic batches over a grid of these
+settings, for training steps (forward + losses + backward + Adam step) and for inference (forward without grads),
+and writes the fastest settings to a profile of the machine:
+
+    misc/machine_profiles/{hostname}_{n_cores}cores.json
+        {"machine": {...},
+         "profiles": {"vae": {"train": {"batch_size", "num_threads", "interop_threads", "samples_per_sec"},
+                              "inference": {...},
+                              "model_config": {...}, "results": [every measurement]},
+                      "density_1d": {...}}}
+
+train.py, train_density.py and the inference server pick up the profile of the machine they run on (--machine_profile
+auto): the thread counts are applied when training/serving on cpu, the batch size only if asked for. A profile is only
+used if it was tuned for the same architecture (ARCHITECTURE_KEYS of the model config), otherwise a warning is logged.
+
+The inter-op thread count can only be set once per process (before any inter-op work), so every inter-op setting is
+benchmarked in its own (spawned) process.
+
+Usage:
+    python helpers/VAE/thread_tuner.py --model_type vae --batch_sizes 16 32 64 128 --num_threads 1 2 4 8
+    # None if the machine has no profile for this architecture
+    entry = apply_machine_profile("train", model_type="vae", model_config=config)
+"""
+import os
+import json
+import time
+import socket
+import platform
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+
+from logging import getLogger
+logger = getLogger("helpers/VAE/thread_tuner.py")
+logger.setLevel("DEBUG")
+
+MODEL_TYPES = ("vae", "density_1d", "density_2d")
+MODES = ("train", "inference")
+# keys of the model config that must match for a profile to be used (the throughput depends on the architecture)
+ARCHITECTURE_KEYS = ("d_model_enc", "d_model_dec", "nhead_enc", "nhead_dec", "dim_feedforward_enc",
+                     "dim_feedforward_dec", "num_encoder_layers", "num_decoder_layers", "latent_dim", "max_len_enc",
+                     "max_len_dec", "embedding_size_src", "embedding_size_tgt")
+DEFAULT_PROFILE_DIR = "misc/machine_profiles"
+
+
+# ---------------------------------------------------------------------------------------------------
+# ------------                 MACHINE                           ------------------------------------
+# ---------------------------------------------------------------------------------------------------
+def get_available_cores():
+    """ Number of cores this process may run on (affinity aware) """
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def get_machine_info():
+    """ Description of the machine the profile belongs to """
+    return {
+        "hostname": socket.gethostname(),
+        "available_cores": get_available_cores(),
+        "cpu_count": os.cpu_count(),
+        "processor": platform.processor() or platform.machine(),
+        "platform": platform.platform(),
+        "torch_version": torch.__version__,
+        "default_num_threads": torch.get_num_threads(),
+    }
+
+
+def get_machine_profile_path(profile_dir=DEFAULT_PROFILE_DIR):
+    """ Path of the profile of this machine (the core count is part of the name, so that jobs limited to a
+    subset of the cores don't use the profile of the whole node) """
+    return os.path.join(profile_dir, f"{socket.gethostname()}_{get_available_cores()}cores.json")
+
+
+def get_default_thread_counts():
+    """ 1, 2, 4, ... up to the number of available cores (always included) """
+    n_cores = get_available_cores()
+    counts = [2 ** i for i in range(n_cores.bit_length()) if 2 ** i <= n_cores]
+    return counts if counts[-1] == n_cores else counts + [n_cores]
+
+
+# ---------------------------------------------------------------------------------------------------
+# ------------                 SYNTHETIC BENCHMARK               ------------------------------------
+# ---------------------------------------------------------------------------------------------------
+def get_model_config(model_type, parameters=None):
+    """
+    Model config with the defaults of train.py (the ratios are resolved like in train.py)
+
+    :param model_type: (str) 'vae', 'density_1d' or 'density_2d'
+    :param parameters: (dict) values overriding the defaults (e.g. the params of a saved model)
+    :return: (dict)
+    """
+    from helpers.VAE.local_sweep import resolve_trial_config
+    parameters = dict(parameters or dict())
+    parameters["device"] = "cpu"
+    config = resolve_trial_config(parameters)
+    if model_type != "vae":
+        config.setdefault("n_params", 1)
+        config.setdefault("add_params", True)
+    config["device"] = "cpu"
+    return config
+
+
+def get_model(model_type, config):
+    from model import GrooveTransformerEncoderVAE, Density1D, Density2D
+    model_class = {"vae": GrooveTransformerEncoderVAE, "density_1d": Density1D, "density_2d": Density2D}[model_type]
+    return model_class(config)
+
+
+def get_synthetic_batch(model_type, config, batch_size):
+    """ Random (tapped input, target hvo[, densities]) batch with the shapes of the config """
+    n_voices = config["embedding_size_tgt"] // 3
+    hits = (torch.rand(batch_size, config["max_len_dec"], n_voices) > 0.8).float()
+    velocities = torch.rand(batch_size, config["max_len_dec"], n_voices) * hits
+    offsets = (torch.rand(batch_size, config["max_len_dec"], n_voices) - 0.5) * hits
+    targets = torch.cat([hits, velocities, offsets], dim=-1)
+    inputs = torch.rand(batch_size, config["max_len_enc"], config["embedding_size_src"])
+    extra_inputs = (torch.rand(batch_size), ) if model_type != "vae" else tuple()
+    return (inputs, ) + extra_inputs, targets
+
+
+def get_training_step(model, config):
+    """ A full training step (forward, losses as in train_utils, backward, optimizer step) """
+    from helpers.VAE.train_utils import calculate_hit_loss, calculate_velocity_loss, calculate_offset_loss, \
+        calculate_kld_loss
+    hit_loss_fn = torch.nn.BCEWithLogitsLoss(reduction='none')
+    velocity_loss_fn = torch.nn.BCEWithLogitsLoss(reduction='none') if config["velocity_loss_function"] == "bce" \
+        else torch.nn.MSELoss(reduction='none')
+    offset_loss_fn = torch.nn.BCEWithLogitsLoss(reduction='none') if config["offset_loss_function"] == "bce" \
+        else torch.nn.MSELoss(reduction='none')
+    optimizer = torch.optim.Adam(model.parameters(), lr=config["lr"])
+
+    def training_step(model_inputs, targets):
+        (h_logits, v_logits, o_logits), mu, log_var, _ = model.forward(*model_inputs)
+        h_targets, v_targets, o_targets = torch.split(targets, targets.shape[-1] // 3, -1)
+        loss = calculate_hit_loss(h_logits, h_targets, hit_loss_fn).mean() + \
+            calculate_velocity_loss(v_logits, v_targets, velocity_loss_fn).mean() + \
+            calculate_offset_loss(o_logits, o_targets, offset_loss_fn).mean() + \
+            calculate_kld_loss(mu, log_var).mean()
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+    return training_step
+
+
+def benchmark_setting(model_type, config, mode, batch_size, n_warmup=3, n_iters=10):
+    """
+    Throughput of one mode/batch size with the current thread settings
+
+    :return: (dict) {"samples_per_sec", "ms_per_batch"}
+    """
+    model = get_model(model_type, config)
+    model_inputs, targets = get_synthetic_batch(model_type, config, batch_size)
+    if mode == "train":
+        model.train()
+        step = get_training_step(model, config)
+    else:
+        model.eval()
+
+        def step(model_inputs_, targets_):
+            with torch.inference_mode():
+                model.forward(*model_inputs_)
+
+    for _ in range(n_warmup):
+        step(model_inputs, targets)
+    start = time.perf_counter()
+    for _ in range(n_iters):
+        step(model_inputs, targets)
+    seconds = time.perf_counter() - start
+    return {"samples_per_sec": batch_size * n_iters / seconds, "ms_per_batch": seconds / n_iters * 1000.0}
+
+
+def _benchmark_grid(model_type, config, modes, batch_sizes, thread_counts, interop_threads, n_warmup, n_iters, seed):
+    # runs in a fresh process: the inter-op threads can only be set before any inter-op work
+    torch.set_num_interop_threads(interop_threads)
+    results = []
+    for num_threads, mode, batch_size in itertools.product(thread_counts, modes, batch_sizes):
+        torch.set_num_threads(num_threads)
+        torch.manual_seed(seed)
+        result = benchmark_setting(model_type, config, mode, batch_size, n_warmup=n_warmup, n_iters=n_iters)
+        result.update({"mode": mode, "batch_size": batch_size, "num_threads": num_threads,
+                       "interop_threads": interop_threads})
+        logger.info(f"{model_type} {mode}: batch_size={batch_size}, threads={num_threads}/{interop_threads} --> "
+                    f"{result['samples_per_sec']:.1f} samples/sec")
+        results.append(result)
+    return results
+
+
+def get_best_settings(results, mode):
+    """ The fastest measurement of a mode (samples/sec), fewer threads win ties within 2% """
+    results = [result for result in results if result["mode"] == mode]
+    if len(results) == 0:
+        return None
+    best_throughput = max(result["samples_per_sec"] for result in results)
+    candidates = [result for result in results if result["samples_per_sec"] >= 0.98 * best_throughput]
+    best = min(candidates, key=lambda result: (result["num_threads"] + result["interop_threads"],
+                                               -result["samples_per_sec"]))
+    return {key: best[key] for key in ("batch_size", "num_threads", "interop_threads", "samples_per_sec",
+                                       "ms_per_batch")}
+
+
+def tune(model_type="vae", model_config=None, modes=MODES, batch_sizes=(16, 32, 64, 128), thread_counts=None,
+         interop_thread_counts=(1, 2), n_warmup=3, n_iters=10, seed=0):
+    """
+    Benchmarks a model over a grid of batch sizes and thread counts
+
+    :param model_type: (str) 'vae', 'density_1d' or 'density_2d'
+    :param model_config: (dict) values overriding the train.py defaults of the model config
+    :param modes: (list) 'train' and/or 'inference'
+    :param batch_sizes: (list) batch sizes to try
+    :param thread_counts: (list) intra-op thread counts to try (default 1, 2, 4, ... up to the available cores)
+    :param interop_thread_counts: (list) inter-op thread counts to try (each one in a separate process)
+    :param n_warmup: (int) steps run before timing
+    :param n_iters: (int) timed steps per setting
+    :param seed: (int) seed of the model weights and of the synthetic batches
+    :return: (dict) {"train": best settings, "inference": best settings, "model_config": ..., "results": [...]}
+    """
+    assert model_type in MODEL_TYPES, f"model_type must be one of {MODEL_TYPES}"
+    config = get_model_config(model_type, model_config)
+    thread_counts = list(thread_counts) if thread_counts is not None else get_default_thread_counts()
+
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for interop_threads in interop_thread_counts:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            results.extend(executor.submit(
+                _benchmark_grid, model_type, config, list(modes), list(batch_sizes), thread_counts, interop_threads,
+                n_warmup, n_iters, seed).result())
+
+    profile = {mode: get_best_settings(results, mode) for mode in modes}
+    profile.update({"model_config": {key: value for key, value in config.items()
+                                     if isinstance(value, (int, float, str, bool))},
+                    "tuned_at": time.strftime("%Y-%m-%d %H:%M:%S"), "results": results})
+    return profile
+
+
+# ---------------------------------------------------------------------------------------------------
+# ------------                 MACHINE PROFILES                  ------------------------------------
+# ---------------------------------------------------------------------------------------------------
+def save_machine_profile(profile, model_type="vae", path=None):
+    """ Writes (or updates) the profile of a model type in the profile file of this machine """
+    path = path if path is not None else get_machine_profile_path()
+    machine_profile = {"machine": get_machine_info(), "profiles": dict()}
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            machine_profile["profiles"] = json.load(f).get("profiles", dict())
+    machine_profile["profiles"][model_type] = profile
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        json.dump(machine_profile, f, indent=2)
+    os.replace(path + ".tmp", path)
+    logger.info(f"Machine profile of {model_type} saved to {path}")
+    return path
+
+
+def get_architecture_mismatches(profile_config, model_config):
+    """ {key: (profiled value, model value)} of the ARCHITECTURE_KEYS that differ between the two configs """
+    return {key: (profile_config.get(key), model_config.get(key)) for key in ARCHITECTURE_KEYS
+            if profile_config.get(key) != model_config.get(key)}
+
+
+def load_machine_profile(mode, model_type="vae", path="auto", model_config=None):
+    """
+    Tuned settings of a model type on this machine
+
+    :param mode: (str) 'train' or 'inference'
+    :param model_type: (str) 'vae', 'density_1d' or 'density_2d'
+    :param path: (str) 'auto' (profile of this machine in misc/machine_profiles), 'none' or a profile path
+    :param model_config: (dict) config (or params) of the model to train/serve, the profile is only used if it was
+                        tuned with the same architecture (ARCHITECTURE_KEYS), None to skip the check
+    :return: (dict) {"batch_size", "num_threads", "interop_threads", ...} or None if not available
+    """
+    if path is None or path == "none":
+        return None
+    path = get_machine_profile_path() if path == "auto" else path
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        profiles = json.load(f).get("profiles", dict())
+    if model_type not in profiles or profiles[model_type].get(mode) is None:
+        return None
+    if model_config is not None:
+        mismatches = get_architecture_mismatches(profiles[model_type].get("model_config", dict()),
+                                                 get_model_config(model_type, model_config))
+        if len(mismatches) > 0:
+            differences = ", ".join(f"{key}: {profiled} vs {value}" for key, (profiled, value) in mismatches.items())
+            logger.warning(f"The {model_type} profile in {path} was tuned for another architecture ({differences}), "
+                           f"not using it (re-run helpers/VAE/thread_tuner.py with this config)")
+            return None
+    return profiles[model_type][mode]
+
+
+def apply_machine_profile(mode, model_type="vae", path="auto", model_config=None):
+    """
+    Sets the tuned thread counts of this machine (call it early, the inter-op threads can only be set before any
+    inter-op work)
+
+    :param model_config: (dict) config of the model, see load_machine_profile
+    :return: (dict) the applied settings (incl. the tuned batch_size) or None if there is no (matching) profile
+    """
+    settings = load_machine_profile(mode, model_type=model_type, path=path, model_config=model_config)
+    if settings is None:
+        return None
+    torch.set_num_threads(settings["num_threads"])
+    try:
+        torch.set_num_interop_threads(settings["interop_threads"])
+    except RuntimeError:
+        logger.warning(f"The inter-op threads are already in use, keeping {torch.get_num_interop_threads()} "
+                       f"instead of {settings['interop_threads']}")
+    logger.info(f"Machine profile ({model_type}, {mode}): {settings['num_threads']} threads, "
+                f"{settings['interop_threads']} inter-op threads, tuned batch size {settings['batch_size']}")
+    return settings
+
+
+if __name__ == "__main__":
+    import sys
+    import argparse
+    sys.path.append(os.path.join(os.path.dirname(__file__), "..", ".."))
+
+    parser = argparse.ArgumentParser(description="Tunes the batch size and thread counts of a model on this machine")
+    parser.add_argument("--model_type", type=str, default="vae", choices=list(MODEL_TYPES))
+    parser.add_argument("--model_path", type=str, default=None,
+                        help="take the model config from the params of a saved model (.pth)")
+    parser.add_argument("--config", type=str, default=None, help="yaml file with the model config (as in train.py)")
+    parser.add_argument("--modes", type=str, nargs="+", default=list(MODES), choices=list(MODES))
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[16, 32, 64, 128])
+    parser.add_argument("--num_threads", type=int, nargs="+", default=None,
+                        help="intra-op thread counts (default 1, 2, 4, ... up to the available cores)")
+    parser.add_argument("--interop_threads", type=int, nargs="+", default=[1, 2], help="inter-op thread counts")
+    parser.add_argument("--n_warmup", type=int, default=3, help="untimed steps per setting")
+    parser.add_argument("--n_iters", type=int, default=10, help="timed steps per setting")
+    parser.add_argument("--profile_path", type=str, default=None,
+                        help="where to write the profile (default misc/machine_profiles/{host}_{cores}cores.json)")
+    args = parser.parse_args()
+
+    model_config = None
+    if args.model_path is not None:
+        model_config = torch.load(args.model_path, map_location="cpu")["params"]
+    elif args.config is not None:
+        import yaml
+        with open(args.config, "r") as f:
+            model_config = yaml.safe_load(f)
+
+    profile = tune(args.model_type, model_config=model_config, modes=args.modes, batch_sizes=args.batch_sizes,
+                   thread_counts=args.num_threads, interop_thread_counts=args.interop_threads,
+                   n_warmup=args.n_warmup, n_iters=args.n_iters)
+    save_machine_profile(profile, model_type=args.model_type, path=args.profile_path)
+    for mode in args.modes:
+        print(f"{mode}: {profile[mode]}")
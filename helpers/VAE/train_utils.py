@@ -1,11 +1,13 @@
 
 import os
+import contextlib
 import torch
 #from torchmetrics import Accuracy
 import wandb
 import re
 import numpy as np
 from model.Base.BasicGrooveTransformer import GrooveTransformerEncoder, GrooveTransformer
+from helpers.VAE.profiling import PhaseProfiler
 
 from logging import getLogger
 logger = getLogger("VAE_LOSS_CALCULATOR")
@@ -140,9 +142,71 @@ def calculate_kld_loss(mu, log_var):
     return kld_loss     # batch_size,  time_steps, n_voices
 
 
+class LossAccumulator(object):
+    """
+    Accumulates the per batch losses as running sums on the device of the losses, so that the host only syncs with
+    the device when the metrics are requested (instead of calling .item() for every loss of every batch)
+
+    :param loss_names: (list) names of the losses (order of the values passed to update())
+    :param keep_batch_losses: (bool) if True, the per batch losses are also kept (on device) for histograms
+    """
+    def __init__(self, loss_names, keep_batch_losses=False):
+        self.loss_names = list(loss_names)
+        self.keep_batch_losses = keep_batch_losses
+        self.reset()
+
+    def reset(self):
+        self.running_sums = None
+        self.n_batches = 0
+        self.batch_losses = []
+
+    def update(self, *batch_losses):
+        """ Adds the (scalar tensor) losses of a batch, in the order of loss_names """
+        losses = torch.stack([loss.detach().float() for loss in batch_losses])
+        self.running_sums = losses if self.running_sums is None else self.running_sums + losses
+        self.n_batches += 1
+        if self.keep_batch_losses:
+            self.batch_losses.append(losses)
+
+    def get_metrics(self):
+        """ Mean of each loss over the accumulated batches (a single device to host copy) """
+        if self.n_batches == 0:
+            return {name: np.nan for name in self.loss_names}
+        means = (self.running_sums / self.n_batches).cpu().numpy()
+        return {name: float(mean) for name, mean in zip(self.loss_names, means)}
+
+    def get_batch_losses(self):
+        """ Per batch losses {name: np.ndarray [n_batches]} (only if keep_batch_losses is True) """
+        if not self.batch_losses:
+            return {name: np.array([]) for name in self.loss_names}
+        batch_losses = torch.stack(self.batch_losses).cpu().numpy()
+        return {name: batch_losses[:, ix] for ix, name in enumerate(self.loss_names)}
+
+
+PRECISIONS = ("fp32", "bf16")
+
+# used when no profiler is given (its phases are no-op contexts)
+_disabled_profiler = PhaseProfiler(enabled=False)
+
+
+def get_autocast_context(device, precision="fp32"):
+    """
+    Returns the autocast context for the forward pass in the given precision
+
+    :param device:  (str or torch.device)  the device of the model
+    :param precision:   (str)  "fp32" (no autocast) or "bf16" (bfloat16 autocast)
+    :return:    a context manager
+    """
+    assert precision in PRECISIONS, f"precision must be one of {PRECISIONS}"
+    if precision == "fp32":
+        return contextlib.nullcontext()
+    device_type = device.type if isinstance(device, torch.device) else str(device).split(":")[0]
+    return torch.autocast(device_type=device_type, dtype=torch.bfloat16)
+
+
 def batch_loop(dataloader_, groove_transformer_vae, hit_loss_fn, velocity_loss_fn,
                offset_loss_fn, device, optimizer=None, starting_step=None, kl_beta=1.0,
-               reduce_by_sum=False):
+               reduce_by_sum=False, augmenter=None, precision="fp32", log_batch_histograms=False, profiler=None):
     """
     This function iteratively loops over the given dataloader and calculates the loss for each batch. If an optimizer is
     provided, it will also perform the backward pass and update the model parameters. The loss values are accumulated
@@ -161,6 +225,15 @@ def batch_loop(dataloader_, groove_transformer_vae, hit_loss_fn, velocity_loss_f
     :param starting_step:   (int)  the starting step for the optimizer
     :param kl_beta: (float)  the beta value for the KLD loss
     :param reduce_by_sum:   (bool)  whether to reduce the loss by sum or mean
+    :param augmenter:   (helpers.VAE.augmentation.BatchAugmenter)  if provided (and training), the targets of each
+                            batch are augmented on device and the inputs are re-tapified from the augmented targets
+    :param precision:   (str)  "fp32" or "bf16" (the forward pass is autocast to bfloat16, the losses are computed
+                            in float32)
+    :param log_batch_histograms:   (bool)  if True, the metrics also include a wandb.Histogram of the per batch values
+                            of each loss (with the key "{loss_name}_histogram")
+    :param profiler:    (helpers.VAE.profiling.PhaseProfiler)  if provided, the wall time of the phases of each batch
+                            (data_loading, to_device, augmentation, forward, loss, backward, optimizer) is recorded
+                            under "train/..." (if training) or "test/..."
     :return:    (dict)  a dictionary containing the loss values for the current batch
 
                 metrics = {
@@ -174,11 +247,16 @@ def batch_loop(dataloader_, groove_transformer_vae, hit_loss_fn, velocity_loss_f
     """
     # Prepare the metric trackers for the new epoch
     # ------------------------------------------------------------------------------------------
-    loss_total, loss_recon, loss_h, loss_v, loss_o, loss_KL, loss_KL_beta_scaled = [], [], [], [], [], [], []
+    # (the losses are accumulated on device, the host syncs only once at the end of the loop)
+    loss_accumulator = LossAccumulator(
+        ["loss_total", "loss_h", "loss_v", "loss_o", "loss_KL", "loss_KL_beta_scaled", "loss_recon"],
+        keep_batch_losses=log_batch_histograms)
 
     # Iterate over batches
     # ------------------------------------------------------------------------------------------
-    for batch_count, data_tuple in enumerate(dataloader_):
+    profiler = profiler if profiler is not None else _disabled_profiler
+    group = "train" if optimizer is not None else "test"
+    for batch_count, data_tuple in enumerate(profiler.iterate(f"{group}/data_loading", dataloader_)):
         inputs_ = data_tuple[0]
         outputs_ = data_tuple[1]
         hit_balancing_weights_per_sample_ = data_tuple[2] if len(data_tuple) > 4 else None
@@ -187,98 +265,100 @@ def batch_loop(dataloader_, groove_transformer_vae, hit_loss_fn, velocity_loss_f
 
         # Move data to GPU if available
         # ---------------------------------------------------------------------------------------
-        inputs = inputs_.to(device) if inputs_.device.type!= device else inputs_
-        outputs = outputs_.to(device) if outputs_.device.type!= device else outputs_
-        if hit_balancing_weights_per_sample_ is not None:
-            hit_balancing_weights_per_sample = hit_balancing_weights_per_sample_.to(device) \
-                if hit_balancing_weights_per_sample_.device.type!= device else hit_balancing_weights_per_sample_
-        else:
-            hit_balancing_weights_per_sample = None
-
-        if genre_balancing_weights_per_sample_ is not None:
-            genre_balancing_weights_per_sample = genre_balancing_weights_per_sample_.to(device) \
-                if genre_balancing_weights_per_sample_.device.type!= device else genre_balancing_weights_per_sample_
-        else:
-            genre_balancing_weights_per_sample = None
+        with profiler.phase(f"{group}/to_device"):
+            inputs = inputs_.to(device) if inputs_.device.type!= device else inputs_
+            outputs = outputs_.to(device) if outputs_.device.type!= device else outputs_
+            if hit_balancing_weights_per_sample_ is not None:
+                hit_balancing_weights_per_sample = hit_balancing_weights_per_sample_.to(device) \
+                    if hit_balancing_weights_per_sample_.device.type!= device else hit_balancing_weights_per_sample_
+            else:
+                hit_balancing_weights_per_sample = None
+
+            if genre_balancing_weights_per_sample_ is not None:
+                genre_balancing_weights_per_sample = genre_balancing_weights_per_sample_.to(device) \
+                    if genre_balancing_weights_per_sample_.device.type!= device else genre_balancing_weights_per_sample_
+            else:
+                genre_balancing_weights_per_sample = None
+
+        # Augment the targets and re-derive the tapped inputs (only when training)
+        # ---------------------------------------------------------------------------------------
+        if augmenter is not None and optimizer is not None:
+            with profiler.phase(f"{group}/augmentation"):
+                inputs, outputs = augmenter(outputs)
+        profiler.add_samples(inputs.shape[0], group)
 
         # Forward pass
         # ---------------------------------------------------------------------------------------
-        (h_logits, v_logits, o_logits), mu, log_var, latent_z = groove_transformer_vae.forward(inputs)
+        with profiler.phase(f"{group}/forward"), get_autocast_context(device, precision):
+            (h_logits, v_logits, o_logits), mu, log_var, latent_z = groove_transformer_vae.forward(inputs)
 
-        # Prepare targets for loss calculation
-        h_targets, v_targets, o_targets = torch.split(outputs, int(outputs.shape[2] / 3), 2)
+        with profiler.phase(f"{group}/loss"):
+            # the losses are always computed in float32
+            h_logits, v_logits, o_logits = h_logits.float(), v_logits.float(), o_logits.float()
+            mu, log_var = mu.float(), log_var.float()
 
-        # Compute losses
-        # ---------------------------------------------------------------------------------------
-        batch_loss_h = calculate_hit_loss(
-            hit_logits=h_logits, hit_targets=h_targets, hit_loss_function=hit_loss_fn)
-        if hit_balancing_weights_per_sample is not None and genre_balancing_weights_per_sample is not None:
-            batch_loss_h = (batch_loss_h * hit_balancing_weights_per_sample * genre_balancing_weights_per_sample)
-        batch_loss_h = batch_loss_h.sum() if reduce_by_sum else batch_loss_h.mean()
+            # Prepare targets for loss calculation
+            h_targets, v_targets, o_targets = torch.split(outputs, int(outputs.shape[2] / 3), 2)
 
-        batch_loss_v = calculate_velocity_loss(
-            vel_logits=v_logits, vel_targets=v_targets, vel_loss_function=velocity_loss_fn)
-        if hit_balancing_weights_per_sample is not None and genre_balancing_weights_per_sample is not None:
-            batch_loss_v = (batch_loss_v * hit_balancing_weights_per_sample * genre_balancing_weights_per_sample)
-        batch_loss_v = batch_loss_v.sum() if reduce_by_sum else batch_loss_v.mean()
+            # Compute losses
+            # ---------------------------------------------------------------------------------------
+            batch_loss_h = calculate_hit_loss(
+                hit_logits=h_logits, hit_targets=h_targets, hit_loss_function=hit_loss_fn)
+            if hit_balancing_weights_per_sample is not None and genre_balancing_weights_per_sample is not None:
+                batch_loss_h = (batch_loss_h * hit_balancing_weights_per_sample * genre_balancing_weights_per_sample)
+            batch_loss_h = batch_loss_h.sum() if reduce_by_sum else batch_loss_h.mean()
 
-        batch_loss_o = calculate_offset_loss(
-            offset_logits=o_logits, offset_targets=o_targets, offset_loss_function=offset_loss_fn)
-        if hit_balancing_weights_per_sample is not None and genre_balancing_weights_per_sample is not None:
-            batch_loss_o = (batch_loss_o * hit_balancing_weights_per_sample * genre_balancing_weights_per_sample)
+            batch_loss_v = calculate_velocity_loss(
+                vel_logits=v_logits, vel_targets=v_targets, vel_loss_function=velocity_loss_fn)
+            if hit_balancing_weights_per_sample is not None and genre_balancing_weights_per_sample is not None:
+                batch_loss_v = (batch_loss_v * hit_balancing_weights_per_sample * genre_balancing_weights_per_sample)
+            batch_loss_v = batch_loss_v.sum() if reduce_by_sum else batch_loss_v.mean()
 
-        batch_loss_o = batch_loss_o.sum() if reduce_by_sum else batch_loss_o.mean()
+            batch_loss_o = calculate_offset_loss(
+                offset_logits=o_logits, offset_targets=o_targets, offset_loss_function=offset_loss_fn)
+            if hit_balancing_weights_per_sample is not None and genre_balancing_weights_per_sample is not None:
+                batch_loss_o = (batch_loss_o * hit_balancing_weights_per_sample * genre_balancing_weights_per_sample)
 
-        batch_loss_KL = kl_beta * calculate_kld_loss(mu, log_var)
-        if genre_balancing_weights_per_sample is not None:
-            batch_loss_KL_Beta_Scaled = (batch_loss_KL * genre_balancing_weights_per_sample[:, 0, 0].view(-1, 1))
+            batch_loss_o = batch_loss_o.sum() if reduce_by_sum else batch_loss_o.mean()
 
-        else:
-            batch_loss_KL_Beta_Scaled = batch_loss_KL
+            batch_loss_KL = kl_beta * calculate_kld_loss(mu, log_var)
+            if genre_balancing_weights_per_sample is not None:
+                batch_loss_KL_Beta_Scaled = (batch_loss_KL * genre_balancing_weights_per_sample[:, 0, 0].view(-1, 1))
 
-        batch_loss_KL_Beta_Scaled = batch_loss_KL_Beta_Scaled.sum() if \
-            reduce_by_sum else batch_loss_KL_Beta_Scaled.mean()
+            else:
+                batch_loss_KL_Beta_Scaled = batch_loss_KL
 
-        batch_loss_KL = batch_loss_KL.sum() if reduce_by_sum else batch_loss_KL.mean()
+            batch_loss_KL_Beta_Scaled = batch_loss_KL_Beta_Scaled.sum() if \
+                reduce_by_sum else batch_loss_KL_Beta_Scaled.mean()
 
-        batch_loss_recon = (batch_loss_h + batch_loss_v + batch_loss_o)
-        batch_loss_total = (batch_loss_recon + batch_loss_KL_Beta_Scaled)
+            batch_loss_KL = batch_loss_KL.sum() if reduce_by_sum else batch_loss_KL.mean()
+
+            batch_loss_recon = (batch_loss_h + batch_loss_v + batch_loss_o)
+            batch_loss_total = (batch_loss_recon + batch_loss_KL_Beta_Scaled)
 
         # Backpropagation and optimization step (if training)
         # ---------------------------------------------------------------------------------------
         if optimizer is not None:
-            optimizer.zero_grad()
-            batch_loss_total.backward()
-            optimizer.step()
+            with profiler.phase(f"{group}/backward"):
+                optimizer.zero_grad()
+                batch_loss_total.backward()
+            with profiler.phase(f"{group}/optimizer"):
+                optimizer.step()
 
         # Update the per batch loss trackers
         # -----------------------------------------------------------------
-        loss_h.append(batch_loss_h.item())
-        loss_v.append(batch_loss_v.item())
-        loss_o.append(batch_loss_o.item())
-        loss_total.append(batch_loss_total.item())
-        loss_recon.append(batch_loss_recon.item())
-        loss_KL.append(batch_loss_KL.item())
-        loss_KL_beta_scaled.append(batch_loss_KL_Beta_Scaled.item())
+        loss_accumulator.update(batch_loss_total, batch_loss_h, batch_loss_v, batch_loss_o, batch_loss_KL,
+                                batch_loss_KL_Beta_Scaled, batch_loss_recon)
 
         # Increment the step counter
         # ---------------------------------------------------------------------------------------
         if starting_step is not None:
             starting_step += 1
 
-    # empty gpu cache if cuda
-    if device != 'cpu':
-        torch.cuda.empty_cache()
-
-    metrics = {
-        "loss_total": np.mean(loss_total),
-        "loss_h": np.mean(loss_h),
-        "loss_v": np.mean(loss_v),
-        "loss_o": np.mean(loss_o),
-        "loss_KL": np.mean(loss_KL),
-        "loss_KL_beta_scaled": np.mean(loss_KL_beta_scaled),
-        "loss_recon": np.mean(loss_recon)
-    }
+    metrics = loss_accumulator.get_metrics()
+    if log_batch_histograms:
+        for key, values in loss_accumulator.get_batch_losses().items():
+            metrics[f"{key}_histogram"] = wandb.Histogram(values)
 
     if starting_step is not None:
         return metrics, starting_step
@@ -287,7 +367,8 @@ def batch_loop(dataloader_, groove_transformer_vae, hit_loss_fn, velocity_loss_f
 
 
 def train_loop(train_dataloader, groove_transformer_vae, optimizer, hit_loss_fn, velocity_loss_fn,
-               offset_loss_fn, device, starting_step, kl_beta=1, reduce_by_sum=False):
+               offset_loss_fn, device, starting_step, kl_beta=1, reduce_by_sum=False, augmenter=None,
+               precision="fp32", log_batch_histograms=False, profiler=None):
     """
     This function performs the training loop for the given model and dataloader. It will iterate over the dataloader
     and perform the forward and backward pass for each batch. The loss values are accumulated and the average is
@@ -304,6 +385,10 @@ def train_loop(train_dataloader, groove_transformer_vae, optimizer, hit_loss_fn,
     :param starting_step:   (int)  the starting step for the optimizer
     :param kl_beta: (float)  the beta value for the KL loss
     :param reduce_by_sum:   (bool)  if True, the loss values are reduced by sum instead of mean
+    :param augmenter:   (helpers.VAE.augmentation.BatchAugmenter)  optional on-device batch augmentation
+    :param precision:   (str)  "fp32" or "bf16" (autocast of the forward pass)
+    :param log_batch_histograms:   (bool)  if True, histograms of the per batch losses are added to the metrics
+    :param profiler:    (helpers.VAE.profiling.PhaseProfiler)  optional per phase wall time profiler
 
     :return:    (dict)  a dictionary containing the loss values for the current batch
 
@@ -330,14 +415,19 @@ def train_loop(train_dataloader, groove_transformer_vae, optimizer, hit_loss_fn,
         optimizer=optimizer,
         starting_step=starting_step,
         kl_beta=kl_beta,
-        reduce_by_sum=reduce_by_sum)
+        reduce_by_sum=reduce_by_sum,
+        augmenter=augmenter,
+        precision=precision,
+        log_batch_histograms=log_batch_histograms,
+        profiler=profiler)
 
     metrics = {f"train/{key}": value for key, value in metrics.items()}
     return metrics, starting_step
 
 
 def test_loop(test_dataloader, groove_transformer_vae, hit_loss_fn, velocity_loss_fn,
-               offset_loss_fn, device, kl_beta=1, reduce_by_sum=False):
+               offset_loss_fn, device, kl_beta=1, reduce_by_sum=False, precision="fp32",
+               log_batch_histograms=False, profiler=None):
     """
     This function performs the test loop for the given model and dataloader. It will iterate over the dataloader
     and perform the forward pass for each batch. The loss values are accumulated and the average is returned at the end
@@ -352,6 +442,9 @@ def test_loop(test_dataloader, groove_transformer_vae, hit_loss_fn, velocity_los
     :param device:  (str)  the device to use for the model
     :param kl_beta: (float)  the beta value for the KL loss
     :param reduce_by_sum:   (bool)  if True, the loss values are reduced by sum instead of mean
+    :param precision:   (str)  "fp32" or "bf16" (autocast of the forward pass)
+    :param log_batch_histograms:   (bool)  if True, histograms of the per batch losses are added to the metrics
+    :param profiler:    (helpers.VAE.profiling.PhaseProfiler)  optional per phase wall time profiler
     :return:   (dict)  a dictionary containing the loss values for the current batch
 
             metrics = {
@@ -377,7 +470,10 @@ def test_loop(test_dataloader, groove_transformer_vae, hit_loss_fn, velocity_los
             device=device,
             optimizer=None,
             kl_beta=kl_beta,
-            reduce_by_sum=reduce_by_sum)
+            reduce_by_sum=reduce_by_sum,
+            precision=precision,
+            log_batch_histograms=log_batch_histograms,
+            profiler=profiler)
 
     metrics = {f"test/{key}": value for key, value in metrics.items()}
     return metrics
@@ -12,3 +12,5 @@ from helpers.VAE.modelLoader import load_variational_mgt_model
 from helpers.BasicMonotonicGrooveTransformer.modelLoadersSamplers import load_mgt_model
 from helpers.BasicMonotonicGrooveTransformer.modelLoadersSamplers import predict_using_mgt
 
+
+from helpers.model_registry import ModelRegistry, get_model_registry, load_cached_model
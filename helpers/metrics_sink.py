@@ -0,0 +1,344 @@
+#  Copyright (c) 2022. \n Created by Behzad Haki. behzad.haki@upf.edu
+"""
+Pluggable metrics/media sinks for the training scripts
+
+The training scripts only talk to a MetricsSink (log, watch, log_model_file, finish, config, run_name, run_id), so
+the backend can be switched without touching the training code:
+
+    - "wandb":    wandb.init/log/watch/artifacts (as before)
+    - "local":    offline, append-only metrics.jsonl + media files on disk, written by a background thread
+    - "disabled": no logging at all (e.g. for the non zero ranks of a distributed run)
+
+log() follows the step semantics of wandb.log (commit=False accumulates into the current step, an explicit step
+closes the previous one). The local backend converts the wandb media objects built by the eval helpers (wandb.Html,
+wandb.Histogram, wandb.Audio, wandb.Image, ...) to files/JSON in its background thread, so the training loop only
+pays for queuing the payload.
+
+Histograms (wandb.Histogram values, and the parameter/gradient histograms of watch()) are rate limited to one every
+histogram_every_n_steps steps.
+
+Local run folder ({output_dir}/{project}/{run_name}_{run_id}/):
+    config.json         the run config
+    metrics.jsonl       one JSON object per step ({"_step": ..., "_timestamp": ..., key: value, ...})
+    media/              html/audio/image files referenced from metrics.jsonl ({"_type": "html", "path": ...})
+    artifacts.jsonl     the model files logged with log_model_file()
+
+Usage:
+    sink = init_metrics_sink("local", config=hparams, project="my_project")
+    sink.watch(model, log_freq=10)
+    sink.log(train_metrics, commit=False)
+    sink.log({"epoch": epoch}, step=epoch)
+    sink.finish()
+"""
+import os
+import json
+import time
+import uuid
+import queue
+import shutil
+import threading
+
+import numpy as np
+import torch
+
+from logging import getLogger
+logger = getLogger("helpers/metrics_sink.py")
+logger.setLevel("DEBUG")
+
+BACKENDS = ("wandb", "local", "disabled")
+
+
+class LocalConfig(dict):
+    """ dict with the parts of the wandb.config interface used by the training scripts (attribute access, as_dict,
+    update(..., allow_val_change=...)) """
+    def __getattr__(self, key):
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(key)
+
+    def __setattr__(self, key, value):
+        self[key] = value
+
+    def as_dict(self):
+        return dict(self)
+
+    def update(self, other=(), allow_val_change=True, **kwargs):
+        super().update(other, **kwargs)
+
+
+def is_histogram(key, value):
+    return type(value).__name__ == "Histogram" or key.endswith("_histogram")
+
+
+# ---------------------------------------------------------------------------------------------------
+# ------------                 DISABLED (BASE)                   ------------------------------------
+# ---------------------------------------------------------------------------------------------------
+class MetricsSink(object):
+    backend = "disabled"
+
+    def __init__(self, config, run_name=None, run_id=None, histogram_every_n_steps=1):
+        """
+        Base sink (also the "disabled" backend: everything is dropped)
+
+        :param config: (dict) the run config
+        :param run_name: (str) name of the run (generated if None)
+        :param run_id: (str) id of the run (generated if None)
+        :param histogram_every_n_steps: (int) histograms are logged at most once every n steps
+        """
+        self.config = config if hasattr(config, "as_dict") else LocalConfig(config)
+        self.run_id = run_id if run_id is not None else uuid.uuid4().hex[:8]
+        self.run_name = run_name if run_name is not None else f"{self.backend}-{time.strftime('%Y%m%d-%H%M%S')}"
+        self.histogram_every_n_steps = max(1, int(histogram_every_n_steps))
+        self.step = 0
+        self._last_histogram_step = None
+
+    def _filter_histograms(self, metrics, step):
+        histogram_keys = [key for key, value in metrics.items() if is_histogram(key, value)]
+        if not histogram_keys:
+            return metrics
+        if self._last_histogram_step is None or step - self._last_histogram_step >= self.histogram_every_n_steps \
+                or step == self._last_histogram_step:
+            self._last_histogram_step = step
+            return metrics
+        return {key: value for key, value in metrics.items() if key not in histogram_keys}
+
+    def log(self, metrics, step=None, commit=None):
+        """
+        Logs a dictionary of metrics/media (same semantics as wandb.log)
+
+        :param metrics: (dict) {name: scalar, wandb media object, ...}
+        :param step: (int) explicit step (None to use the current step)
+        :param commit: (bool) if False, the metrics are accumulated into the current step
+        """
+        metrics = self._filter_histograms(metrics, self.step if step is None else step)
+        self._log(metrics, step, commit)
+        if step is not None and step > self.step:
+            self.step = step
+        if (step is None and commit is None) or commit:
+            self.step += 1
+
+    def _log(self, metrics, step, commit):
+        pass
+
+    def watch(self, model, log_freq=100):
+        """ Logs histograms of the parameters and gradients of the model every log_freq steps """
+        pass
+
+    def log_model_file(self, model_path, name):
+        """ Records (and uploads, for wandb) a saved model file """
+        pass
+
+    def finish(self):
+        pass
+
+
+# ---------------------------------------------------------------------------------------------------
+# ------------                 WANDB                             ------------------------------------
+# ---------------------------------------------------------------------------------------------------
+class WandbSink(MetricsSink):
+    backend = "wandb"
+
+    def __init__(self, config, project, histogram_every_n_steps=1, run_id=None, resume=False, **init_kwargs):
+        """
+        wandb backend
+
+        :param config: (dict) the run config (replaced by wandb.config, which may be modified by a sweep)
+        :param project: (str) wandb project
+        :param histogram_every_n_steps: (int) histograms are logged at most once every n steps
+        :param run_id: (str) id of the run to resume (None for a new run)
+        :param resume: (bool) if True, logs to the existing run with run_id
+        :param init_kwargs: additional arguments for wandb.init (e.g. entity, settings, anonymous)
+        """
+        import wandb
+        self._wandb = wandb
+        self.run = wandb.init(config=config, project=project, id=run_id, resume="allow" if resume else None,
+                              **init_kwargs)
+        super().__init__(wandb.config, self.run.name, self.run.id, histogram_every_n_steps)
+
+    def _log(self, metrics, step, commit):
+        self._wandb.log(metrics, step=step, commit=commit)
+
+    def watch(self, model, log_freq=100):
+        self._wandb.watch(model, log="all", log_freq=log_freq)
+
+    def log_model_file(self, model_path, name):
+        model_artifact = self._wandb.Artifact(name, type='model')
+        model_artifact.add_file(model_path)
+        self.run.log_artifact(model_artifact)
+
+    def finish(self):
+        self._wandb.finish()
+
+
+# ---------------------------------------------------------------------------------------------------
+# ------------                 LOCAL                             ------------------------------------
+# ---------------------------------------------------------------------------------------------------
+class LocalSink(MetricsSink):
+    backend = "local"
+
+    def __init__(self, config, project, output_dir="misc/logs", histogram_every_n_steps=1, run_id=None,
+                 resume=False, run_name=None):
+        """
+        Offline backend: append-only JSONL + media files, written by a background thread
+
+        :param config: (dict) the run config
+        :param project: (str) project folder
+        :param output_dir: (str) root folder of the runs
+        :param histogram_every_n_steps: (int) histograms are logged at most once every n steps
+        :param run_id: (str) id of the run (to resume a run, together with resume=True)
+        :param resume: (bool) if True, appends to the existing folder of run_id
+        :param run_name: (str) name of the run (generated if None)
+        """
+        if resume and run_id is not None:
+            existing = [folder for folder in os.listdir(os.path.join(output_dir, project))
+                        if folder.endswith(f"_{run_id}")] if os.path.isdir(os.path.join(output_dir, project)) else []
+            run_name = existing[0][:-len(f"_{run_id}")] if existing else run_name
+        super().__init__(LocalConfig(config), run_name, run_id, histogram_every_n_steps)
+        self.run_dir = os.path.join(output_dir, project, f"{self.run_name}_{self.run_id}")
+        os.makedirs(os.path.join(self.run_dir, "media"), exist_ok=True)
+        with open(os.path.join(self.run_dir, "config.json"), "w") as f:
+            json.dump(self.config.as_dict(), f, indent=4, default=str)
+        if resume and os.path.exists(os.path.join(self.run_dir, "metrics.jsonl")):
+            with open(os.path.join(self.run_dir, "metrics.jsonl"), "r") as f:
+                steps = [json.loads(line)["_step"] for line in f if line.strip()]
+            self.step = max(steps) + 1 if steps else 0
+
+        self._pending = dict()
+        self._watched = []
+        self._watch_log_freq = None
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._write_loop, name="LocalSink", daemon=True)
+        self._thread.start()
+        logger.info(f"Logging locally to {self.run_dir}")
+
+    # ------------------------- caller thread -------------------------
+    def _log(self, metrics, step, commit):
+        if step is not None and step < self.step:
+            logger.warning(f"Step {step} is older than the current step {self.step}, dropping {list(metrics.keys())}")
+            return
+        if step is not None and step > self.step:
+            self._flush()
+            self.step = step
+        self._pending.update(metrics)
+        if (step is None and commit is None) or commit:
+            self._flush()
+
+    def _flush(self):
+        if not self._pending:
+            return
+        if self._watched and self.step % self._watch_log_freq == 0:
+            self._pending.update(self._filter_histograms(self._get_watch_snapshot(), self.step))
+        self._queue.put(("metrics", self.step, self._pending))
+        self._pending = dict()
+
+    def _get_watch_snapshot(self):
+        # only copies the tensors, the histograms are computed in the background thread
+        snapshot = dict()
+        for model_ix, model in enumerate(self._watched):
+            prefix = "" if len(self._watched) == 1 else f"model_{model_ix}/"
+            for name, param in model.named_parameters():
+                snapshot[f"{prefix}parameters/{name}_histogram"] = param.detach().to("cpu", copy=True)
+                if param.grad is not None:
+                    snapshot[f"{prefix}gradients/{name}_histogram"] = param.grad.detach().to("cpu", copy=True)
+        return snapshot
+
+    def watch(self, model, log_freq=100):
+        self._watched.append(model)
+        self._watch_log_freq = max(1, int(log_freq))
+
+    def log_model_file(self, model_path, name):
+        self._queue.put(("artifact", self.step, {"name": name, "type": "model", "path": model_path}))
+
+    def finish(self):
+        """ Writes the pending metrics and waits for the background thread """
+        self._flush()
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+    # ------------------------- background thread -------------------------
+    def _write_loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            kind, step, payload = item
+            try:
+                if kind == "metrics":
+                    row = {"_step": step, "_timestamp": time.time()}
+                    row.update({key: self._serialize(key, value, step) for key, value in payload.items()})
+                    self._append("metrics.jsonl", row)
+                else:
+                    self._append("artifacts.jsonl", dict(payload, _step=step, _timestamp=time.time()))
+            except Exception:
+                logger.exception(f"Could not write the {kind} of step {step}")
+
+    def _append(self, fname, row):
+        with open(os.path.join(self.run_dir, fname), "a") as f:
+            f.write(json.dumps(row, default=str) + "\n")
+
+    def _get_media_path(self, key, step, extension):
+        folder = os.path.join(self.run_dir, "media", key.replace("/", "__"))
+        os.makedirs(folder, exist_ok=True)
+        return os.path.join(folder, f"{step:06d}{extension}")
+
+    def _serialize(self, key, value, step):
+        """ JSON serializable version of a logged value (media objects are written to files) """
+        if isinstance(value, (bool, int, float, str)) or value is None:
+            return value
+        if isinstance(value, (np.generic, )):
+            return value.item()
+        if isinstance(value, torch.Tensor) and value.numel() == 1:
+            return value.item()
+        if isinstance(value, (np.ndarray, torch.Tensor)) and is_histogram(key, value):
+            values = value.numpy() if isinstance(value, torch.Tensor) else value
+            counts, bins = np.histogram(values.astype(np.float64).ravel(), bins=64)
+            return {"_type": "histogram", "counts": counts.tolist(), "bins": bins.tolist()}
+        if isinstance(value, (np.ndarray, torch.Tensor)):
+            return value.tolist()
+        if isinstance(value, dict):
+            return {k: self._serialize(f"{key}/{k}", v, step) for k, v in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [self._serialize(f"{key}/{ix}", v, step) for ix, v in enumerate(value)]
+        type_name = type(value).__name__
+        if type_name == "Histogram":
+            return {"_type": "histogram", "counts": list(value.histogram), "bins": list(value.bins)}
+        if type_name == "Html":
+            path = self._get_media_path(key, step, ".html")
+            with open(path, "w") as f:
+                f.write(value.html)
+            return {"_type": "html", "path": os.path.relpath(path, self.run_dir)}
+        if getattr(value, "_path", None) is not None and os.path.exists(value._path):
+            # wandb.Audio, wandb.Image, ... keep their content in a (temporary) file
+            path = self._get_media_path(key, step, os.path.splitext(value._path)[1])
+            shutil.copyfile(value._path, path)
+            return {"_type": type_name.lower(), "path": os.path.relpath(path, self.run_dir),
+                    "caption": getattr(value, "_caption", None)}
+        return repr(value)
+
+
+def init_metrics_sink(backend, config, project, output_dir="misc/logs", histogram_every_n_steps=1, run_id=None,
+                      resume=False, enabled=True, **wandb_init_kwargs):
+    """
+    Creates the metrics sink of a training run
+
+    :param backend: (str) "wandb", "local" or "disabled"
+    :param config: (dict) the run config
+    :param project: (str) project name (wandb project, or sub folder of output_dir for the local backend)
+    :param output_dir: (str) root folder of the local runs
+    :param histogram_every_n_steps: (int) histograms are logged at most once every n steps
+    :param run_id: (str) id of the run to resume (None for a new run)
+    :param resume: (bool) if True, logs to the existing run with run_id
+    :param enabled: (bool) if False, a disabled sink is returned whatever the backend (e.g. non zero ranks)
+    :param wandb_init_kwargs: additional arguments for wandb.init (ignored by the other backends)
+    :return: (MetricsSink)
+    """
+    assert backend in BACKENDS, f"backend must be one of {BACKENDS}"
+    if backend == "disabled" or not enabled:
+        return MetricsSink(config, run_id=run_id, histogram_every_n_steps=histogram_every_n_steps)
+    if backend == "local":
+        return LocalSink(config, project, output_dir=output_dir, histogram_every_n_steps=histogram_every_n_steps,
+                         run_id=run_id, resume=resume)
+    return WandbSink(config, project, histogram_every_n_steps=histogram_every_n_steps, run_id=run_id, resume=resume,
+                     **wandb_init_kwargs)
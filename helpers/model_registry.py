@@ -0,0 +1,180 @@
+#  Copyright (c) 2022. \n Created by Behzad Haki. behzad.haki@upf.edu
+"""
+Process wide registry of loaded models
+
+Evaluation scripts and notebooks tend to load the same checkpoints over and over. The registry keeps the loaded models
+(in eval mode, with gradients disabled) keyed by (path, modification time, device, dtype, loader arguments), so a
+checkpoint is only read from disk again if it has changed. The least recently used models are dropped once the total
+size of the cached models exceeds the memory budget.
+
+With share_memory=True, the weights of cpu models are moved to shared memory, so processes forked after loading
+(e.g. torch.multiprocessing / DataLoader workers) use the same weights instead of getting a copy on write.
+
+The returned models are shared with every other user of the registry, so they must be treated as read-only
+(use copy.deepcopy() before training or modifying them).
+
+Usage:
+    model = load_cached_model("path/to/model.pth", "vae", device="cpu")
+    model = load_cached_model("path/to/model.pth", "density", density_version=2)
+    get_model_registry().get_stats()
+"""
+import os
+import json
+import time
+import threading
+import collections
+
+from helpers.VAE.modelLoader import load_variational_mgt_model
+from helpers.Control.density_model_Loader import load_density_model
+from helpers.Control.density_1D_modelLoader import load_density_1d_model
+from helpers.Control.density_2D_modelLoader import load_density_2d_model
+
+from logging import getLogger
+logger = getLogger("helpers/model_registry.py")
+logger.setLevel("DEBUG")
+
+MODEL_LOADERS = {
+    "vae": load_variational_mgt_model,
+    "density": load_density_model,
+    "density_1d": load_density_1d_model,
+    "density_2d": load_density_2d_model,
+}
+
+RegistryEntry = collections.namedtuple("RegistryEntry", ["model", "size_bytes", "load_time_sec"])
+
+
+def get_model_size_bytes(model):
+    """ Memory used by the parameters and buffers of a model (tied tensors are counted once) """
+    tensors = {t.data_ptr(): t for t in list(model.parameters()) + list(model.buffers())}
+    return sum(t.numel() * t.element_size() for t in tensors.values())
+
+
+class ModelRegistry(object):
+    def __init__(self, memory_budget_mb=2048, share_memory=False):
+        """
+        LRU cache of loaded models
+
+        :param memory_budget_mb: (float) maximum total size of the cached models (None for no limit). The most recently
+                                used model is always kept, even if it is larger than the budget on its own.
+        :param share_memory: (bool) if True, the weights of cpu models are moved to shared memory
+        """
+        self.memory_budget_mb = memory_budget_mb
+        self.share_memory = share_memory
+        self._entries = collections.OrderedDict()
+        self._lock = threading.RLock()
+        self.n_hits = 0
+        self.n_misses = 0
+
+    @staticmethod
+    def get_key(model_path, model_type, device, dtype, loader_kwargs):
+        model_path = os.path.abspath(model_path)
+        return (model_path, os.stat(model_path).st_mtime_ns, model_type, str(device), str(dtype),
+                json.dumps(loader_kwargs, sort_keys=True, default=str))
+
+    def get(self, model_path, model_type="vae", device=None, dtype=None, **loader_kwargs):
+        """
+        Returns the model (loads it if not already in the registry, or if the file has changed since)
+
+        :param model_path: (str) path to the .pth checkpoint
+        :param model_type: (str) one of MODEL_LOADERS ("vae", "density", "density_1d", "density_2d")
+        :param device: (None, str or torch.device) device of the model (see the loaders)
+        :param dtype: (None or torch.dtype) if given, the model is cast to this dtype
+        :param loader_kwargs: additional arguments for the loader (e.g. density_version, params_dict)
+        :return: the (read-only, eval mode) model
+        """
+        assert model_type in MODEL_LOADERS, f"model_type must be one of {list(MODEL_LOADERS.keys())}"
+        key = self.get_key(model_path, model_type, device, dtype, loader_kwargs)
+
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.n_hits += 1
+                return self._entries[key].model
+
+            self.n_misses += 1
+            # an older version of the same checkpoint is not needed anymore
+            for stale_key in [k for k in self._entries.keys() if k[0] == key[0] and k[1] != key[1]]:
+                logger.info(f"{model_path} has changed on disk, dropping the previously loaded version")
+                del self._entries[stale_key]
+
+            start = time.perf_counter()
+            model = MODEL_LOADERS[model_type](model_path, device=device, is_evaluating=True, **loader_kwargs)
+            if dtype is not None:
+                model = model.to(dtype)
+            model.eval().requires_grad_(False)
+            if self.share_memory and next(model.parameters()).device.type == "cpu":
+                model.share_memory()
+            entry = RegistryEntry(model, get_model_size_bytes(model), time.perf_counter() - start)
+            logger.info(f"Loaded {model_path} ({model_type}, {device}, {dtype}) in {entry.load_time_sec:.3f} sec, "
+                        f"{entry.size_bytes / 2 ** 20:.2f} MB")
+
+            self._entries[key] = entry
+            self._evict()
+            return model
+
+    def _evict(self):
+        if self.memory_budget_mb is None:
+            return
+        while len(self._entries) > 1 and self.get_total_size_bytes() > self.memory_budget_mb * 2 ** 20:
+            key, entry = self._entries.popitem(last=False)
+            logger.info(f"Evicting {key[0]} ({entry.size_bytes / 2 ** 20:.2f} MB) from the model registry")
+
+    def get_total_size_bytes(self):
+        with self._lock:
+            return sum(entry.size_bytes for entry in self._entries.values())
+
+    def remove(self, model_path):
+        """ Drops all the loaded versions of a checkpoint """
+        model_path = os.path.abspath(model_path)
+        with self._lock:
+            for key in [k for k in self._entries.keys() if k[0] == model_path]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get_stats(self):
+        """ Summary of the registry (hits, misses, memory and the cached models from least to most recently used) """
+        with self._lock:
+            return {
+                "num_models": len(self._entries),
+                "num_hits": self.n_hits,
+                "num_misses": self.n_misses,
+                "total_size_mb": self.get_total_size_bytes() / 2 ** 20,
+                "memory_budget_mb": self.memory_budget_mb,
+                "models": [{"path": key[0], "model_type": key[2], "device": key[3], "dtype": key[4],
+                            "size_mb": entry.size_bytes / 2 ** 20, "load_time_sec": entry.load_time_sec}
+                           for key, entry in self._entries.items()]
+            }
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# ---------------------------------------------------------------------------------------------------
+# ------------                 DEFAULT (PROCESS WIDE) REGISTRY   ------------------------------------
+# ---------------------------------------------------------------------------------------------------
+_default_registry = None
+_default_registry_lock = threading.Lock()
+
+
+def get_model_registry():
+    """ The process wide registry used by load_cached_model (created on first use) """
+    global _default_registry
+    with _default_registry_lock:
+        if _default_registry is None:
+            _default_registry = ModelRegistry()
+        return _default_registry
+
+
+def set_model_registry(registry):
+    """ Replaces the process wide registry (e.g. to change its memory budget or to enable share_memory) """
+    global _default_registry
+    with _default_registry_lock:
+        _default_registry = registry
+
+
+def load_cached_model(model_path, model_type="vae", device=None, dtype=None, **loader_kwargs):
+    """ Loads a model through the process wide registry (see ModelRegistry.get) """
+    return get_model_registry().get(model_path, model_type, device=device, dtype=dtype, **loader_kwargs)
@@ -35,10 +35,13 @@ class GrooveTransformer(torch.nn.Module):
         self.InputLayerEncoder.init_weights()
         self.OutputLayer.init_weights()
 
+        # causal mask of the decoder (not saved in the state_dict)
+        self.register_buffer('tgt_mask', get_tgt_mask(self.max_len), persistent=False)
+
     def forward(self, src, tgt):
         # model Nx32xembedding_size_src
         # tgt Nx32xembedding_size_tgt
-        mask = get_tgt_mask(self.max_len).to(self.device)
+        mask = self.tgt_mask
 
         x = self.InputLayerEncoder(src)  # Nx32xd_model
         y = self.InputLayerDecoder(tgt)  # Nx32xd_model
@@ -48,12 +51,26 @@ class GrooveTransformer(torch.nn.Module):
 
         return out
 
-    def predict(self, src, use_thres=True, thres=0.5, use_pd=False):
+    def predict(self, src, use_thres=True, thres=0.5, use_pd=False, use_kv_cache=True):
+        """
+        Autoregressively generates the output sequence
+
+        :param src: the input sequence [batch_size, max_len, embedding_size_src]
+        :param use_thres: (bool) use thresholding for hits
+        :param thres: (float) threshold for hits
+        :param use_pd: (bool) sample the hits using a random threshold
+        :param use_kv_cache: (bool) if True, the keys/values of the previous steps are cached and only the new step
+                            is decoded at each iteration. Otherwise the whole sequence is re-decoded at every step
+        :return: h, v, o (each of shape [batch_size, max_len, embedding_size_tgt // 3])
+        """
+        if use_kv_cache:
+            return self.predict_incrementally(src, use_thres=use_thres, thres=thres, use_pd=use_pd)
+
         self.eval()
 
         with torch.no_grad():
             n_voices = self.embedding_size_tgt // 3
-            mask = get_tgt_mask(self.max_len).to(self.device)
+            mask = self.tgt_mask
 
             # encoder
             x = self.InputLayerEncoder(src)  # Nx32xd_model
@@ -85,6 +102,42 @@ class GrooveTransformer(torch.nn.Module):
 
         return h, v, o
 
+    def predict_incrementally(self, src, use_thres=True, thres=0.5, use_pd=False):
+        """ Same as predict(use_kv_cache=False), but each step only decodes the new position, attending to the cached
+        keys/values of the previous ones """
+        self.eval()
+
+        with torch.no_grad():
+            n_voices = self.embedding_size_tgt // 3
+            batch_size = src.shape[0]
+
+            # encoder
+            x = self.InputLayerEncoder(src)  # Nx32xd_model
+            memory = self.Encoder(x)  # Nx32xd_model
+            memory_keys_values = self.Decoder.get_memory_keys_values(memory)
+            self_attention_cache = self.Decoder.init_self_attention_cache(batch_size, self.max_len, memory.device)
+
+            tgt = torch.zeros([batch_size, self.max_len, self.embedding_size_tgt], device=memory.device)
+            tgt_step = torch.zeros([batch_size, 1, self.embedding_size_tgt], device=memory.device)
+
+            for i in range(self.max_len):
+                y_step = self.InputLayerDecoder.forward_step(tgt_step, i)  # Nx1xd_model
+                out = self.Decoder.forward_step(y_step, i, memory_keys_values, self_attention_cache)
+                _h, v, o = self.OutputLayer(out)
+
+                h = get_hits_activation(_h, use_thres=use_thres, thres=thres, use_pd=use_pd)
+
+                tgt[:, i, 0: n_voices] = h[:, 0, :]
+                tgt[:, i, n_voices: 2 * n_voices] = v[:, 0, :]
+                tgt[:, i, 2 * n_voices:] = o[:, 0, :]
+                tgt_step = tgt[:, i:i + 1, :]
+
+            h = tgt[:, :, 0: n_voices]
+            v = tgt[:, :, n_voices: 2 * n_voices]
+            o = tgt[:, :, 2 * n_voices:]
+
+        return h, v, o
+
 
 class GrooveTransformerEncoder(torch.nn.Module):
     """
@@ -79,6 +79,22 @@ def get_tgt_mask(d_model):
     mask = mask.masked_fill(mask == 0, float('-inf')).masked_fill(mask == 1, float(0.0))
     return mask
 
+def split_heads(x, nhead):
+    # NxLxd_model --> NxnheadxLxhead_dim
+    return x.reshape(x.shape[0], x.shape[1], nhead, x.shape[2] // nhead).transpose(1, 2)
+
+
+def merge_heads(x):
+    # NxnheadxLxhead_dim --> NxLxd_model
+    return x.transpose(1, 2).reshape(x.shape[0], x.shape[2], x.shape[1] * x.shape[3])
+
+
+def scaled_dot_product_attention(q, k, v):
+    # q NxnheadxL_qxhead_dim, k/v NxnheadxL_kvxhead_dim
+    weights = torch.softmax(torch.matmul(q, k.transpose(-2, -1)) / math.sqrt(q.shape[-1]), dim=-1)
+    return torch.matmul(weights, v)
+
+
 class Decoder(torch.nn.Module):
 
     def __init__(self, d_model, nhead, dim_feedforward, dropout, num_decoder_layers):
@@ -86,6 +102,7 @@ class Decoder(torch.nn.Module):
         norm_decoder = torch.nn.LayerNorm(d_model)
         decoder_layer = torch.nn.TransformerDecoderLayer(d_model, nhead, dim_feedforward, dropout)
         self.Decoder = torch.nn.TransformerDecoder(decoder_layer, num_decoder_layers, norm_decoder)
+        self.nhead = nhead
 
     def forward(self, tgt, memory, tgt_mask):
         # tgt    Nx32xd_model
@@ -100,6 +117,70 @@ class Decoder(torch.nn.Module):
 
         return out
 
+    # ----------------------------------------------------------------------------
+    # Incremental (step by step) decoding
+    # the keys/values of the previous steps are cached, so each step only runs the new position through the layers
+    # ----------------------------------------------------------------------------
+    def get_memory_keys_values(self, memory):
+        """ Projects the encoder memory (Nx32xd_model) to the keys and values of the cross attention of each layer
+        (these do not change during decoding, so they are computed once) """
+        keys_values = []
+        for layer in self.Decoder.layers:
+            d_model = layer.multihead_attn.embed_dim
+            w, b = layer.multihead_attn.in_proj_weight, layer.multihead_attn.in_proj_bias
+            k = torch.nn.functional.linear(memory, w[d_model:2 * d_model], b[d_model:2 * d_model])
+            v = torch.nn.functional.linear(memory, w[2 * d_model:], b[2 * d_model:])
+            keys_values.append((split_heads(k, self.nhead), split_heads(v, self.nhead)))
+        return keys_values
+
+    def init_self_attention_cache(self, batch_size, max_len, device):
+        """ Pre-allocated keys/values of the self attention of each layer (NxnheadxMax_lenxhead_dim) """
+        cache = []
+        for layer in self.Decoder.layers:
+            d_model = layer.self_attn.embed_dim
+            shape = (batch_size, self.nhead, max_len, d_model // self.nhead)
+            cache.append((torch.zeros(shape, device=device), torch.zeros(shape, device=device)))
+        return cache
+
+    def forward_step(self, tgt_step, step, memory_keys_values, self_attention_cache):
+        """ Decodes a single position (equivalent to forward() at that position with a causal mask)
+
+        :param tgt_step: (Tensor) Nx1xd_model input at position step
+        :param step: (int) position of tgt_step
+        :param memory_keys_values: (list) output of get_memory_keys_values()
+        :param self_attention_cache: (list) output of init_self_attention_cache(), updated in place
+        :return: (Tensor) Nx1xd_model
+        """
+        x = tgt_step
+        for layer, (mem_k, mem_v), (cache_k, cache_v) in zip(
+                self.Decoder.layers, memory_keys_values, self_attention_cache):
+            assert not layer.norm_first, "incremental decoding is only implemented for post-norm layers"
+
+            # self attention (over the cached positions and the new one)
+            q, k, v = torch.nn.functional.linear(
+                x, layer.self_attn.in_proj_weight, layer.self_attn.in_proj_bias).chunk(3, dim=-1)
+            cache_k[:, :, step:step + 1] = split_heads(k, self.nhead)
+            cache_v[:, :, step:step + 1] = split_heads(v, self.nhead)
+            sa = scaled_dot_product_attention(
+                split_heads(q, self.nhead), cache_k[:, :, :step + 1], cache_v[:, :, :step + 1])
+            x = layer.norm1(x + layer.dropout1(layer.self_attn.out_proj(merge_heads(sa))))
+
+            # cross attention
+            d_model = layer.multihead_attn.embed_dim
+            q = torch.nn.functional.linear(x, layer.multihead_attn.in_proj_weight[:d_model],
+                                           layer.multihead_attn.in_proj_bias[:d_model])
+            ca = scaled_dot_product_attention(split_heads(q, self.nhead), mem_k, mem_v)
+            x = layer.norm2(x + layer.dropout2(layer.multihead_attn.out_proj(merge_heads(ca))))
+
+            # feed forward
+            ff = layer.linear2(layer.dropout(layer.activation(layer.linear1(x))))
+            x = layer.norm3(x + layer.dropout3(ff))
+
+        if self.Decoder.norm is not None:
+            x = self.Decoder.norm(x)
+
+        return x
+
 # --------------------------------------------------------------------------------
 # ------------                     I/O Layers                ---------------------
 # --------------------------------------------------------------------------------
@@ -122,6 +203,15 @@ class InputLayer(torch.nn.Module):
 
         return out
 
+    def forward_step(self, src_step, step):
+        # src_step Nx1xembedding_size at position step (same as forward() at that position)
+        x = self.Linear(src_step)
+        x = self.ReLU(x)
+        x = x + self.PositionalEncoding.pe[:, step:step + 1, :]
+        out = self.PositionalEncoding.dropout(x)
+
+        return out
+
 class OutputLayer(torch.nn.Module):
     def __init__(self, embedding_size, d_model):
         super(OutputLayer, self).__init__()
@@ -32,6 +32,8 @@ class Density1D(torch.nn.Module):
             max_len_dec: the maximum length of the output sequence
             device: the device to use
             o_activation: the activation function to use for the output
+            precision: (optional, default 'fp32') 'fp32' or 'bf16' (bf16 autocast on the device of the inputs in the
+                        predict/sample methods, scripted versions of the model always run in fp32)
         """
 
         super(Density1D, self).__init__()
@@ -58,6 +60,8 @@ class Density1D(torch.nn.Module):
         self.max_len_dec = config['max_len_dec']
         self.device = config['device']
         self.o_activation = config['o_activation']
+        self.precision = config['precision'] if 'precision' in config else 'fp32'
+        assert self.precision in ['fp32', 'bf16'], 'precision must be fp32 or bf16'
 
         # New control params
         self.n_params = config['n_params']
@@ -106,47 +110,37 @@ class Density1D(torch.nn.Module):
         self.Decoder.DecoderInput.init_weights()
         self.Decoder.OutputLayer.init_weights(offset_activation=self.o_activation)
 
+    def get_latent_probs_and_reparametrize_to_z(self, src_, params_):
+        x = self.InputLayerEncoder(src_, params_)  # Nx32xd_model
+        memory = self.Encoder(x)  # Nx32xd_model
+        mu, log_var, latent_z = self.LatentEncoder(memory)
+        return mu, log_var, latent_z
+
+    @torch.jit.export
     def encode(self, src, params):
         """ Encodes a given input sequence of shape (batch_size, seq_len, embedding_size_src) into a latent space
         of shape (batch_size, latent_dim)
 
         :param src: the input sequence
-        :param eval: if True, the encoder will be in eval mode
+        :param params: the control params [batch_size]
         :return: mu, log_var, latent_z (each of shape [batch_size, latent_dim])
         """
-
-        def get_latent_probs_and_reparametrize_to_z(src_, params_):
-            x = self.InputLayerEncoder(src_, params_)  # Nx32xd_model
-            memory = self.Encoder(x)  # Nx32xd_model
-            mu, log_var, latent_z = self.LatentEncoder(memory)
-            return mu, log_var, latent_z
-
         if not self.training:
             with torch.no_grad():
-                return get_latent_probs_and_reparametrize_to_z(src, params)
+                return self.get_latent_probs_and_reparametrize_to_z(src, params)
         else:
-            self.train()
-            return get_latent_probs_and_reparametrize_to_z(src, params)
-
-    def encode_to_mu_logvar(self, src):
-        def get_mu_var(src_):
-            x = self.InputLayerEncoder(src_)  # Nx32xd_model
-            memory = self.Encoder(x)  # Nx32xd_model
-            mu, log_var, _ = self.LatentEncoder(memory)
-            return mu, log_var
+            return self.get_latent_probs_and_reparametrize_to_z(src, params)
 
-        if not self.training:
-            with torch.no_grad():
-                return get_mu_var(src)
-        else:
-            self.train()
-            return get_mu_var(src)
+    def encode_to_mu_logvar(self, src, params):
+        mu, log_var, _ = self.encode(src, params)
+        return mu, log_var
 
+    @torch.jit.export
     def reparametrize(self, mu, log_var):
         return self.LatentEncoder.reparametrize(mu, log_var)
 
-
-    def decode(self, latent_z, threshold=0.5):
+    @torch.jit.export
+    def decode(self, latent_z, threshold: float = 0.5):
         """ Decodes a given latent space of shape (batch_size, latent_dim) into a sequence of shape
         (batch_size, seq_len, embedding_size_tgt)
 
@@ -158,11 +152,11 @@ class Density1D(torch.nn.Module):
             with torch.no_grad():
                 return self.Decoder.decode(latent_z, threshold=threshold)
         else:
-            self.train()
             return self.Decoder.decode(latent_z, threshold=threshold)
 
+    @VAE_components.bf16_autocast
     def sample(self, latent_z, voice_thresholds, voice_max_count_allowed,
-           return_concatenated=False, sampling_mode=0):
+           return_concatenated=False, sampling_mode=0, temperature=1.0):
         """Converts the latent vector into hit, vel, offset values
 
         :param latent_z: (Tensor) [N x latent_dim]
@@ -171,13 +165,37 @@ class Density1D(torch.nn.Module):
         :param return_concatenated: (bool) Whether to return the concatenated tensor or the individual tensors
         :param sampling_mode: (int) 0 for top-k sampling,
                                     1 for bernoulli sampling
+        :param temperature: (float) temperature for sampling
         """
-        return self.Decoder.sample(
+        sample_fn = self.Decoder.sample_and_return_concatenated if return_concatenated else self.Decoder.sample
+        return sample_fn(
             latent_z=latent_z,
             voice_thresholds=voice_thresholds,
             voice_max_count_allowed=voice_max_count_allowed,
-            return_concatenated=return_concatenated,
-            sampling_mode=sampling_mode)
+            sampling_mode=sampling_mode,
+            temperature=temperature)
+
+    @torch.jit.export
+    @VAE_components.bf16_autocast
+    def sample_and_return_concatenated(self, latent_z, voice_thresholds, voice_max_count_allowed,
+                                       sampling_mode: int = 0, temperature: float = 1.0):
+        """Converts the latent vector into hit, vel, offset values and returns the concatenated tensor
+
+        :param latent_z: (Tensor) [N x latent_dim]
+        :param voice_thresholds: (Tensor) Thresholds for hit prediction
+        :param voice_max_count_allowed: (Tensor) Maximum number of hits to allow for each voice
+        :param sampling_mode: (int) 0 for top-k sampling,
+                                    1 for bernoulli sampling
+        :param temperature: (float) temperature for sampling
+        :Returns:
+        hvo, _h
+        """
+        return self.Decoder.sample_and_return_concatenated(
+            latent_z=latent_z,
+            voice_thresholds=voice_thresholds,
+            voice_max_count_allowed=voice_max_count_allowed,
+            sampling_mode=sampling_mode,
+            temperature=temperature)
 
     def forward(self, src, params):
         """ Converts a given input sequence of shape (batch_size, seq_len, embedding_size_src) into a
@@ -191,6 +209,20 @@ class Density1D(torch.nn.Module):
 
         return (h_logits, v_logits, o_logits), mu, log_var, latent_z
 
+    @torch.jit.export
+    @VAE_components.bf16_autocast
+    def encode_decode(self, src_, params_, thres: float):
+        mu, log_var, latent_z = self.encode(src_, params_)
+        h, v, o = self.Decoder.decode(latent_z, threshold=thres, use_thres=True)
+        return (h, v, o), mu, log_var, latent_z
+
+    @torch.jit.export
+    @VAE_components.bf16_autocast
+    def encode_decode_and_return_concatenated(self, src_, params_, thres: float):
+        mu, log_var, latent_z = self.encode(src_, params_)
+        hvo = self.Decoder.decode_and_return_concatenated(latent_z, threshold=thres, use_thres=True)
+        return hvo, mu, log_var, latent_z
+
     def predict(self, src, params, thres=0.5, return_concatenated=False):
         """
         Predicts the actual hvo array from the input Base
@@ -200,30 +232,59 @@ class Density1D(torch.nn.Module):
         :return: (full_hvo_array, mu, log_var, latent_z) if return_concatenated is False, else
         ((h, v, o), mu, log_var, latent_z)
         """
-        def encode_decode(src_, params_):
-            mu, log_var, latent_z = self.encode(src_, params_)
-            h, v, o = self.Decoder.decode(latent_z, threshold=thres, use_pd=False, use_thres=True,
-                                          return_concatenated=False)
-            if return_concatenated:
-                hvo = torch.cat((h, v, o), dim=-1)
-                return hvo, mu, log_var, latent_z
-            else:
-                return (h, v, o), mu, log_var, latent_z
+        if return_concatenated:
+            return self.predict_and_return_concatenated(src, params, thres=thres)
 
         if not self.training:
             with torch.no_grad():
-                return encode_decode(src, params)
+                return self.encode_decode(src, params, thres=thres)
         else:
-            return encode_decode(src, params)
+            return self.encode_decode(src, params, thres=thres)
 
-    def save(self, save_path, additional_info=None):
-        """ Saves the model to the given path. The Saved pickle has all the parameters ('params' field) as well as
-        the state_dict ('state_dict' field) """
-        if not save_path.endswith('.pth'):
-            save_path += '.pth'
-        os.makedirs(os.path.dirname(save_path), exist_ok=True)
+    @torch.jit.export
+    def predict_and_return_concatenated(self, src, params, thres: float = 0.5):
+        """
+        Predicts the actual hvo array from the input Base
+        :param src: the input sequence [batch_size, seq_len, embedding_size_src]
+        :param thres: (default=0.5) the threshold to use for the output
+        :return: (full_hvo_array, mu, log_var, latent_z)
+        """
+        if not self.training:
+            with torch.no_grad():
+                return self.encode_decode_and_return_concatenated(src, params, thres)
+        else:
+            return self.encode_decode_and_return_concatenated(src, params, thres)
+
+    def encode_to_latent_handle(self, src, params):
+        """ Encodes a batch once, so that it can be decoded many times using decode_latent_handle()
+
+        The control parameters condition the encoder, so a grid of control values is encoded at once: if params is
+        [num_params x batch_size] (e.g. a sweep over density values), src is repeated for each row of params and
+        all the rows are encoded in a single encoder pass
+
+        :param src: the input sequence [batch_size, seq_len, embedding_size_src]
+        :param params: [batch_size] or [num_params x batch_size] control values
+        :return: (LatentHandle) mu, log_var, latent_z (each of shape [(num_params x) batch_size x latent_dim])
+        """
+        return VAE_components.encode_to_latent_handle(self.encode, src, params)
 
-        params_dict = {
+    def decode_latent_handle(self, latent_handle, num_samples: int = 1, use_mean: bool = False,
+                             temperatures=(1.0, ), thres: float = 0.5, voice_thresholds=None,
+                             voice_max_count_allowed=None, sampling_mode: int = 0):
+        """ Decodes all the variations of an encoded batch (all control values, resampled z's and temperatures)
+        in a single decoder pass (see VAE_components.decode_latent_handle for the arguments)
+
+        :return: (Tensor) hvo [num_temperatures x num_samples x (num_params x) batch_size x seq_len x
+                                embedding_size_tgt]
+        """
+        return VAE_components.decode_latent_handle(
+            self.Decoder, latent_handle, num_samples=num_samples, use_mean=use_mean, temperatures=temperatures,
+            thres=thres, voice_thresholds=voice_thresholds, voice_max_count_allowed=voice_max_count_allowed,
+            sampling_mode=sampling_mode)
+
+    def get_params_dict(self):
+        """ Returns the parameters needed to re-instantiate the model (i.e. the config passed to __init__) """
+        return {
             'd_model_enc': self.d_model_enc,
             'd_model_dec': self.d_model_dec,
             'embedding_size_src': self.embedding_size_src,
@@ -240,10 +301,20 @@ class Density1D(torch.nn.Module):
             'max_len_dec': self.max_len_dec,
             'device': self.device.type if isinstance(self.device, torch.device) else self.device,
             'o_activation': self.o_activation,
+            'precision': self.precision,
             'n_params': self.n_params,
             'add_params': self.add_params
         }
 
+    def save(self, save_path, additional_info=None):
+        """ Saves the model to the given path. The Saved pickle has all the parameters ('params' field) as well as
+        the state_dict ('state_dict' field) """
+        if not save_path.endswith('.pth'):
+            save_path += '.pth'
+        os.makedirs(os.path.dirname(save_path), exist_ok=True)
+
+        params_dict = self.get_params_dict()
+
         json.dump(params_dict, open(save_path.replace('.pth', '.json'), 'w'))
         torch.save({'model_state_dict': self.state_dict(), 'params': params_dict,
                     'additional_info': additional_info}, save_path)
@@ -32,6 +32,8 @@ class Density2D(torch.nn.Module):
             max_len_dec: the maximum length of the output sequence
             device: the device to use
             o_activation: the activation function to use for the output
+            precision: (optional, default 'fp32') 'fp32' or 'bf16' (bf16 autocast on the device of the inputs in the
+                        predict/sample methods, scripted versions of the model always run in fp32)
         """
 
         super(Density2D, self).__init__()
@@ -58,6 +60,8 @@ class Density2D(torch.nn.Module):
         self.max_len_dec = config['max_len_dec']
         self.device = config['device']
         self.o_activation = config['o_activation']
+        self.precision = config['precision'] if 'precision' in config else 'fp32'
+        assert self.precision in ['fp32', 'bf16'], 'precision must be fp32 or bf16'
 
         # New control params
         self.n_params = config['n_params']
@@ -113,6 +117,7 @@ class Density2D(torch.nn.Module):
         mu, log_var, latent_z = self.LatentEncoder(memory)
         return mu, log_var, latent_z
 
+    @torch.jit.export
     def encode(self, src, params):
         """ Encodes a given input sequence of shape (batch_size, seq_len, embedding_size_src) into a latent space
         of shape (batch_size, latent_dim)
@@ -142,10 +147,12 @@ class Density2D(torch.nn.Module):
     #         self.train()
     #         return get_mu_var(src)
 
+    @torch.jit.export
     def reparametrize(self, mu, log_var):
         return self.LatentEncoder.reparametrize(mu, log_var)
 
 
+    @torch.jit.export
     def decode(self, latent_z, threshold: float = 0.5):
         """ Decodes a given latent space of shape (batch_size, latent_dim) into a sequence of shape
         (batch_size, seq_len, embedding_size_tgt)
@@ -161,6 +168,7 @@ class Density2D(torch.nn.Module):
             return self.Decoder.decode(latent_z, threshold=threshold)
 
     @torch.jit.export
+    @VAE_components.bf16_autocast
     def sample(self, latent_z, voice_thresholds, voice_max_count_allowed, sampling_mode: int = 0,
                temperature: float = 1.0):
         """Converts the latent vector into hit, vel, offset values
@@ -183,6 +191,7 @@ class Density2D(torch.nn.Module):
             temperature=temperature)
 
     @torch.jit.export
+    @VAE_components.bf16_autocast
     def sample_and_return_concatenated(self, latent_z, voice_thresholds, voice_max_count_allowed,
               sampling_mode: int = 0, temperature: float = 1.0):
         """Converts the latent vector into hit, vel, offset values and returns the concatenated tensor
@@ -214,25 +223,30 @@ class Density2D(torch.nn.Module):
 
         return (h_logits, v_logits, o_logits), mu, log_var, latent_z
 
+    @VAE_components.bf16_autocast
     def encode_decode(self, src_, params_, thres: float):
         mu, log_var, latent_z = self.encode(src_, params_)
         h, v, o = self.Decoder.decode(latent_z, threshold=thres, use_thres=True)
         return (h, v, o), mu, log_var, latent_z
 
     @torch.jit.export
+    @VAE_components.bf16_autocast
     def encode_decode_and_return_concatenated(self, src_, params_, thres: float):
         mu, log_var, latent_z = self.encode(src_, params_)
         hvo = self.Decoder.decode_and_return_concatenated(latent_z, threshold=thres, use_thres=True)
         return hvo, mu, log_var, latent_z
-    def predict(self, src, params,  thres: float = 0.5):
+
+    def predict(self, src, params,  thres: float = 0.5, return_concatenated: bool = False):
         """
         Predicts the actual hvo array from the input Base
         :param src: the input sequence [batch_size, seq_len, embedding_size_src]
         :param thres: (default=0.5) the threshold to use for the output
+        :param return_concatenated: (default=False) if True, the output will be a single array of shape
         :return: (full_hvo_array, mu, log_var, latent_z) if return_concatenated is False, else
         ((h, v, o), mu, log_var, latent_z)
         """
-
+        if return_concatenated:
+            return self.predict_and_return_concatenated(src, params, thres=thres)
 
         if not self.training:
             with torch.no_grad():
@@ -255,14 +269,36 @@ class Density2D(torch.nn.Module):
         else:
             return self.encode_decode_and_return_concatenated(src, params, thres)
 
-    def save(self, save_path, additional_info=None):
-        """ Saves the model to the given path. The Saved pickle has all the parameters ('params' field) as well as
-        the state_dict ('state_dict' field) """
-        if not save_path.endswith('.pth'):
-            save_path += '.pth'
-        os.makedirs(os.path.dirname(save_path), exist_ok=True)
+    def encode_to_latent_handle(self, src, params):
+        """ Encodes a batch once, so that it can be decoded many times using decode_latent_handle()
+
+        The control parameters condition the encoder, so a grid of control values is encoded at once: if params is
+        [num_params x batch_size] (e.g. a sweep over density values), src is repeated for each row of params and
+        all the rows are encoded in a single encoder pass
 
-        params_dict = {
+        :param src: the input sequence [batch_size, seq_len, embedding_size_src]
+        :param params: [batch_size] or [num_params x batch_size] control values
+        :return: (LatentHandle) mu, log_var, latent_z (each of shape [(num_params x) batch_size x latent_dim])
+        """
+        return VAE_components.encode_to_latent_handle(self.encode, src, params)
+
+    def decode_latent_handle(self, latent_handle, num_samples: int = 1, use_mean: bool = False,
+                             temperatures=(1.0, ), thres: float = 0.5, voice_thresholds=None,
+                             voice_max_count_allowed=None, sampling_mode: int = 0):
+        """ Decodes all the variations of an encoded batch (all control values, resampled z's and temperatures)
+        in a single decoder pass (see VAE_components.decode_latent_handle for the arguments)
+
+        :return: (Tensor) hvo [num_temperatures x num_samples x (num_params x) batch_size x seq_len x
+                                embedding_size_tgt]
+        """
+        return VAE_components.decode_latent_handle(
+            self.Decoder, latent_handle, num_samples=num_samples, use_mean=use_mean, temperatures=temperatures,
+            thres=thres, voice_thresholds=voice_thresholds, voice_max_count_allowed=voice_max_count_allowed,
+            sampling_mode=sampling_mode)
+
+    def get_params_dict(self):
+        """ Returns the parameters needed to re-instantiate the model (i.e. the config passed to __init__) """
+        return {
             'd_model_enc': self.d_model_enc,
             'd_model_dec': self.d_model_dec,
             'embedding_size_src': self.embedding_size_src,
@@ -279,10 +315,20 @@ class Density2D(torch.nn.Module):
             'max_len_dec': self.max_len_dec,
             'device': self.device.type if isinstance(self.device, torch.device) else self.device,
             'o_activation': self.o_activation,
+            'precision': self.precision,
             'n_params': self.n_params,
             'add_params': self.add_params
         }
 
+    def save(self, save_path, additional_info=None):
+        """ Saves the model to the given path. The Saved pickle has all the parameters ('params' field) as well as
+        the state_dict ('state_dict' field) """
+        if not save_path.endswith('.pth'):
+            save_path += '.pth'
+        os.makedirs(os.path.dirname(save_path), exist_ok=True)
+
+        params_dict = self.get_params_dict()
+
         json.dump(params_dict, open(save_path.replace('.pth', '.json'), 'w'))
         torch.save({'model_state_dict': self.state_dict(), 'params': params_dict,
                     'additional_info': additional_info}, save_path)
@@ -32,6 +32,8 @@ class GrooveTransformerEncoderVAE(torch.nn.Module):
             max_len_dec: the maximum length of the output sequence
             device: the device to use
             o_activation: the activation function to use for the output
+            precision: (optional, default 'fp32') 'fp32' or 'bf16' (bf16 autocast on the device of the inputs in the
+                        predict/sample methods, scripted versions of the model always run in fp32)
         """
 
         super(GrooveTransformerEncoderVAE, self).__init__()
@@ -58,6 +60,8 @@ class GrooveTransformerEncoderVAE(torch.nn.Module):
         self.max_len_dec = config['max_len_dec']
         self.device = config['device']
         self.o_activation = config['o_activation']
+        self.precision = config['precision'] if 'precision' in config else 'fp32'
+        assert self.precision in ['fp32', 'bf16'], 'precision must be fp32 or bf16'
 
         # Layers
         # ---------------------------------------------------
@@ -105,6 +109,7 @@ class GrooveTransformerEncoderVAE(torch.nn.Module):
 
 
 
+    @torch.jit.export
     def encode(self, src):
         """ Encodes a given input sequence of shape (batch_size, seq_len, embedding_size_src) into a latent space
         of shape (batch_size, latent_dim)
@@ -153,6 +158,7 @@ class GrooveTransformerEncoderVAE(torch.nn.Module):
             return self.Decoder.decode(latent_z, threshold=threshold)
 
     @torch.jit.export
+    @VAE_components.bf16_autocast
     def sample(self, latent_z, voice_thresholds, voice_max_count_allowed, sampling_mode: int = 0,
                temperature: float = 1.0):
         """Converts the latent vector into hit, vel, offset values
@@ -175,6 +181,7 @@ class GrooveTransformerEncoderVAE(torch.nn.Module):
             temperature=temperature)
 
     @torch.jit.export
+    @VAE_components.bf16_autocast
     def sample_and_return_concatenated(self, latent_z, voice_thresholds, voice_max_count_allowed,
               sampling_mode: int = 0, temperature: float = 1.0):
         """Converts the latent vector into hit, vel, offset values and returns the concatenated tensor
@@ -207,6 +214,7 @@ class GrooveTransformerEncoderVAE(torch.nn.Module):
         return (h_logits, v_logits, o_logits), mu, log_var, latent_z
 
     @torch.jit.export
+    @VAE_components.bf16_autocast
     def encode_decode(self, src_, thres: float):
         mu, log_var, latent_z = self.encode(src_)
         h, v, o = self.Decoder.decode(latent_z, threshold=thres, use_thres=True)
@@ -214,8 +222,7 @@ class GrooveTransformerEncoderVAE(torch.nn.Module):
 
     @torch.jit.export
     def encode_decode_and_return_concatenated(self, src_, thres: float):
-        mu, log_var, latent_z = self.encode(src_)
-        h, v, o = self.Decoder.decode(latent_z, threshold=thres, use_thres=True)
+        (h, v, o), mu, log_var, latent_z = self.encode_decode(src_, thres)
         hvo = torch.cat((h, v, o), dim=-1)
         return hvo, mu, log_var, latent_z
 
@@ -252,14 +259,33 @@ class GrooveTransformerEncoderVAE(torch.nn.Module):
             return self.encode_decode_and_return_concatenated(src, thres)
 
     @torch.jit.ignore
-    def save(self, save_path, additional_info=None):
-        """ Saves the model to the given path. The Saved pickle has all the parameters ('params' field) as well as
-        the state_dict ('state_dict' field) """
-        if not save_path.endswith('.pth'):
-            save_path += '.pth'
-        os.makedirs(os.path.dirname(save_path), exist_ok=True)
+    def encode_to_latent_handle(self, src):
+        """ Encodes a batch once, so that it can be decoded many times (e.g. at different temperatures or with
+        resampled z's) using decode_latent_handle()
+
+        :param src: the input sequence [batch_size, seq_len, embedding_size_src]
+        :return: (LatentHandle) mu, log_var, latent_z (each of shape [batch_size, latent_dim])
+        """
+        return VAE_components.encode_to_latent_handle(self.encode, src)
+
+    @torch.jit.ignore
+    def decode_latent_handle(self, latent_handle, num_samples: int = 1, use_mean: bool = False,
+                             temperatures=(1.0, ), thres: float = 0.5, voice_thresholds=None,
+                             voice_max_count_allowed=None, sampling_mode: int = 0):
+        """ Decodes all the variations of an encoded batch (resampled z's and temperatures) in a single decoder pass
+        (see VAE_components.decode_latent_handle for the arguments)
+
+        :return: (Tensor) hvo [num_temperatures x num_samples x batch_size x seq_len x embedding_size_tgt]
+        """
+        return VAE_components.decode_latent_handle(
+            self.Decoder, latent_handle, num_samples=num_samples, use_mean=use_mean, temperatures=temperatures,
+            thres=thres, voice_thresholds=voice_thresholds, voice_max_count_allowed=voice_max_count_allowed,
+            sampling_mode=sampling_mode)
 
-        params_dict = {
+    @torch.jit.ignore
+    def get_params_dict(self):
+        """ Returns the parameters needed to re-instantiate the model (i.e. the config passed to __init__) """
+        return {
             'd_model_enc': self.d_model_enc,
             'd_model_dec': self.d_model_dec,
             'embedding_size_src': self.embedding_size_src,
@@ -276,8 +302,19 @@ class GrooveTransformerEncoderVAE(torch.nn.Module):
             'max_len_dec': self.max_len_dec,
             'device': self.device.type if isinstance(self.device, torch.device) else self.device,
             'o_activation': self.o_activation,
+            'precision': self.precision,
         }
 
+    @torch.jit.ignore
+    def save(self, save_path, additional_info=None):
+        """ Saves the model to the given path. The Saved pickle has all the parameters ('params' field) as well as
+        the state_dict ('state_dict' field) """
+        if not save_path.endswith('.pth'):
+            save_path += '.pth'
+        os.makedirs(os.path.dirname(save_path), exist_ok=True)
+
+        params_dict = self.get_params_dict()
+
         json.dump(params_dict, open(save_path.replace('.pth', '.json'), 'w'))
         torch.save({'model_state_dict': self.state_dict(), 'params': params_dict,
                     'additional_info': additional_info}, save_path)
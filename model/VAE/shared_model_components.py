@@ -2,8 +2,10 @@
 
 import torch
 import math
+import contextlib
+import functools
 
-from typing import List
+from typing import List, NamedTuple, Optional
 
 # --------------------------------------------------------------------------------
 # ------------       Positinal Encoding BLOCK                ---------------------
@@ -168,7 +170,6 @@ class InputLayer2DParam(torch.nn.Module):
         params = torch.unsqueeze(params, dim=2)
         params = params.repeat(1, hvo.shape[1], 1)
         src = torch.cat((hvo, params), dim=2)
-        print("src shape: ", src.shape)
         x = self.Linear(src)
         x = self.ReLU(x)
         out = self.PositionalEncoding(x)
@@ -303,6 +304,164 @@ class DecoderInput(torch.nn.Module):
         return result
 
 
+# --------------------------------------------------------------------------------
+# ------------                  HIT SAMPLING                 ---------------------
+# --------------------------------------------------------------------------------
+def get_per_voice_ranks(scores):
+    """Ranks (0 for the largest score) of each time step within its own (batch row, voice) column
+
+    :param scores: (Tensor) [N x max_len x num_voices]
+    :return: (Tensor) [N x max_len x num_voices] (long)
+    """
+    order = torch.argsort(scores, dim=1, descending=True)
+    return torch.argsort(order, dim=1)
+
+
+def sample_hits(hit_probs, voice_thresholds, voice_max_count_allowed, sampling_mode: int = 0):
+    """Samples the hits of a batch of sequences, independently for every batch row and voice
+
+    :param hit_probs: (Tensor) [N x max_len x num_voices] hit probabilities
+    :param voice_thresholds: (Tensor) [num_voices] or [N x num_voices] thresholds for hit prediction
+                            (only used for top-k sampling)
+    :param voice_max_count_allowed: (Tensor) [num_voices] or [N x num_voices] Maximum number of hits to allow
+                            for each voice
+    :param sampling_mode: (int) 0 for top-k sampling (the max_count most probable steps above the threshold),
+                                1 for bernoulli sampling (the max_count most probable steps among the sampled ones)
+    :return: (Tensor) [N x max_len x num_voices] hits (0 or 1, same dtype as hit_probs)
+    """
+    max_counts = voice_max_count_allowed.to(device=hit_probs.device, dtype=hit_probs.dtype)
+    max_counts = max_counts.reshape(-1, 1, hit_probs.shape[-1])
+
+    if sampling_mode == 0:
+        thresholds = voice_thresholds.to(device=hit_probs.device, dtype=hit_probs.dtype)
+        thresholds = thresholds.reshape(-1, 1, hit_probs.shape[-1])
+        candidates = hit_probs > thresholds
+        scores = hit_probs
+    elif sampling_mode == 1:
+        candidates = torch.bernoulli(hit_probs) > 0
+        scores = torch.where(candidates, hit_probs, torch.zeros_like(hit_probs))
+    else:
+        raise ValueError(f"sampling_mode {sampling_mode} is not supported")
+
+    # steps that are not candidates are ranked last, so they never take the place of a candidate
+    ranks = get_per_voice_ranks(torch.where(candidates, scores, torch.full_like(scores, -1.0)))
+    return (candidates & (ranks < max_counts)).to(hit_probs.dtype)
+
+
+# --------------------------------------------------------------------------------
+# ------------                 MIXED PRECISION               ---------------------
+# --------------------------------------------------------------------------------
+def autocast_if_bf16(precision: str, device_type: str):
+    """ bf16 autocast on the given device type if precision is 'bf16', otherwise a no-op context (eager only) """
+    if precision == "bf16":
+        return torch.autocast(device_type=device_type, dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+
+def _to_float(outputs):
+    """ Casts the (nested tuples of) floating point tensors back to float32 """
+    if isinstance(outputs, torch.Tensor):
+        return outputs.float() if outputs.is_floating_point() else outputs
+    if isinstance(outputs, tuple):
+        return tuple(_to_float(output) for output in outputs)
+    return outputs
+
+
+def bf16_autocast(method):
+    """ Runs a model method under autocast_if_bf16(self.precision, device of the first tensor argument) and returns
+    float32 outputs. torch.jit.script compiles the undecorated method, so scripted models always run in fp32
+    (place it below @torch.jit.export) """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.precision != "bf16":
+            return method(self, *args, **kwargs)
+        device_type = next(arg.device.type for arg in list(args) + list(kwargs.values())
+                           if isinstance(arg, torch.Tensor))
+        with autocast_if_bf16(self.precision, device_type):
+            outputs = method(self, *args, **kwargs)
+        return _to_float(outputs)
+    return wrapper
+
+
+# --------------------------------------------------------------------------------
+# ------------                 LATENT HANDLES                ---------------------
+# --------------------------------------------------------------------------------
+class LatentHandle(NamedTuple):
+    """ A batch encoded once (see encode_to_latent_handle() in the VAE models), to be decoded as many times as needed
+    using decode_latent_handle(). Each tensor is [... x latent_dim] """
+    mu: torch.Tensor
+    log_var: torch.Tensor
+    latent_z: torch.Tensor
+
+
+def get_latent_variations(latent_handle: LatentHandle, num_samples: int = 1, use_mean: bool = False):
+    """Gets the latent vectors to decode from a latent handle
+
+    :param latent_handle: (LatentHandle) output of encode_to_latent_handle()
+    :param num_samples: (int) number of z's to draw from N(mu, var). If 1, the z sampled at encoding time is used
+    :param use_mean: (bool) if True, mu is used instead of sampling (num_samples is ignored)
+    :return: (Tensor) [num_samples x ... x latent_dim] ([1 x ... x latent_dim] if use_mean or num_samples is 1)
+    """
+    if use_mean:
+        return latent_handle.mu.unsqueeze(0)
+    if num_samples == 1:
+        return latent_handle.latent_z.unsqueeze(0)
+    std = torch.exp(0.5 * latent_handle.log_var)
+    eps = torch.randn((num_samples,) + tuple(std.shape), device=std.device, dtype=std.dtype)
+    return eps * std.unsqueeze(0) + latent_handle.mu.unsqueeze(0)
+
+
+def encode_to_latent_handle(encode_fn, src, params=None):
+    """Encodes a batch once (shared by the encode_to_latent_handle() methods of the VAE models)
+
+    The control parameters condition the encoder, so a grid of control values is encoded at once: if params is
+    [num_params x batch_size] (e.g. a sweep over density values), src is repeated for each row of params and all the
+    rows are encoded in a single encoder pass
+
+    :param encode_fn: the encode() method of the model (encode(src) or encode(src, params))
+    :param src: (Tensor) [batch_size x seq_len x embedding_size_src] the input sequence
+    :param params: (Tensor) None for models without control params, [batch_size] or [num_params x batch_size]
+    :return: (LatentHandle) mu, log_var, latent_z (each of shape [(num_params x) batch_size x latent_dim])
+    """
+    if params is None:
+        mu, log_var, latent_z = encode_fn(src)
+        return LatentHandle(mu, log_var, latent_z)
+    if params.dim() == 1:
+        mu, log_var, latent_z = encode_fn(src, params)
+        return LatentHandle(mu, log_var, latent_z)
+
+    n_params, batch_size = params.shape[0], params.shape[1]
+    src_ = src.unsqueeze(0).expand((n_params,) + tuple(src.shape)).reshape((-1,) + tuple(src.shape[1:]))
+    mu, log_var, latent_z = encode_fn(src_, params.reshape(-1))
+    return LatentHandle(mu.reshape(n_params, batch_size, -1), log_var.reshape(n_params, batch_size, -1),
+                        latent_z.reshape(n_params, batch_size, -1))
+
+
+def decode_latent_handle(decoder, latent_handle, num_samples: int = 1, use_mean: bool = False,
+                         temperatures=(1.0, ), thres: float = 0.5, voice_thresholds=None,
+                         voice_max_count_allowed=None, sampling_mode: int = 0):
+    """Decodes all the variations of an encoded batch (resampled z's, temperatures and, for the density models, all
+    the control values) in a single decoder pass (shared by the decode_latent_handle() methods of the VAE models)
+
+    :param decoder: (VAE_Decoder) the decoder of the model
+    :param latent_handle: (LatentHandle) output of encode_to_latent_handle()
+    :param num_samples: (int) number of z's to resample from N(mu, var) (1: use the z sampled at encoding)
+    :param use_mean: (bool) if True, mu is decoded instead of sampled z's
+    :param temperatures: (list/Tensor) temperatures applied to the hit logits
+    :param thres: (float) threshold for hits (used if voice_thresholds/voice_max_count_allowed are not given)
+    :param voice_thresholds: (Tensor) [num_voices] Thresholds for hit prediction
+    :param voice_max_count_allowed: (Tensor) [num_voices] Maximum number of hits to allow for each voice
+    :param sampling_mode: (int) 0 for top-k sampling,
+                                1 for bernoulli sampling
+    :return: (Tensor) hvo [num_temperatures x num_samples x ... x batch_size x seq_len x embedding_size_tgt]
+    """
+    latent_z = get_latent_variations(latent_handle, num_samples=num_samples, use_mean=use_mean)
+    return decoder.decode_variations(
+        latent_z, torch.as_tensor(temperatures, dtype=latent_z.dtype), threshold=thres,
+        voice_thresholds=voice_thresholds, voice_max_count_allowed=voice_max_count_allowed,
+        sampling_mode=sampling_mode)
+
+
 class VAE_Decoder(torch.nn.Module):
     """
     Decoder for the VAE model
@@ -358,7 +517,7 @@ class VAE_Decoder(torch.nn.Module):
             h = torch.where(_h > thres, 1, 0)
 
         else:
-            pd = torch.rand(_h.shape[0], _h.shape[1])
+            pd = torch.rand_like(_h)
             h = torch.where(_h > pd, 1, 0)
 
         return h
@@ -421,8 +580,9 @@ class VAE_Decoder(torch.nn.Module):
         """Converts the latent vector into hit, vel, offset values
 
         :param latent_z: (Tensor) [N x latent_dim]
-        :param voice_thresholds: (torch.FloatTensor) Thresholds for hit prediction
+        :param voice_thresholds: (torch.FloatTensor) Thresholds for hit prediction ([num_voices] or [N x num_voices])
         :param voice_max_count_allowed: (torch.FloatTensor) Maximum number of hits to allow for each voice
+                                        ([num_voices] or [N x num_voices])
         :param sampling_mode: (int) 0 for top-k sampling,
                                     1 for bernoulli sampling
         :param temperature: (float) Temperature for sampling
@@ -431,7 +591,6 @@ class VAE_Decoder(torch.nn.Module):
         with torch.no_grad():
             h_logits, v_logits, o_logits = self.forward(latent_z)
             _h = 1.0 / (1.0 + torch.exp(-h_logits / temperature))
-            h = torch.zeros_like(_h)
 
             v = torch.sigmoid(v_logits)
 
@@ -442,21 +601,60 @@ class VAE_Decoder(torch.nn.Module):
             else:
                 raise ValueError(f"{self.o_activation} for offsets is not supported")
 
-            if sampling_mode == 0:
-                for ix, (thres, max_count) in enumerate(zip(voice_thresholds, voice_max_count_allowed)):
-                    max_indices = torch.topk(_h[:, :, ix], max_count.item()).indices[0]
-                    h[:, max_indices, ix] = _h[:, max_indices, ix]
-                    h[:, :, ix] = torch.where(h[:, :, ix] > thres, 1, 0)
-            elif sampling_mode == 1:
-                for ix, (thres, max_count) in enumerate(zip(voice_thresholds, voice_max_count_allowed)):
-                    # sample using probability distribution of hits (_h)
-                    voice_probs = _h[:, :, ix]
-                    sampled_indices = torch.bernoulli(voice_probs)
-                    max_indices = torch.topk(sampled_indices*voice_probs, max_count.item()).indices[0]
-                    h[:, max_indices, ix] = 1
+            h = sample_hits(_h, voice_thresholds, voice_max_count_allowed, sampling_mode=sampling_mode)
 
             return h, v, o, _h
 
+    @torch.jit.export
+    def decode_variations(self, latent_z, temperatures: torch.Tensor, threshold: float = 0.5,
+                          voice_thresholds: Optional[torch.Tensor] = None,
+                          voice_max_count_allowed: Optional[torch.Tensor] = None, sampling_mode: int = 0):
+        """Decodes any number of latent vectors in a single decoder pass, and activates the hits at several
+        temperatures (the temperatures only change the activation, so the logits are computed once)
+
+        :param latent_z: (Tensor) [... x latent_dim] (e.g. [num_samples x N x latent_dim])
+        :param temperatures: (Tensor) [num_temperatures] temperatures applied to the hit logits
+        :param threshold: (float) Threshold for hit prediction (used if no per voice thresholds/counts are given)
+        :param voice_thresholds: (Tensor) [num_voices] Thresholds for hit prediction (default: threshold)
+        :param voice_max_count_allowed: (Tensor) [num_voices] Maximum number of hits to allow for each voice
+                                        (default: no limit)
+        :param sampling_mode: (int) 0 for top-k sampling,
+                                    1 for bernoulli sampling
+        :return: (Tensor) [num_temperatures x ... x max_len x (num_voices * 3)]
+        """
+        with torch.no_grad():
+            leading_shape = latent_z.shape[:-1]
+            h_logits, v_logits, o_logits = self.forward(latent_z.reshape(-1, latent_z.shape[-1]))
+            n_rows, n_steps, n_voices = h_logits.shape[0], h_logits.shape[1], h_logits.shape[2]
+
+            temperatures = temperatures.to(device=h_logits.device, dtype=h_logits.dtype).reshape(-1, 1, 1, 1)
+            _h = torch.sigmoid(h_logits.unsqueeze(0) / temperatures)
+            n_temperatures = _h.shape[0]
+
+            if voice_thresholds is None and voice_max_count_allowed is None and sampling_mode == 0:
+                h = (_h > threshold).to(_h.dtype)
+            else:
+                if voice_thresholds is None:
+                    voice_thresholds = torch.full((n_voices,), threshold, device=_h.device)
+                if voice_max_count_allowed is None:
+                    voice_max_count_allowed = torch.full((n_voices,), float(n_steps), device=_h.device)
+                h = sample_hits(_h.reshape(-1, n_steps, n_voices), voice_thresholds, voice_max_count_allowed,
+                                sampling_mode=sampling_mode)
+                h = h.reshape(n_temperatures, n_rows, n_steps, n_voices)
+
+            v = torch.sigmoid(v_logits)
+            if self.o_activation == "tanh":
+                o = torch.tanh(o_logits) * 0.5
+            elif self.o_activation == "sigmoid":
+                o = torch.sigmoid(o_logits) - 0.5
+            else:
+                raise ValueError(f"{self.o_activation} for offsets is not supported")
+
+            vo = torch.cat((v, o), dim=-1).unsqueeze(0).expand(n_temperatures, n_rows, n_steps, 2 * n_voices)
+            hvo = torch.cat((h, vo), dim=-1)
+
+            return hvo.reshape([n_temperatures] + list(leading_shape) + [n_steps, 3 * n_voices])
+
     @torch.jit.export
     def sample_and_return_concatenated(self, latent_z, voice_thresholds: torch.FloatTensor,
                                        voice_max_count_allowed: torch.FloatTensor, sampling_mode: int = 0,
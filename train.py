@@ -1,11 +1,20 @@
 import os
+import gc
 
 import wandb
 
 import torch
 from model import GrooveTransformerEncoderVAE
 from helpers import vae_train_utils, vae_test_utils
-from data.src.dataLoaders import MonotonicGrooveDataset, MegaMonotonicGrooveDataset
+from helpers.VAE.augmentation import BatchAugmenter
+from helpers.VAE.compile_utils import compile_model, warmup_compiled_model
+from helpers.VAE import distributed_utils, checkpointing
+from helpers.VAE.thread_tuner import apply_machine_profile
+from helpers.VAE.profiling import PhaseProfiler
+from helpers.VAE.eval_worker import EvalWorker, WHEN_FULL_POLICIES
+from helpers.metrics_sink import init_metrics_sink, BACKENDS
+from data.src.dataLoaders import MonotonicGrooveDataset, MegaMonotonicGrooveDataset, SharedMemoryGrooveDataset, \
+    TensorBatchIterator
 from torch.utils.data import DataLoader
 from logging import getLogger, DEBUG
 import yaml
@@ -30,6 +39,12 @@ parser.add_argument("--wandb", type=bool, help="log to wandb", default=True)
 parser.add_argument(
     "--config",
     help="Yaml file for configuration. If available, the rest of the arguments will be ignored", default=None)
+parser.add_argument("--logger", type=str, help="metrics backend - 'wandb', 'local' (offline jsonl + media files) or "
+                                              "'disabled'", default="wandb", choices=list(BACKENDS))
+parser.add_argument("--log_dir", type=str, help="root folder of the runs logged with --logger local",
+                    default="misc/logs")
+parser.add_argument("--histogram_every_n_steps", type=int, help="log histograms at most once every n steps", default=1)
+parser.add_argument("--watch_log_freq", type=int, help="log parameter/gradient histograms every n steps", default=1)
 parser.add_argument("--wandb_project", type=str, help="WANDB Project Name",
                     default="mega_drum_no_balancing")
 
@@ -70,12 +85,39 @@ parser.add_argument("--beta_annealing_start_first_rise_at_epoch", type=int, help
 # ----------------------- Training Parameters -----------------------
 parser.add_argument("--dropout", type=float, help="Dropout", default=0.4)
 parser.add_argument("--force_data_on_cuda", type=bool, help="places all training data on cude", default=True)
+parser.add_argument("--num_workers", type=int,
+                    help="Number of data loading worker processes (data not on cuda is then shared via memory maps)",
+                    default=0)
+parser.add_argument("--in_memory_batches", type=bool, help="slice the batches directly out of the dataset tensors "
+                    "(cpu or cuda) instead of collating them sample by sample with a DataLoader", default=True)
 parser.add_argument("--epochs", type=int, help="Number of epochs", default=100)
 parser.add_argument("--batch_size", type=int, help="Batch size", default=64)
 parser.add_argument("--lr", type=float, help="Learning rate", default=1e-4)
+parser.add_argument("--machine_profile", type=str, help="tuned thread counts of this machine used when training on "
+                    "cpu (see helpers/VAE/thread_tuner.py) - 'auto', 'none' or the path of a profile", default="auto")
+parser.add_argument("--batch_size_from_profile", type=bool, help="also use the tuned batch size of the machine profile",
+                    default=False)
 parser.add_argument("--optimizer", type=str, help="optimizer to use - either 'sgd' or 'adam' loss", default="sgd",
                     choices=['sgd', 'adam'])
 parser.add_argument("--reduce_loss_by_sum", type=int, help="reduce loss by summing over all dimensions", default=0)
+parser.add_argument("--compile", type=bool, help="compile the forward/backward pass with torch.compile (falls "
+                                                 "back to eager if compilation fails)", default=False)
+parser.add_argument("--distributed", type=bool, help="data parallel training over the ranks launched with torchrun "
+                                                     "(gloo backend, cpu) - batch_size is split across the ranks",
+                    default=False)
+parser.add_argument("--precision", type=str, help="precision of the forward pass - either 'fp32' or 'bf16' "
+                                                  "(bfloat16 autocast, losses stay in float32)", default="fp32",
+                    choices=['fp32', 'bf16'])
+
+# ----------------------- Augmentation Parameters -----------------------
+parser.add_argument("--augment_event_removal_prob", type=float,
+                    help="probability of removing random events from a training sample", default=0.0)
+parser.add_argument("--augment_velocity_scale_min", type=float, help="min per sample velocity scaling", default=1.0)
+parser.add_argument("--augment_velocity_scale_max", type=float, help="max per sample velocity scaling", default=1.0)
+parser.add_argument("--augment_velocity_jitter_std", type=float, help="std of velocity jitter", default=0.0)
+parser.add_argument("--augment_offset_jitter_std", type=float, help="std of microtiming jitter", default=0.0)
+parser.add_argument("--augment_voice_dropout_prob", type=float, help="probability of muting each voice", default=0.0)
+parser.add_argument("--augmentation_seed", type=int, help="seed for the augmentation generator", default=None)
 
 # ----------------------- Data Parameters -----------------------
 parser.add_argument("--dataset_json_dir", type=str,
@@ -99,11 +141,29 @@ parser.add_argument("--calculate_hit_scores_on_test", type=bool,
 parser.add_argument("--piano_roll_samples", type=bool, help="Generate audio samples", default=True)
 parser.add_argument("--piano_roll_frequency", type=int, help="Frequency of piano roll generation", default=20)
 parser.add_argument("--hit_score_frequency", type=int, help="Frequency of hit score generation", default=10)
+parser.add_argument("--eval_in_background", type=bool, help="run the piano rolls, umap and hit scores in a "
+                    "background process on snapshots of the model (the training doesn't wait for them)", default=False)
+parser.add_argument("--eval_max_pending", type=int, help="max number of snapshots waiting for the background "
+                                                         "evaluation", default=1)
+parser.add_argument("--eval_when_full", type=str, help="'skip' the snapshot or 'block' the training when "
+                    "eval_max_pending snapshots are already waiting", default="skip", choices=list(WHEN_FULL_POLICIES))
+parser.add_argument("--eval_worker_threads", type=int, help="number of torch threads of the evaluation worker",
+                    default=1)
+parser.add_argument("--log_batch_histograms", type=bool, help="log histograms of the per batch losses", default=False)
+parser.add_argument("--profile", type=bool, help="record the wall time of each training/evaluation phase per epoch "
+                                                 "(saved as profile.jsonl/csv and logged to wandb)", default=False)
+parser.add_argument("--profile_trace_epochs", type=int, nargs=2, default=None,
+                    help="first and last epoch to record in a torch.profiler chrome trace (requires --profile)")
 
 # ----------------------- Misc Params -----------------------
 parser.add_argument("--save_model", type=bool, help="Save model", default=True)
 parser.add_argument("--save_model_dir", type=str, help="Path to save the model", default="misc/VAE")
 parser.add_argument("--save_model_frequency", type=int, help="Save model every n epochs", default=10)
+parser.add_argument("--checkpoint_frequency", type=int,
+                    help="Save the full training state (in the background) every n epochs (0 to disable)", default=1)
+parser.add_argument("--keep_last_checkpoints", type=int, help="Number of training state checkpoints to keep", default=3)
+parser.add_argument("--resume", type=str, default=None,
+                    help="Training state checkpoint (or folder of checkpoints, the latest is used) to resume from")
 
 
 args, unknown = parser.parse_known_args()
@@ -151,9 +211,17 @@ else:
         lr=args.lr,
         optimizer=args.optimizer,
         reduce_loss_by_sum=True if args.reduce_loss_by_sum == 1 else False,
+        precision=args.precision,
         is_testing=args.is_testing,
         dataset_json_dir=args.dataset_json_dir,
         dataset_json_fname=args.dataset_json_fname,
+        augment_event_removal_prob=args.augment_event_removal_prob,
+        augment_velocity_scale_min=args.augment_velocity_scale_min,
+        augment_velocity_scale_max=args.augment_velocity_scale_max,
+        augment_velocity_jitter_std=args.augment_velocity_jitter_std,
+        augment_offset_jitter_std=args.augment_offset_jitter_std,
+        augment_voice_dropout_prob=args.augment_voice_dropout_prob,
+        augmentation_seed=args.augmentation_seed,
         device="cuda" if torch.cuda.is_available() else "cpu"
     )
 
@@ -167,21 +235,52 @@ assert "wandb_project" in hparams.keys(), "wandb_project not specified"
 
 if __name__ == "__main__":
 
-    # Initialize wandb
+    # Initialize the process group if training data parallel (only rank 0 logs, evaluates and saves)
+    # ----------------------------------------------------------------------------------------------------------
+    if args.distributed:
+        rank, world_size = distributed_utils.init_distributed(backend="gloo")
+        hparams["device"] = "cpu"
+    else:
+        rank, world_size = 0, 1
+
+    # Load the training state if resuming (the run continues with the config and in the wandb run of the checkpoint)
+    # ----------------------------------------------------------------------------------------------------------
+    resume_state = checkpointing.load_checkpoint(args.resume) if args.resume is not None else None
+    if resume_state is not None:
+        hparams = resume_state["config"]
+
+    # Use the tuned thread counts (and batch size if asked for) of this machine when training on cpu
     # ----------------------------------------------------------------------------------------------------------
-    wandb_run = wandb.init(
+    if hparams.get("device") == "cpu" and not args.distributed:
+        machine_settings = apply_machine_profile("train", model_type="vae", path=args.machine_profile,
+                                                 model_config=hparams)
+        if machine_settings is not None and args.batch_size_from_profile and resume_state is None:
+            hparams["batch_size"] = machine_settings["batch_size"]
+
+    # Initialize the metrics sink (wandb, local or disabled - only rank 0 logs)
+    # ----------------------------------------------------------------------------------------------------------
+    sink = init_metrics_sink(
+        args.logger,
         config=hparams,                         # either from config file or CLI specified hyperparameters
         project=hparams["wandb_project"],          # name of the project
+        output_dir=args.log_dir,
+        histogram_every_n_steps=args.histogram_every_n_steps,
+        run_id=resume_state["wandb_run_id"] if resume_state is not None else None,
+        resume=resume_state is not None,
+        enabled=rank == 0,
         anonymous="allow",
         entity="nime2022_anon",                          # saves in the mmil_vae_cntd team account
-        settings=wandb.Settings(code_dir="train.py")    # for code saving
+        settings=wandb.Settings(code_dir="train.py")    # for code saving (wandb only)
     )
 
-    # Reset config to wandb.config (in case of sweeping with YAML necessary)
+    # Reset config to sink.config (wandb.config in case of sweeping with YAML necessary)
+    # the other ranks use the config of rank 0 (which may have been modified by a sweep)
     # ----------------------------------------------------------------------------------------------------------
-    config = wandb.config
-    run_name = wandb_run.name
-    run_id = wandb_run.id
+    if args.distributed:
+        sink.config.update(distributed_utils.broadcast_object(sink.config.as_dict()), allow_val_change=True)
+    config = sink.config
+    run_name = sink.run_name
+    run_id = sink.run_id
     collapse_tapped_sequence = (args.embedding_size_src == 3)
     # Load Training and Testing Datasets and Wrap them in torch.utils.data.Dataloader
     # ----------------------------------------------------------------------------------------------------------
@@ -196,7 +295,24 @@ if __name__ == "__main__":
         move_all_to_gpu=should_place_all_data_on_cuda,
     )
 
-    train_dataloader = DataLoader(training_dataset, batch_size=config.batch_size, shuffle=True)
+    if args.distributed:
+        # each rank trains on its own shard of the training set
+        train_dataloader = distributed_utils.get_distributed_dataloader(
+            training_dataset, batch_size=max(1, config.batch_size // world_size), shuffle=True,
+            seed=config.get("seed", 0), num_workers=args.num_workers, persistent_workers=args.num_workers > 0)
+    elif args.num_workers > 0 and not should_place_all_data_on_cuda:
+        # share the arrays with the worker processes via memory mapped files and freeze the objects created so far
+        # so that the garbage collector in the forked workers doesn't touch (and copy) them
+        training_dataset = SharedMemoryGrooveDataset(training_dataset)
+        gc.collect()
+        gc.freeze()
+        train_dataloader = DataLoader(training_dataset, batch_size=config.batch_size, shuffle=True,
+                                      num_workers=args.num_workers, persistent_workers=True)
+    elif args.in_memory_batches:
+        # the whole dataset already sits in (cpu or cuda) tensors, the batches are sliced out of them directly
+        train_dataloader = TensorBatchIterator(training_dataset, batch_size=config.batch_size, shuffle=True)
+    else:
+        train_dataloader = DataLoader(training_dataset, batch_size=config.batch_size, shuffle=True)
 
     test_dataset = MonotonicGrooveDataset(
         dataset_setting_json_path="data/dataset_json_settings/4_4_Beats_gmd.json",
@@ -208,14 +324,27 @@ if __name__ == "__main__":
         move_all_to_gpu=should_place_all_data_on_cuda
     )
 
-    test_dataloader = DataLoader(test_dataset, batch_size=config.batch_size, shuffle=True)
+    if args.in_memory_batches:
+        test_dataloader = TensorBatchIterator(test_dataset, batch_size=config.batch_size, shuffle=True)
+    else:
+        test_dataloader = DataLoader(test_dataset, batch_size=config.batch_size, shuffle=True)
 
     # Initialize the model
     # ------------------------------------------------------------------------------------------------------------
     groove_transformer_vae_cpu = GrooveTransformerEncoderVAE(config)
 
     groove_transformer_vae = groove_transformer_vae_cpu.to(config.device)
-    wandb.watch(groove_transformer_vae, log="all", log_freq=1)
+    if rank == 0:
+        sink.watch(groove_transformer_vae, log_freq=args.watch_log_freq)
+
+    if args.compile:
+        compile_model(groove_transformer_vae)
+        groove_transformer_vae.train()
+        warmup_compiled_model(groove_transformer_vae, batch_sizes=(config.batch_size // world_size, ), training=True)
+
+    # the replicas start from the weights of rank 0 and their gradients are averaged after each backward pass
+    # (evaluation and saving use the unwrapped model)
+    train_model = distributed_utils.wrap_model(groove_transformer_vae) if args.distributed else groove_transformer_vae
 
     # Instantiate the loss Criterion and Optimizer
     # ------------------------------------------------------------------------------------------------------------
@@ -236,33 +365,94 @@ if __name__ == "__main__":
         offset_loss_fn = torch.nn.MSELoss(reduction='none')
 
     if config.optimizer == 'adam':
-        optimizer = torch.optim.Adam(groove_transformer_vae.parameters(), lr=config.lr)
+        optimizer = torch.optim.Adam(train_model.parameters(), lr=config.lr)
     else:
-        optimizer = torch.optim.SGD(groove_transformer_vae.parameters(), lr=config.lr)
+        optimizer = torch.optim.SGD(train_model.parameters(), lr=config.lr)
+
+    # On-device augmentation of the training batches (inactive with the default parameters)
+    # ------------------------------------------------------------------------------------------------------------
+    augmenter = BatchAugmenter(
+        event_removal_prob=config.get("augment_event_removal_prob", args.augment_event_removal_prob),
+        velocity_scale_range=(config.get("augment_velocity_scale_min", args.augment_velocity_scale_min),
+                              config.get("augment_velocity_scale_max", args.augment_velocity_scale_max)),
+        velocity_jitter_std=config.get("augment_velocity_jitter_std", args.augment_velocity_jitter_std),
+        offset_jitter_std=config.get("augment_offset_jitter_std", args.augment_offset_jitter_std),
+        voice_dropout_prob=config.get("augment_voice_dropout_prob", args.augment_voice_dropout_prob),
+        tapped_voice_idx=2,
+        collapse_tapped_sequence=collapse_tapped_sequence,
+        seed=config.get("augmentation_seed", args.augmentation_seed))
+    augmenter = augmenter if augmenter.is_active else None
 
     # Iterate over epochs
     # ------------------------------------------------------------------------------------------------------------
     metrics = dict()
     step_ = 0
 
-    beta_np_cyc = vae_train_utils.generate_beta_curve(
+    # (the beta curve is per epoch, and every rank goes through the same epochs, but the curve of rank 0 is used
+    # everywhere to be sure the KL terms of all the ranks are scaled alike)
+    beta_np_cyc = distributed_utils.broadcast_object(vae_train_utils.generate_beta_curve(
         n_epochs=config.epochs, 
         period_epochs=config.beta_annealing_per_cycle_period,
         rise_ratio=config.beta_annealing_per_cycle_rising_ratio,
-        start_first_rise_at_epoch=config.beta_annealing_start_first_rise_at_epoch)
-
-    for epoch in range(config.epochs):
+        start_first_rise_at_epoch=config.beta_annealing_start_first_rise_at_epoch))
+
+    # Restore the training state right before the epoch loop (so that the random number generators continue exactly
+    # where they were), and write the training states in the background
+    # (every rank restores the same state, the checkpoints are written by rank 0)
+    # (the augmenter and the in memory batch iterators have their own generators)
+    stateful_objects = {name: obj for name, obj in [("augmenter", augmenter), ("train_batches", train_dataloader),
+                                                    ("test_batches", test_dataloader)]
+                        if obj is not None and hasattr(obj, "load_state_dict")}
+    start_epoch = 0
+    if resume_state is not None:
+        start_epoch, step_ = checkpointing.restore_training_state(
+            resume_state, groove_transformer_vae, optimizer, stateful_objects=stateful_objects)
+    checkpointer = checkpointing.AsyncCheckpointer(
+        f"{args.save_model_dir}/{args.wandb_project}/{run_name}_{run_id}/checkpoints",
+        keep_last=args.keep_last_checkpoints) if rank == 0 and args.checkpoint_frequency > 0 else None
+
+    # Per phase wall time profiler (no-op unless --profile)
+    profiler = PhaseProfiler(
+        f"{args.save_model_dir}/{args.wandb_project}/{run_name}_{run_id}/profile", device=config.device,
+        enabled=args.profile and rank == 0, trace_epochs=args.profile_trace_epochs)
+
+    # Background evaluation of the model snapshots (piano rolls, umap and hit scores, if --eval_in_background)
+    eval_worker = EvalWorker(
+        settings=dict(
+            dataset_json_dir=config.dataset_json_dir,
+            dataset_json_fname=config.dataset_json_fname,
+            evaluate_on_subset=args.evaluate_on_subset,
+            collapse_tapped_sequence=collapse_tapped_sequence,
+            cached_folder="eval/GrooveEvaluator/templates",
+            device="cpu",
+            test_dataset_kwargs=dict(
+                dataset_setting_json_path="data/dataset_json_settings/4_4_Beats_gmd.json",
+                subset_tag="test",
+                max_len=int(args.max_len_enc),
+                tapped_voice_idx=2,
+                collapse_tapped_sequence=collapse_tapped_sequence,
+                down_sampled_ratio=0.1 if args.is_testing is True else None,
+                move_all_to_gpu=False)),
+        output_dir=f"{args.save_model_dir}/{args.wandb_project}/{run_name}_{run_id}/eval",
+        max_pending=args.eval_max_pending,
+        when_full=args.eval_when_full,
+        num_threads=args.eval_worker_threads) if args.eval_in_background and rank == 0 else None
+
+    for epoch in range(start_epoch, config.epochs):
         print(f"Epoch {epoch} of {config.epochs}, steps so far {step_}")
+        profiler.start_epoch(epoch)
 
         # Run the training loop (trains per batch internally)
         # ------------------------------------------------------------------------------------------
-        groove_transformer_vae.train()
+        train_model.train()
+        if args.distributed:
+            train_dataloader.sampler.set_epoch(epoch)
 
         logger.info("***************************Training...")
 
         train_log_metrics, step_ = vae_train_utils.train_loop(
             train_dataloader=train_dataloader,
-            groove_transformer_vae=groove_transformer_vae,
+            groove_transformer_vae=train_model,
             optimizer=optimizer,
             hit_loss_fn=hit_loss_fn,
             velocity_loss_fn=velocity_loss_fn,
@@ -271,10 +461,20 @@ if __name__ == "__main__":
             starting_step=step_,
             kl_beta=beta_np_cyc[epoch],
             reduce_by_sum=config.reduce_loss_by_sum,
+            precision=config.get("precision", "fp32"),
+            log_batch_histograms=args.log_batch_histograms,
+            augmenter=augmenter,
+            profiler=profiler
         )
 
-        wandb.log(train_log_metrics, commit=False)
-        wandb.log({"kl_beta": beta_np_cyc[epoch]}, commit=False)
+        if args.distributed:
+            # average the losses of all the shards, then only rank 0 goes on with the evaluation/logging/saving
+            train_log_metrics = distributed_utils.all_reduce_metrics(train_log_metrics)
+            if rank != 0:
+                continue
+
+        sink.log(train_log_metrics, commit=False)
+        sink.log({"kl_beta": beta_np_cyc[epoch]}, commit=False)
 
         # ---------------------------------------------------------------------------------------------------
         # After each epoch, evaluate the model on the test set
@@ -293,80 +493,100 @@ if __name__ == "__main__":
             offset_loss_fn=offset_loss_fn,
             device=config.device,
             kl_beta=beta_np_cyc[epoch],
-            reduce_by_sum = config.reduce_loss_by_sum
+            reduce_by_sum = config.reduce_loss_by_sum,
+            precision=config.get("precision", "fp32"),
+            log_batch_histograms=args.log_batch_histograms,
+            profiler=profiler
         )
 
-        wandb.log(test_log_metrics, commit=False)
+        sink.log(test_log_metrics, commit=False)
         logger.info(f"Epoch {epoch} Finished with total train loss of {train_log_metrics['train/loss_total']} "
                     f"and test loss of {test_log_metrics['test/loss_total']}")
 
         # Generate PianoRolls and UMAP Plots  and KL/OA PLots if Needed
         # ---------------------------------------------------------------------------------------------------
         umap_logged = False
+        eval_tasks = []
         if args.piano_roll_samples:
-            if epoch % args.piano_roll_frequency == 0:
-                media = vae_test_utils.get_logging_media_for_vae_model_wandb(
-                    groove_transformer_vae=groove_transformer_vae,
-                    device=config.device,
-                    dataset_setting_json_path=f"{config.dataset_json_dir}/{config.dataset_json_fname}",
-                    subset_name='test',
-                    down_sampled_ratio=0.005,
-                    collapse_tapped_sequence=collapse_tapped_sequence,
-                    cached_folder="eval/GrooveEvaluator/templates",
-                    divide_by_genre=True,
-                    need_piano_roll=True,
-                    need_kl_plot=False,
-                    need_audio=False
-                )
-                wandb.log(media, commit=False)
+            if epoch % args.piano_roll_frequency == 0 and eval_worker is not None:
+                eval_tasks.extend(["piano_rolls", "umap"])
+                umap_logged = True
+            elif epoch % args.piano_roll_frequency == 0:
+                with profiler.phase("media/piano_rolls"):
+                    media = vae_test_utils.get_logging_media_for_vae_model_wandb(
+                        groove_transformer_vae=groove_transformer_vae,
+                        device=config.device,
+                        dataset_setting_json_path=f"{config.dataset_json_dir}/{config.dataset_json_fname}",
+                        subset_name='test',
+                        down_sampled_ratio=0.005,
+                        collapse_tapped_sequence=collapse_tapped_sequence,
+                        cached_folder="eval/GrooveEvaluator/templates",
+                        divide_by_genre=True,
+                        need_piano_roll=True,
+                        need_kl_plot=False,
+                        need_audio=False
+                    )
+                    sink.log(media, commit=False)
 
                 # umap
-                media = vae_test_utils.generate_umap_for_vae_model_wandb(
-                    groove_transformer_vae=groove_transformer_vae,
-                    device=config.device,
-                    test_dataset=test_dataset,
-                    subset_name='test',
-                    collapse_tapped_sequence=collapse_tapped_sequence,
-                )
-                wandb.log(media, commit=False)
+                with profiler.phase("media/umap"):
+                    media = vae_test_utils.generate_umap_for_vae_model_wandb(
+                        groove_transformer_vae=groove_transformer_vae,
+                        device=config.device,
+                        test_dataset=test_dataset,
+                        subset_name='test',
+                        collapse_tapped_sequence=collapse_tapped_sequence,
+                    )
+                    sink.log(media, commit=False)
 
                 umap_logged = True
 
         # Get Hit Scores for the entire train and the entire test set
         # ---------------------------------------------------------------------------------------------------
         if args.calculate_hit_scores_on_train:
-            if epoch % args.hit_score_frequency == 0:
-                logger.info("________Calculating Hit Scores on Train Set...")
-                train_set_hit_scores = vae_test_utils.get_hit_scores_for_vae_model(
-                    groove_transformer_vae=groove_transformer_vae,
-                    device=config.device,
-                    dataset_setting_json_path=f"{config.dataset_json_dir}/{config.dataset_json_fname}",
-                    subset_name='train',
-                    down_sampled_ratio=0.1,
-                    collapse_tapped_sequence=collapse_tapped_sequence,
-                    cached_folder="eval/GrooveEvaluator/templates",
-                    divide_by_genre=False
-                )
-                wandb.log(train_set_hit_scores, commit=False)
+            if epoch % args.hit_score_frequency == 0 and eval_worker is not None:
+                eval_tasks.append("hit_scores_train")
+            elif epoch % args.hit_score_frequency == 0:
+                with profiler.phase("hit_scores/train"):
+                    logger.info("________Calculating Hit Scores on Train Set...")
+                    train_set_hit_scores = vae_test_utils.get_hit_scores_for_vae_model(
+                        groove_transformer_vae=groove_transformer_vae,
+                        device=config.device,
+                        dataset_setting_json_path=f"{config.dataset_json_dir}/{config.dataset_json_fname}",
+                        subset_name='train',
+                        down_sampled_ratio=0.1,
+                        collapse_tapped_sequence=collapse_tapped_sequence,
+                        cached_folder="eval/GrooveEvaluator/templates",
+                        divide_by_genre=False
+                    )
+                    sink.log(train_set_hit_scores, commit=False)
 
         if args.calculate_hit_scores_on_test:
-            if epoch % args.hit_score_frequency == 0:
-                logger.info("________Calculating Hit Scores on Test Set...")
-                test_set_hit_scores = vae_test_utils.get_hit_scores_for_vae_model(
-                    groove_transformer_vae=groove_transformer_vae,
-                    device=config.device,
-                    dataset_setting_json_path=f"{config.dataset_json_dir}/{config.dataset_json_fname}",
-                    subset_name=args.evaluate_on_subset,
-                    down_sampled_ratio=None,
-                    collapse_tapped_sequence=collapse_tapped_sequence,
-                    cached_folder="eval/GrooveEvaluator/templates",
-                    divide_by_genre=False
-                )
-                wandb.log(test_set_hit_scores, commit=False)
-
-        # Commit the metrics to wandb
+            if epoch % args.hit_score_frequency == 0 and eval_worker is not None:
+                eval_tasks.append("hit_scores_test")
+            elif epoch % args.hit_score_frequency == 0:
+                with profiler.phase("hit_scores/test"):
+                    logger.info("________Calculating Hit Scores on Test Set...")
+                    test_set_hit_scores = vae_test_utils.get_hit_scores_for_vae_model(
+                        groove_transformer_vae=groove_transformer_vae,
+                        device=config.device,
+                        dataset_setting_json_path=f"{config.dataset_json_dir}/{config.dataset_json_fname}",
+                        subset_name=args.evaluate_on_subset,
+                        down_sampled_ratio=None,
+                        collapse_tapped_sequence=collapse_tapped_sequence,
+                        cached_folder="eval/GrooveEvaluator/templates",
+                        divide_by_genre=False
+                    )
+                    sink.log(test_set_hit_scores, commit=False)
+
+        # Hand a snapshot to the background evaluation and log the evaluations finished so far
+        # (logged at the current step, eval/epoch is the epoch of the evaluated snapshot)
         # ---------------------------------------------------------------------------------------------------
-        wandb.log({"epoch": epoch}, step=epoch)
+        if eval_worker is not None:
+            with profiler.phase("eval_worker/submit"):
+                eval_worker.submit(epoch, groove_transformer_vae, eval_tasks)
+            for eval_epoch, eval_results in eval_worker.poll_results():
+                sink.log({**eval_results, "eval/epoch": eval_epoch}, commit=False)
 
         # Save the model if needed
         # ---------------------------------------------------------------------------------------------------
@@ -378,12 +598,39 @@ if __name__ == "__main__":
                     ep_ = f"0{epoch}"
                 else:
                     ep_ = epoch
-                model_artifact = wandb.Artifact(f'model_epoch_{ep_}', type='model')
-                model_path = f"{args.save_model_dir}/{args.wandb_project}/{run_name}_{run_id}/{ep_}.pth"
-                groove_transformer_vae.save(model_path)
-                model_artifact.add_file(model_path)
-                wandb_run.log_artifact(model_artifact)
+                with profiler.phase("save_model"):
+                    model_path = f"{args.save_model_dir}/{args.wandb_project}/{run_name}_{run_id}/{ep_}.pth"
+                    groove_transformer_vae.save(model_path)
+                    sink.log_model_file(model_path, f'model_epoch_{ep_}')
                 logger.info(f"Model saved to {model_path}")
 
-    wandb.finish()
+        # Save the full training state (snapshot now, written by a background thread)
+        # ---------------------------------------------------------------------------------------------------
+        if checkpointer is not None and ((epoch + 1) % args.checkpoint_frequency == 0 or epoch == config.epochs - 1):
+            with profiler.phase("checkpoint"):
+                checkpointer.save(checkpointing.get_training_state(
+                    groove_transformer_vae, optimizer, epoch, step_,
+                    config={key: value for key, value in config.as_dict().items() if not key.startswith("_")},
+                    wandb_run_id=run_id,
+                    stateful_objects=stateful_objects), epoch)
+
+        # Export the per phase timings of the epoch
+        # ---------------------------------------------------------------------------------------------------
+        profile_summary = profiler.end_epoch()
+        if profile_summary is not None:
+            sink.log(profiler.get_wandb_metrics(profile_summary), commit=False)
+
+        # Commit the metrics of the epoch
+        # ---------------------------------------------------------------------------------------------------
+        sink.log({"epoch": epoch}, step=epoch, commit=True)
+
+    profiler.close()
+    if eval_worker is not None:
+        for eval_epoch, eval_results in eval_worker.close():
+            sink.log({**eval_results, "eval/epoch": eval_epoch})
+    if checkpointer is not None:
+        checkpointer.close()
+    sink.finish()
+    if args.distributed:
+        distributed_utils.cleanup_distributed()
 
@@ -6,9 +6,13 @@ import torch
 from model import Density1D
 from helpers import vae_train_utils
 from helpers.Control.density_eval import *
-from data.src.dataLoaders import GrooveDataSet_Density
+from data.src.dataLoaders import GrooveDataSet_Density, TensorBatchIterator
 from helpers import vae_test_utils, vae_train_utils
 from helpers import density_eval
+from helpers.VAE.compile_utils import compile_model, warmup_compiled_model
+from helpers.VAE import checkpointing
+from helpers.VAE.thread_tuner import apply_machine_profile
+from helpers.metrics_sink import init_metrics_sink, BACKENDS
 from torch.utils.data import DataLoader
 from logging import getLogger, DEBUG
 import yaml
@@ -31,6 +35,12 @@ parser.add_argument("--wandb", type=bool, help="log to wandb", default=True)
 parser.add_argument(
     "--config",
     help="Yaml file for configuration. If available, the rest of the arguments will be ignored", default=None)
+parser.add_argument("--logger", type=str, help="metrics backend - 'wandb', 'local' (offline jsonl + media files) or "
+                                              "'disabled'", default="wandb", choices=list(BACKENDS))
+parser.add_argument("--log_dir", type=str, help="root folder of the runs logged with --logger local",
+                    default="misc/logs")
+parser.add_argument("--histogram_every_n_steps", type=int, help="log histograms at most once every n steps", default=1)
+parser.add_argument("--watch_log_freq", type=int, help="log parameter/gradient histograms every n steps", default=1)
 parser.add_argument("--wandb_project", type=str, help="WANDB Project Name",
                     default="Control 1D")
 
@@ -77,12 +87,23 @@ parser.add_argument("--beta_annealing_start_first_rise_at_epoch", type=int, help
 # ----------------------- Training Parameters -----------------------
 parser.add_argument("--dropout", type=float, help="Dropout", default=0.4)
 parser.add_argument("--force_data_on_cuda", type=bool, help="places all training data on cude", default=True)
+parser.add_argument("--in_memory_batches", type=bool, help="slice the batches directly out of the dataset tensors "
+                    "(cpu or cuda) instead of collating them sample by sample with a DataLoader", default=True)
 parser.add_argument("--epochs", type=int, help="Number of epochs", default=100)
 parser.add_argument("--batch_size", type=int, help="Batch size", default=64)
 parser.add_argument("--lr", type=float, help="Learning rate", default=1e-4)
+parser.add_argument("--machine_profile", type=str, help="tuned thread counts of this machine used when training on "
+                    "cpu (see helpers/VAE/thread_tuner.py) - 'auto', 'none' or the path of a profile", default="auto")
+parser.add_argument("--batch_size_from_profile", type=bool, help="also use the tuned batch size of the machine profile",
+                    default=False)
 parser.add_argument("--optimizer", type=str, help="optimizer to use - either 'sgd' or 'adam' loss", default="sgd",
                     choices=['sgd', 'adam'])
 parser.add_argument("--reduce_loss_by_sum", type=int, help="reduce loss by summing over all dimensions", default=0)
+parser.add_argument("--compile", type=bool, help="compile the forward/backward pass with torch.compile (falls "
+                                                 "back to eager if compilation fails)", default=False)
+parser.add_argument("--precision", type=str, help="precision of the forward pass - either 'fp32' or 'bf16' "
+                                                  "(bfloat16 autocast, losses stay in float32)", default="fp32",
+                    choices=['fp32', 'bf16'])
 
 # ----------------------- Data Parameters -----------------------
 parser.add_argument("--dataset_json_dir", type=str,
@@ -106,11 +127,17 @@ parser.add_argument("--calculate_hit_scores_on_test", type=bool,
 parser.add_argument("--piano_roll_samples", type=bool, help="Generate audio samples", default=True)
 parser.add_argument("--piano_roll_frequency", type=int, help="Frequency of piano roll generation", default=20)
 parser.add_argument("--hit_score_frequency", type=int, help="Frequency of hit score generation", default=10)
+parser.add_argument("--log_batch_histograms", type=bool, help="log histograms of the per batch losses", default=False)
 
 # ----------------------- Misc Params -----------------------
 parser.add_argument("--save_model", type=bool, help="Save model", default=True)
 parser.add_argument("--save_model_dir", type=str, help="Path to save the model", default="misc/VAE")
 parser.add_argument("--save_model_frequency", type=int, help="Save model every n epochs", default=10)
+parser.add_argument("--checkpoint_frequency", type=int,
+                    help="Save the full training state (in the background) every n epochs (0 to disable)", default=1)
+parser.add_argument("--keep_last_checkpoints", type=int, help="Number of training state checkpoints to keep", default=3)
+parser.add_argument("--resume", type=str, default=None,
+                    help="Training state checkpoint (or folder of checkpoints, the latest is used) to resume from")
 
 
 args, unknown = parser.parse_known_args()
@@ -163,6 +190,7 @@ else:
         lr=args.lr,
         optimizer=args.optimizer,
         reduce_loss_by_sum=True if args.reduce_loss_by_sum == 1 else False,
+        precision=args.precision,
         is_testing=args.is_testing,
         dataset_json_dir=args.dataset_json_dir,
         dataset_json_fname=args.dataset_json_fname,
@@ -179,20 +207,39 @@ assert "wandb_project" in hparams.keys(), "wandb_project not specified"
 
 if __name__ == "__main__":
 
-    # Initialize wandb
+    # Load the training state if resuming (the run continues with the config and in the wandb run of the checkpoint)
+    # ----------------------------------------------------------------------------------------------------------
+    resume_state = checkpointing.load_checkpoint(args.resume) if args.resume is not None else None
+    if resume_state is not None:
+        hparams = resume_state["config"]
+
+    # Use the tuned thread counts (and batch size if asked for) of this machine when training on cpu
+    # ----------------------------------------------------------------------------------------------------------
+    if hparams.get("device") == "cpu":
+        machine_settings = apply_machine_profile("train", model_type="density_1d", path=args.machine_profile,
+                                                 model_config=hparams)
+        if machine_settings is not None and args.batch_size_from_profile and resume_state is None:
+            hparams["batch_size"] = machine_settings["batch_size"]
+
+    # Initialize the metrics sink (wandb, local or disabled)
     # ----------------------------------------------------------------------------------------------------------
-    wandb_run = wandb.init(
+    sink = init_metrics_sink(
+        args.logger,
         config=hparams,                         # either from config file or CLI specified hyperparameters
         project=hparams["wandb_project"],          # name of the project
+        output_dir=args.log_dir,
+        histogram_every_n_steps=args.histogram_every_n_steps,
+        run_id=resume_state["wandb_run_id"] if resume_state is not None else None,
+        resume=resume_state is not None,
         entity="mmil_julian",                          # saves in the mmil_vae_cntd team account
-        settings=wandb.Settings(code_dir="train.py")    # for code saving
+        settings=wandb.Settings(code_dir="train.py")    # for code saving (wandb only)
     )
 
-    # Reset config to wandb.config (in case of sweeping with YAML necessary)
+    # Reset config to sink.config (wandb.config in case of sweeping with YAML necessary)
     # ----------------------------------------------------------------------------------------------------------
-    config = wandb.config
-    run_name = wandb_run.name
-    run_id = wandb_run.id
+    config = sink.config
+    run_name = sink.run_name
+    run_id = sink.run_id
     collapse_tapped_sequence = (args.embedding_size_src == 3)
     # Load Training and Testing Datasets and Wrap them in torch.utils.data.Dataloader
     # ----------------------------------------------------------------------------------------------------------
@@ -209,7 +256,10 @@ if __name__ == "__main__":
         hit_loss_balancing_beta=args.hit_loss_balancing_beta,
         genre_loss_balancing_beta=args.genre_loss_balancing_beta
     )
-    train_dataloader = DataLoader(training_dataset, batch_size=config.batch_size, shuffle=True)
+    if args.in_memory_batches:
+        train_dataloader = TensorBatchIterator(training_dataset, batch_size=config.batch_size, shuffle=True)
+    else:
+        train_dataloader = DataLoader(training_dataset, batch_size=config.batch_size, shuffle=True)
 
     test_dataset = GrooveDataSet_Density(
         dataset_setting_json_path="data/dataset_json_settings/4_4_BeatsAndFills_gmd.json",
@@ -221,14 +271,22 @@ if __name__ == "__main__":
         move_all_to_gpu=should_place_all_data_on_cuda
     )
 
-    test_dataloader = DataLoader(test_dataset, batch_size=config.batch_size, shuffle=True)
+    if args.in_memory_batches:
+        test_dataloader = TensorBatchIterator(test_dataset, batch_size=config.batch_size, shuffle=True)
+    else:
+        test_dataloader = DataLoader(test_dataset, batch_size=config.batch_size, shuffle=True)
 
     # Initialize the model
     # ------------------------------------------------------------------------------------------------------------
     model = Density1D(config)
 
     groove_1D_density_model = model.to(config.device)
-    wandb.watch(groove_1D_density_model, log="all", log_freq=1)
+    sink.watch(groove_1D_density_model, log_freq=args.watch_log_freq)
+
+    if args.compile:
+        compile_model(groove_1D_density_model)
+        groove_1D_density_model.train()
+        warmup_compiled_model(groove_1D_density_model, batch_sizes=(config.batch_size, ), training=True)
 
     # Instantiate the loss Criterion and Optimizer
     # ------------------------------------------------------------------------------------------------------------
@@ -265,7 +323,21 @@ if __name__ == "__main__":
     metrics = dict()
     step_ = 0
 
-    for epoch in range(config.epochs):
+    # Restore the training state right before the epoch loop (so that the random number generators continue exactly
+    # where they were), and write the training states in the background
+    # (the in memory batch iterators have their own generators)
+    stateful_objects = {name: obj for name, obj in [("train_batches", train_dataloader),
+                                                    ("test_batches", test_dataloader)]
+                        if hasattr(obj, "load_state_dict")}
+    start_epoch = 0
+    if resume_state is not None:
+        start_epoch, step_ = checkpointing.restore_training_state(resume_state, groove_1D_density_model, optimizer,
+                                                                  stateful_objects=stateful_objects)
+    checkpointer = checkpointing.AsyncCheckpointer(
+        f"{args.save_model_dir}/{args.wandb_project}/{run_name}_{run_id}/checkpoints",
+        keep_last=args.keep_last_checkpoints) if args.checkpoint_frequency > 0 else None
+
+    for epoch in range(start_epoch, config.epochs):
         print(f"Epoch {epoch} of {config.epochs}, steps so far {step_}")
 
         # Run the training loop (trains per batch internally)
@@ -290,10 +362,12 @@ if __name__ == "__main__":
             starting_step=step_,
             kl_beta=beta,
             reduce_by_sum=config.reduce_loss_by_sum,
+            precision=config.get("precision", "fp32"),
+            log_batch_histograms=args.log_batch_histograms,
         )
 
-        wandb.log(train_log_metrics, commit=False)
-        wandb.log({"kl_beta": beta}, commit=False)
+        sink.log(train_log_metrics, commit=False)
+        sink.log({"kl_beta": beta}, commit=False)
 
         # ---------------------------------------------------------------------------------------------------
         # After each epoch, evaluate the model on the test set
@@ -312,10 +386,12 @@ if __name__ == "__main__":
             offset_loss_fn=offset_loss_fn,
             device=config.device,
             kl_beta=beta,
-            reduce_by_sum = config.reduce_loss_by_sum
+            reduce_by_sum = config.reduce_loss_by_sum,
+            precision=config.get("precision", "fp32"),
+            log_batch_histograms=args.log_batch_histograms
         )
 
-        wandb.log(test_log_metrics, commit=False)
+        sink.log(test_log_metrics, commit=False)
 
 
 
@@ -331,7 +407,7 @@ if __name__ == "__main__":
                                                                       test_dataset=test_dataset,
                                                                       normalizing_fn=training_dataset.normalize_density)
 
-                wandb.log(piano_rolls, commit=False)
+                sink.log(piano_rolls, commit=False)
 
                 media = generate_umap_for_control_model_wandb(
                     model=groove_1D_density_model,
@@ -340,7 +416,7 @@ if __name__ == "__main__":
                     subset_name='test',
                     collapse_tapped_sequence=collapse_tapped_sequence,
                 )
-                wandb.log(media, commit=False)
+                sink.log(media, commit=False)
 
 
         # Get Hit Scores for the entire train and the entire test set
@@ -359,13 +435,13 @@ if __name__ == "__main__":
                     cached_folder="eval/GrooveEvaluator/templates",
                     divide_by_genre=False
                 )
-                wandb.log(train_set_hit_scores, commit=False)
+                sink.log(train_set_hit_scores, commit=False)
 
                 densities_predictions = get_density_prediction_averages(model=groove_1D_density_model,
                                                                         test_dataset=test_dataset,
                                                                         device=config.device,
                                                                         normalizing_fn=training_dataset.normalize_density)
-                wandb.log(densities_predictions, commit=False)
+                sink.log(densities_predictions, commit=False)
 
         if args.calculate_hit_scores_on_test:
             if epoch % args.hit_score_frequency == 0:
@@ -381,13 +457,9 @@ if __name__ == "__main__":
                     cached_folder="eval/GrooveEvaluator/templates",
                     divide_by_genre=False
                 )
-                wandb.log(test_set_hit_scores, commit=False)
-
+                sink.log(test_set_hit_scores, commit=False)
 
 
-        # Commit the metrics to wandb
-        # ---------------------------------------------------------------------------------------------------
-        wandb.log({"epoch": epoch}, step=epoch)
 
         # Save the model if needed
         # ---------------------------------------------------------------------------------------------------
@@ -399,12 +471,24 @@ if __name__ == "__main__":
                     ep_ = f"0{epoch}"
                 else:
                     ep_ = epoch
-                model_artifact = wandb.Artifact(f'model_epoch_{ep_}', type='model')
                 model_path = f"{args.save_model_dir}/{args.wandb_project}/{run_name}_{run_id}/{ep_}.pth"
                 groove_1D_density_model.save(model_path)
-                model_artifact.add_file(model_path)
-                wandb_run.log_artifact(model_artifact)
+                sink.log_model_file(model_path, f'model_epoch_{ep_}')
                 logger.info(f"Model saved to {model_path}")
 
-    wandb.finish()
+        # Save the full training state (snapshot now, written by a background thread)
+        # ---------------------------------------------------------------------------------------------------
+        if checkpointer is not None and ((epoch + 1) % args.checkpoint_frequency == 0 or epoch == config.epochs - 1):
+            checkpointer.save(checkpointing.get_training_state(
+                groove_1D_density_model, optimizer, epoch, step_,
+                config={key: value for key, value in config.as_dict().items() if not key.startswith("_")},
+                wandb_run_id=run_id, stateful_objects=stateful_objects), epoch)
+
+        # Commit the metrics of the epoch
+        # ---------------------------------------------------------------------------------------------------
+        sink.log({"epoch": epoch}, step=epoch, commit=True)
+
+    if checkpointer is not None:
+        checkpointer.close()
+    sink.finish()
 